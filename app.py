@@ -40,8 +40,19 @@ def start_channel(channel_name: str):
     channel.startup()
 
 
+def warm_up():
+    """在启动channel前预热bot、tokenizer和api连接，超时未完成的继续在后台执行"""
+    if not conf().get("warmup", True):
+        return
+    from bridge.bridge import Bridge
+    from common import warmup
+
+    warmup.warm_up(Bridge())
+
+
 def run():
     try:
+        start = time.time()
         # load config
         load_config()
         # ctrl + c
@@ -58,6 +69,8 @@ def run():
         if channel_name == "wxy":
             os.environ["WECHATY_LOG"] = "warn"
 
+        warm_up()
+        logger.info("App startup took {:.2f}s before starting channel {}".format(time.time() - start, channel_name))
         start_channel(channel_name)
 
         while True:
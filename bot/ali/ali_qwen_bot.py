@@ -15,7 +15,8 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common import const
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
+from common import const, metering
 from config import conf, load_config
 
 class AliQwenBot(Bot):
@@ -70,7 +71,7 @@ class AliQwenBot(Bot):
             session = self.sessions.session_query(query, session_id)
             logger.debug("[QWEN] session query={}".format(session.messages))
 
-            reply_content = self.reply_text(session)
+            reply_content = self.reply_text(session, cancel_token=context.get("cancel_token"))
             logger.debug(
                 "[QWEN] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -82,6 +83,7 @@ class AliQwenBot(Bot):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                metering.report_usage(context, conf().get("model"), reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -93,18 +95,23 @@ class AliQwenBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: AliQwenSession, retry_count=0) -> dict:
+    def reply_text(self, session: AliQwenSession, retry_count=0, cancel_token=None, deadline=None) -> dict:
         """
         call bailian's ChatCompletion to get the answer
         :param session: a conversation session
         :param retry_count: retry count
+        :param cancel_token: cancel token of the context, checked during retry waits
+        :param deadline: monotonic time after which no more retries are made
         :return: {}
         """
+        policy = get_retry_policy("qwen")
+        deadline = deadline or policy.deadline()
         try:
             prompt, history = self.convert_messages_format(session.messages)
             self.update_api_key_if_expired()
             # NOTE 阿里百炼的call()函数未提供temperature参数，考虑到temperature和top_p参数作用相同，取两者较小的值作为top_p参数传入，详情见文档 https://help.aliyun.com/document_detail/2587502.htm
-            response = broadscope_bailian.Completions().call(app_id=self.app_id(), prompt=prompt, history=history, top_p=min(self.temperature(), self.top_p()))
+            with policy.attempt():
+                response = broadscope_bailian.Completions().call(app_id=self.app_id(), prompt=prompt, history=history, top_p=min(self.temperature(), self.top_p()))
             completion_content = self.get_completion_content(response, self.node_id())
             completion_tokens, total_tokens = self.calc_tokens(session.messages, completion_content)
             return {
@@ -113,23 +120,20 @@ class AliQwenBot(Bot):
                 "content": completion_content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            need_retry = policy.is_transient(e)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[QWEN] {}".format(e))
+                result["content"] = "服务暂时不可用，请稍后再试"
+            elif isinstance(e, openai.error.RateLimitError):
                 logger.warn("[QWEN] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[QWEN] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[QWEN] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[QWEN] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -139,9 +143,9 @@ class AliQwenBot(Bot):
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
+            if need_retry and policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(e), policy.is_rate_limited(e)):
                 logger.warn("[QWEN] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
+                return self.reply_text(session, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
             else:
                 return result
 
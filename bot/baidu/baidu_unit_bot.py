@@ -4,33 +4,70 @@ import requests
 
 from bot.bot import Bot
 from bridge.reply import Reply, ReplyType
+from common.cancel_token import is_cancelled
+from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
+from config import conf
 
 
 # Baidu Unit对话接口 (可用, 但能力较弱)
 class BaiduUnitBot(Bot):
+    def __init__(self):
+        super().__init__()
+        self.retry_policy = get_retry_policy("baidu_unit")
+
     def reply(self, query, context=None):
-        token = self.get_token()
-        url = "https://aip.baidubce.com/rpc/2.0/unit/service/v3/chat?access_token=" + token
-        post_data = (
-            '{"version":"3.0","service_id":"S73177","session_id":"","log_id":"7758521","skill_ids":["1221886"],"request":{"terminal_id":"88888","query":"'
-            + query
-            + '", "hyper_params": {"chat_custom_bot_profile": 1}}}'
+        cancel_token = context.get("cancel_token") if context else None
+        try:
+            response = self.reply_text(query, cancel_token=cancel_token)
+        except CircuitOpenError as e:
+            logger.warn("[BAIDU_UNIT] {}".format(e))
+            return Reply(ReplyType.ERROR, "服务暂时不可用，请稍后再试")
+        except Exception as e:
+            logger.exception("[BAIDU_UNIT] Exception: {}".format(e))
+            return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+        if response is None:
+            return Reply(ReplyType.ERROR, "请求已取消")
+        reply = Reply(
+            ReplyType.TEXT,
+            response.json()["result"]["context"]["SYS_PRESUMED_HIST"][1],
         )
-        print(post_data)
-        headers = {"content-type": "application/x-www-form-urlencoded"}
-        response = requests.post(url, data=post_data.encode(), headers=headers)
-        if response:
-            reply = Reply(
-                ReplyType.TEXT,
-                response.json()["result"]["context"]["SYS_PRESUMED_HIST"][1],
-            )
-            return reply
+        return reply
+
+    def reply_text(self, query, retry_count=0, cancel_token=None, deadline=None):
+        """
+        :return: 接口的响应，请求被取消时返回None，重试用完后抛出最后一次的异常
+        """
+        if is_cancelled(cancel_token):
+            return None
+        deadline = deadline or self.retry_policy.deadline()
+        try:
+            with self.retry_policy.attempt():
+                token = self.get_token(deadline)
+                url = "https://aip.baidubce.com/rpc/2.0/unit/service/v3/chat?access_token=" + token
+                post_data = (
+                    '{"version":"3.0","service_id":"S73177","session_id":"","log_id":"7758521","skill_ids":["1221886"],"request":{"terminal_id":"88888","query":"'
+                    + query
+                    + '", "hyper_params": {"chat_custom_bot_profile": 1}}}'
+                )
+                logger.debug("[BAIDU_UNIT] post_data={}".format(post_data))
+                headers = {"content-type": "application/x-www-form-urlencoded"}
+                response = requests.post(url, data=post_data.encode(), headers=headers,
+                                         timeout=self.retry_policy.timeout(deadline, conf().get("request_timeout")))
+                response.raise_for_status()
+            return response
+        except Exception as e:
+            if self.retry_policy.is_transient(e) and self.retry_policy.wait_retry(
+                    retry_count, cancel_token, deadline, retry_after_seconds(e), self.retry_policy.is_rate_limited(e)):
+                logger.warn("[BAIDU_UNIT] {}, 第{}次重试".format(e, retry_count + 1))
+                return self.reply_text(query, retry_count + 1, cancel_token, deadline)
+            raise
 
-    def get_token(self):
+    def get_token(self, deadline=None):
         access_key = "YOUR_ACCESS_KEY"
         secret_key = "YOUR_SECRET_KEY"
         host = "https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id=" + access_key + "&client_secret=" + secret_key
-        response = requests.get(host)
-        if response:
-            print(response.json())
-            return response.json()["access_token"]
+        response = requests.get(host, timeout=self.retry_policy.timeout(deadline, conf().get("request_timeout")))
+        response.raise_for_status()
+        logger.debug("[BAIDU_UNIT] token response={}".format(response.json()))
+        return response.json()["access_token"]
@@ -2,17 +2,22 @@
 
 import requests
 import json
-from common import const
+from common import const, metering
 from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy
 from config import conf
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
 BAIDU_API_KEY = conf().get("baidu_wenxin_api_key")
 BAIDU_SECRET_KEY = conf().get("baidu_wenxin_secret_key")
+# 千帆接口的错误码：服务内部错误，可以重试
+BAIDU_SERVER_ERROR_CODES = (1, 2, 336000, 336100)
+# 千帆接口的错误码：QPS、RPM、TPM超限，可以退避后重试
+BAIDU_RATE_LIMIT_CODES = (4, 18, 336501, 336502)
 
 class BaiduWenxinBot(Bot):
 
@@ -49,7 +54,7 @@ class BaiduWenxinBot(Bot):
                     reply = Reply(ReplyType.INFO, "所有人记忆已清除")
                 else:
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)
+                    result = self.reply_text(session, cancel_token=context.get("cancel_token"))
                     total_tokens, completion_tokens, reply_content = (
                         result["total_tokens"],
                         result["completion_tokens"],
@@ -62,6 +67,7 @@ class BaiduWenxinBot(Bot):
                     if total_tokens == 0:
                         reply = Reply(ReplyType.ERROR, reply_content)
                     else:
+                        metering.report_usage(context, session.model, total_tokens, completion_tokens)
                         self.sessions.session_reply(reply_content, session_id, total_tokens)
                         reply = Reply(ReplyType.TEXT, reply_content)
                 return reply
@@ -74,7 +80,9 @@ class BaiduWenxinBot(Bot):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: BaiduWenxinSession, retry_count=0):
+    def reply_text(self, session: BaiduWenxinSession, retry_count=0, cancel_token=None, deadline=None):
+        policy = get_retry_policy("baidu")
+        deadline = deadline or policy.deadline()
         try:
             logger.info("[BAIDU] model={}".format(session.model))
             access_token = self.get_access_token()
@@ -90,9 +98,21 @@ class BaiduWenxinBot(Bot):
                 'Content-Type': 'application/json'
             }
             payload = {'messages': session.messages, 'system': self.prompt} if self.prompt_enabled else {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
-            response_text = json.loads(response.text)
+            with policy.attempt() as attempt:
+                response = requests.request("POST", url, headers=headers, data=json.dumps(payload),
+                                            timeout=policy.timeout(deadline, conf().get("request_timeout")))
+                response_text = json.loads(response.text)
+                error_code = response_text.get("error_code")
+                if response.status_code >= 500 or error_code in BAIDU_SERVER_ERROR_CODES:
+                    attempt.fail()
             logger.info(f"[BAIDU] response text={response_text}")
+            if response.status_code >= 500 or error_code in BAIDU_SERVER_ERROR_CODES + BAIDU_RATE_LIMIT_CODES:
+                rate_limited = error_code in BAIDU_RATE_LIMIT_CODES
+                if policy.wait_retry(retry_count, cancel_token, deadline, rate_limited=rate_limited):
+                    logger.warn("[BAIDU] 第{}次重试, error_code={}".format(retry_count + 1, error_code))
+                    return self.reply_text(session, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
+                content = "提问太快啦，请休息一下再问我吧" if rate_limited else "我现在有点累了，等会再来吧"
+                return {"total_tokens": 0, "completion_tokens": 0, "content": content}
             res_content = response_text["result"]
             total_tokens = response_text["usage"]["total_tokens"]
             completion_tokens = response_text["usage"]["completion_tokens"]
@@ -103,9 +123,16 @@ class BaiduWenxinBot(Bot):
                 "content": res_content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[BAIDU] {}".format(e))
+                return {"total_tokens": 0, "completion_tokens": 0, "content": "服务暂时不可用，请稍后再试"}
+            if policy.is_transient(e):
+                logger.warn("[BAIDU] {}: {}".format(type(e).__name__, e))
+                if policy.wait_retry(retry_count, cancel_token, deadline):
+                    logger.warn("[BAIDU] 第{}次重试".format(retry_count + 1))
+                    return self.reply_text(session, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
+                return {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             logger.warn("[BAIDU] Exception: {}".format(e))
-            need_retry = False
             self.sessions.clear_session(session.session_id)
             result = {"total_tokens": 0, "completion_tokens": 0, "content": "出错了: {}".format(e)}
             return result
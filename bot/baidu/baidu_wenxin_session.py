@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from common import token_estimator
 from common.log import logger
 
 """
@@ -45,9 +46,4 @@ class BaiduWenxinSession(Session):
 
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
-    tokens = 0
-    for msg in messages:
-        # 官方token计算规则暂不明确： "大约为 token数为 "中文字 + 其他语种单词数 x 1.3"
-        # 这里先直接根据字数粗略估算吧，暂不影响正常使用，仅在判断是否丢弃历史会话的时候会有偏差
-        tokens += len(msg["content"])
-    return tokens
+    return token_estimator.num_tokens_from_messages(messages, model)
@@ -15,3 +15,14 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    def clear_session(self, session_id):
+        """清除会话的上下文，没有会话记录的bot不需要处理"""
+        sessions = getattr(self, "sessions", None)
+        if sessions is not None:
+            sessions.clear_session(session_id)
+
+    def clear_all_session(self):
+        sessions = getattr(self, "sessions", None)
+        if sessions is not None:
+            sessions.clear_all_session()
@@ -0,0 +1,301 @@
+"""
+按顺序在多个bot后端之间故障转移的路由层，如 ChatGPT -> Moonshot -> Qwen
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from bot.bot import Bot
+from bot.bot_factory import create_bot
+from bot.session_manager import SessionManager
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common.cancel_token import CancelToken
+from common.circuit_breaker import CircuitBreaker, LatencyTracker
+from common.log import logger
+from config import conf
+
+# 请求在这里的线程中执行，调用方只等待结果，超时或对冲失败的请求被取消后不再阻塞调用方
+_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="bot_router")
+_create_lock = threading.Lock()
+
+MIN_SAMPLES = 20  # 样本数达到后才按耗时分位数调整超时和对冲
+
+
+class Backend(object):
+    def __init__(self, bot_type, model=None):
+        self.bot_type = bot_type
+        self.model = model
+        self.bot = None
+        self.name = "{}({})".format(bot_type, model) if model else bot_type
+        breaker = conf().get("bot_circuit_breaker") or {}
+        self.breaker = CircuitBreaker(breaker.get("failure_threshold", 5), breaker.get("recovery_timeout", 30))
+        self.latency = LatencyTracker()
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def get_bot(self) -> Bot:
+        if self.bot is None:
+            with _create_lock:
+                if self.bot is None:
+                    self.bot = _create_bot(self.bot_type, self.model)
+        return self.bot
+
+    def timeout(self) -> float:
+        """自适应超时：p99耗时的2倍，限制在[bot_timeout_min, bot_timeout_max]之间，样本不足时用最大值"""
+        max_timeout = conf().get("bot_timeout_max", 180)
+        p99 = self.latency.percentile(99) if len(self.latency) >= MIN_SAMPLES else None
+        if p99 is None:
+            return max_timeout
+        return min(max_timeout, max(conf().get("bot_timeout_min", 10), p99 * 2))
+
+    def hedge_delay(self):
+        """超过p95耗时仍未返回时向下一个后端发起对冲请求，样本不足时不对冲"""
+        if len(self.latency) < MIN_SAMPLES:
+            return None
+        return self.latency.percentile(95)
+
+    def stats(self) -> dict:
+        p50 = self.latency.percentile(50)
+        p95 = self.latency.percentile(95)
+        return {
+            "state": self.breaker.state,
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "p50": round(p50, 2) if p50 is not None else None,
+            "p95": round(p95, 2) if p95 is not None else None,
+            "timeout": round(self.timeout(), 2),
+        }
+
+
+def _create_bot(bot_type, model):
+    """指定了模型的后端在bot创建后替换bot自身的模型和会话的模型，不修改全局的model配置"""
+    bot = create_bot(bot_type)
+    if model:
+        _set_model(bot, model, bot_type)
+    return bot
+
+
+def _set_model(bot: Bot, model, bot_type):
+    pinned = False
+    for name in ("args", "request_body"):
+        args = getattr(bot, name, None)
+        if isinstance(args, dict) and "model" in args:
+            args["model"] = model
+            pinned = True
+    for name in ("model", "model_name"):
+        if isinstance(getattr(bot, name, None), str):
+            setattr(bot, name, model)
+            pinned = True
+    if not pinned:
+        # 这类bot在每次请求时读取全局的model配置，无法为单个后端指定模型
+        logger.warning("[BotRouter] {} does not support a per-backend model, use the global model instead of {}".format(bot_type, model))
+        return
+    sessions = getattr(bot, "sessions", None)
+    if isinstance(sessions, SessionManager) and "model" in sessions.session_args:
+        sessions.session_args["model"] = model
+
+
+class _Attempt(object):
+    def __init__(self, backend: Backend, future, cancel_token: CancelToken):
+        self.backend = backend
+        self.future = future
+        self.cancel_token = cancel_token
+        self.start = time.monotonic()
+        self.deadline = self.start + backend.timeout()
+
+
+class BotRouter(Bot):
+    """
+    文本对话依次尝试各个后端：失败(异常或错误回复)或超时后换下一个，熔断打开的后端直接跳过；
+    开启对冲(bot_hedging)时，当前后端超过p95耗时未返回就同时请求下一个后端，取先成功的结果并取消其他请求
+    """
+
+    def __init__(self, primary, failover):
+        self.backends = [Backend(primary)]
+        for item in failover:
+            if isinstance(item, str):
+                self.backends.append(Backend(item))
+            else:
+                self.backends.append(Backend(item["bot_type"], item.get("model")))
+        logger.info("[BotRouter] backends: {}".format(" -> ".join(b.name for b in self.backends)))
+
+    @property
+    def sessions(self):
+        return getattr(self.backends[0].get_bot(), "sessions", None)
+
+    def clear_session(self, session_id):
+        """清除所有已创建后端的会话，否则之后切换到其他后端时被清除的上下文又会出现"""
+        for backend in self.backends:
+            if backend.bot is not None:
+                backend.bot.clear_session(session_id)
+
+    def clear_all_session(self):
+        for backend in self.backends:
+            if backend.bot is not None:
+                backend.bot.clear_all_session()
+
+    def reply(self, query, context: Context = None) -> Reply:
+        if context.type != ContextType.TEXT:
+            return self.backends[0].get_bot().reply(query, context)
+        if query.startswith("#"):
+            # 清除记忆等命令对所有已创建的后端生效
+            reply = self.backends[0].get_bot().reply(query, context)
+            for backend in self.backends[1:]:
+                if backend.bot is not None:
+                    backend.bot.reply(query, context)
+            return reply
+        return self._route(query, context)
+
+    def _route(self, query, context: Context) -> Reply:
+        parent_token = context.get("cancel_token")
+        hedging = conf().get("bot_hedging", False)
+        pending = list(self.backends)  # 尚未尝试的后端
+        attempted = []  # 已发起的请求
+        running = []
+        reply = None
+        while True:
+            if not running:
+                backend = self._next_backend(pending, attempted)
+                if backend is None:
+                    break
+                running.append(self._start(backend, query, context, parent_token))
+                attempted.append(running[-1])
+            now = time.monotonic()
+            wake_at = min(a.deadline for a in running)
+            hedge_at = None
+            if hedging and len(running) == 1 and pending:
+                delay = running[0].backend.hedge_delay()
+                if delay is not None:
+                    hedge_at = running[0].start + delay
+                    wake_at = min(wake_at, hedge_at)
+            done, _ = wait([a.future for a in running], timeout=max(0, wake_at - now), return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for attempt in [a for a in running if a.future in done]:
+                running.remove(attempt)
+                result = self._finish(attempt)
+                if result is not None and result.type != ReplyType.ERROR:
+                    for other in running:
+                        logger.info("[BotRouter] cancel slower request to {}".format(other.backend.name))
+                        self._abandon(other)
+                    self._sync_sessions(query, context, attempt, attempted, result)
+                    return result
+                reply = result or reply
+            for attempt in [a for a in running if a.deadline <= now]:
+                running.remove(attempt)
+                attempt.cancel_token.cancel()
+                attempt.backend.timeouts += 1
+                attempt.backend.failures += 1
+                attempt.backend.breaker.record_failure()
+                logger.warning("[BotRouter] {} timeout after {:.1f}s".format(attempt.backend.name, now - attempt.start))
+            if hedge_at is not None and now >= hedge_at and len(running) == 1:
+                backend = self._next_backend(pending, attempted)
+                if backend is not None:
+                    logger.info("[BotRouter] {} slower than p95 ({:.1f}s), hedge to {}".format(
+                        running[0].backend.name, now - running[0].start, backend.name))
+                    running.append(self._start(backend, query, context, parent_token))
+                    attempted.append(running[-1])
+            if parent_token is not None and parent_token.cancelled:
+                for attempt in running:
+                    self._abandon(attempt)
+                break
+        return reply or Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+
+    def _next_backend(self, pending, attempted):
+        """取出下一个熔断器放行的后端；所有后端都被熔断时仍然尝试主后端"""
+        while pending:
+            backend = pending.pop(0)
+            if backend.breaker.allow():
+                return backend
+            logger.debug("[BotRouter] skip {}, circuit {}".format(backend.name, backend.breaker.state))
+        if not attempted:
+            logger.warning("[BotRouter] all backends are unavailable, try {} anyway".format(self.backends[0].name))
+            return self.backends[0]
+        return None
+
+    def _start(self, backend: Backend, query, context: Context, parent_token) -> _Attempt:
+        # 每次请求使用独立的context和取消令牌，取消一个请求不影响其他请求，原请求被取消时一并取消
+        cancel_token = CancelToken()
+        if parent_token is not None:
+            parent_token.add_callback(cancel_token.cancel)
+        kwargs = dict(context.kwargs)
+        kwargs["cancel_token"] = cancel_token
+        fallback = backend is not self.backends[0]
+        if fallback:
+            kwargs.pop("gpt_model", None)  # 用户指定的模型只对主后端有效
+        attempt_context = Context(context.type, context.content, kwargs)
+        if fallback:
+            logger.info("[BotRouter] request {}".format(backend.name))
+        future = _executor.submit(backend.get_bot().reply, query, attempt_context)
+        attempt = _Attempt(backend, future, cancel_token)
+        if parent_token is not None:
+            future.add_done_callback(lambda f: parent_token.remove_callback(cancel_token.cancel))
+        return attempt
+
+    @staticmethod
+    def _abandon(attempt: _Attempt):
+        """取消不再需要的请求，请求结束后释放熔断器的半开探测名额"""
+        attempt.cancel_token.cancel()
+        attempt.future.add_done_callback(lambda f: attempt.backend.breaker.record_cancelled())
+
+    def _finish(self, attempt: _Attempt):
+        backend = attempt.backend
+        try:
+            result = attempt.future.result()
+        except Exception as e:
+            logger.exception("[BotRouter] {} error: {}".format(backend.name, e))
+            result = None
+        if result is not None and result.type != ReplyType.ERROR:
+            backend.successes += 1
+            backend.latency.record(time.monotonic() - attempt.start)
+            backend.breaker.record_success()
+        elif not attempt.cancel_token.cancelled:
+            backend.failures += 1
+            backend.breaker.record_failure()
+            logger.warning("[BotRouter] {} failed: {}".format(backend.name, result))
+        return result
+
+    def _sync_sessions(self, query, context: Context, winner: _Attempt, attempted, reply: Reply):
+        """
+        其他后端的会话补记这一轮对话，之后切换后端时上下文不丢失
+        失败、超时或被取消的请求可能已经记录了提问，等请求结束后只补记回复，不留下没有回复的提问
+        """
+        if reply.type != ReplyType.TEXT:
+            return
+        session_id = context.get("session_id")
+        attempts = {a.backend: a for a in attempted}
+        for backend in self.backends:
+            if backend is winner.backend or backend.bot is None:
+                continue
+            attempt = attempts.get(backend)
+            if attempt is None:
+                self._sync_session(backend, query, session_id, reply.content, False)
+            else:
+                # 已结束的请求会立即执行回调
+                attempt.future.add_done_callback(lambda f, b=backend: self._sync_attempted(b, f, query, session_id, reply.content))
+
+    def _sync_attempted(self, backend: Backend, future, query, session_id, content):
+        try:
+            result = None if future.cancelled() or future.exception() else future.result()
+            if result is not None and result.type != ReplyType.ERROR:
+                return  # 请求在取消前已完成，bot自己记录了这一轮对话
+            self._sync_session(backend, query, session_id, content, True)
+        except Exception as e:
+            logger.warning("[BotRouter] sync session of {} failed: {}".format(backend.name, e))
+
+    @staticmethod
+    def _sync_session(backend: Backend, query, session_id, content, attempted):
+        sessions = getattr(backend.bot, "sessions", None)
+        if not isinstance(sessions, SessionManager):
+            return
+        with sessions.lock(session_id):
+            session = sessions.sessions.get(session_id)
+            last = session.messages[-1] if session and session.messages else None
+            if not attempted or not last or last.get("role") != "user" or last.get("content") != query:
+                sessions.session_query(query, session_id)
+            sessions.session_reply(content, session_id)
+
+    def stats(self) -> dict:
+        return {backend.name: backend.stats() for backend in self.backends}
@@ -1,33 +1,33 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 import requests
-from common import const
+from common import const, metering
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
-from bridge.context import ContextType
+from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common.cancel_token import RequestCancelled, is_cancelled
+from common.image_jobs import SUCCEEDED, ImageJobFailed, ImageJobQuotaExceeded, image_job_engine
+from common.key_pool import LEAST_LOADED, build_key_pool
 from common.log import logger
+from common.openai_client import OpenAIClient, get_openai_client
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
 from common.token_bucket import TokenBucket
 from config import conf, load_config
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
+
 # OpenAI对话模型API (可用)
 class ChatGPTBot(Bot, OpenAIImage):
     def __init__(self):
         super().__init__()
-        # set the default api_key
-        openai.api_key = conf().get("open_ai_api_key")
-        if conf().get("open_ai_api_base"):
-            openai.api_base = conf().get("open_ai_api_base")
-        proxy = conf().get("proxy")
-        if proxy:
-            openai.proxy = proxy
+        # 配置了open_ai_api_keys时在多个key之间调度，否则只有open_ai_api_key一个key
+        self.key_pool = build_key_pool(conf().get("open_ai_api_keys"), conf().get("open_ai_api_key"),
+                                       strategy=conf().get("api_key_strategy", LEAST_LOADED))
         if conf().get("rate_limit_chatgpt"):
             self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
         conf_model = conf().get("model") or "gpt-3.5-turbo"
@@ -50,6 +50,8 @@ class ChatGPTBot(Bot, OpenAIImage):
             remove_keys = ["temperature", "top_p", "frequency_penalty", "presence_penalty"]
             for key in remove_keys:
                 self.args.pop(key, None)  # 如果键不存在，使用 None 来避免抛出错误
+        self.sessions.summarizer = self.summarize
+        self.retry_policy = get_retry_policy("chatgpt")
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -83,7 +85,7 @@ class ChatGPTBot(Bot, OpenAIImage):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
+            reply_content = self.reply_text(session, api_key, args=new_args, cancel_token=context.get("cancel_token"))
             logger.debug(
                 "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -95,6 +97,7 @@ class ChatGPTBot(Bot, OpenAIImage):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                metering.report_usage(context, (new_args or self.args).get("model"), reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -114,21 +117,40 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, cancel_token=None, tried_keys=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param cancel_token: cancel token of the context, checked before each attempt and during retry waits
+        :param tried_keys: keys of the key pool that already failed in this request
+        :param deadline: monotonic time after which no more retries are made
         :return: {}
         """
+        if is_cancelled(cancel_token):
+            logger.info("[CHATGPT] request cancelled, session_id={}".format(session.session_id))
+            return {"completion_tokens": 0, "content": "请求已取消"}
+        pool_key = None
+        deadline = deadline or self.retry_policy.deadline()
         try:
             if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
+            # if api_key == None, a key from the key pool (or the default open_ai_api_key) will be used
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+            if api_key is None:
+                pool_key = self.key_pool.acquire(exclude=tried_keys or ())
+            request_args = dict(args, request_timeout=self.retry_policy.timeout(deadline, args.get("request_timeout")))
+            try:
+                with self.retry_policy.attempt():
+                    response = self._client(api_key, pool_key).chat_completion(session.messages, cancel_token=cancel_token, **request_args)
+            except Exception:
+                if pool_key:
+                    self.key_pool.release(pool_key, error=True)
+                raise
+            if pool_key:
+                self.key_pool.release(pool_key, tokens=response["usage"]["total_tokens"])
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
             return {
@@ -136,75 +158,187 @@ class ChatGPTBot(Bot, OpenAIImage):
                 "completion_tokens": response["usage"]["completion_tokens"],
                 "content": response.choices[0]["message"]["content"],
             }
+        except RequestCancelled:
+            logger.info("[CHATGPT] request cancelled, session_id={}".format(session.session_id))
+            return {"completion_tokens": 0, "content": "请求已取消"}
         except Exception as e:
-            need_retry = retry_count < 2
+            if pool_key and self._quarantine_key(pool_key, e):
+                # 被限流或鉴权失败的key先隔离，还有其他key时立即换key重试，不计入重试次数
+                tried_keys = (tried_keys or set()) | {pool_key}
+                if self.key_pool.has_alternative(tried_keys):
+                    logger.warn("[CHATGPT] key {} failed, failover to next key".format(pool_key.name))
+                    return self.reply_text(session, api_key, args, retry_count, cancel_token=cancel_token, tried_keys=tried_keys, deadline=deadline)
+            need_retry = self.retry_policy.is_transient(e)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[CHATGPT] {}".format(e))
+                result["content"] = "服务暂时不可用，请稍后再试"
+            elif isinstance(e, openai.error.RateLimitError):
                 logger.warn("[CHATGPT] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CHATGPT] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
             else:
                 logger.exception("[CHATGPT] Exception: {}".format(e))
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
+            if need_retry and self.retry_policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(e),
+                                                           self.retry_policy.is_rate_limited(e)):
                 logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                return self.reply_text(session, api_key, args, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
             else:
                 return result
 
 
+    def summarize(self, previous_summary, transcript, session_id=None) -> str:
+        """
+        把之前的摘要和较早的对话压缩成新的摘要，优先使用conversation_summary_model配置的较便宜的模型
+        在后台执行，没有消息上下文，用量按session_id计量
+        """
+        args = self.args.copy()
+        if conf().get("conversation_summary_model"):
+            args["model"] = conf().get("conversation_summary_model")
+        if "temperature" in args:
+            args["temperature"] = 0.3
+        content = "之前的摘要：\n{}\n\n新的对话：\n{}".format(previous_summary or "无", transcript)
+        messages = [
+            {"role": "system", "content": "你负责压缩对话记录。把之前的摘要和新的对话合并成一份简洁的摘要，保留用户的身份、偏好、已确认的事实和未完成的问题，不超过300字，直接输出摘要。"},
+            {"role": "user", "content": content},
+        ]
+        pool_key = self.key_pool.acquire()
+        try:
+            response = self._client(None, pool_key).chat_completion(messages, **args)
+        except Exception:
+            if pool_key:
+                self.key_pool.release(pool_key, error=True)
+            raise
+        if pool_key:
+            self.key_pool.release(pool_key, tokens=response["usage"]["total_tokens"])
+        metering.report_usage(Context(kwargs={"session_id": session_id}), args.get("model"),
+                              response["usage"]["total_tokens"], response["usage"]["completion_tokens"])
+        return response.choices[0]["message"]["content"]
+
+    def _client(self, api_key, pool_key) -> OpenAIClient:
+        """请求使用的客户端：用户自己的key优先，其次是key池分配的key，都没有时使用open_ai_api_key"""
+        if api_key or not pool_key:
+            return get_openai_client(api_key=api_key)
+        return get_openai_client(pool_key.api_base, pool_key.key)
+
+    def _quarantine_key(self, pool_key, e) -> bool:
+        """按错误类型隔离key，返回是否隔离"""
+        quarantine_seconds = conf().get("api_key_quarantine_seconds", {})
+        if isinstance(e, openai.error.RateLimitError):
+            # 优先按服务端返回的Retry-After隔离
+            retry_after = (getattr(e, "headers", None) or {}).get("retry-after")
+            try:
+                seconds = float(retry_after)
+            except (TypeError, ValueError):
+                seconds = quarantine_seconds.get("rate_limit", 20)
+            self.key_pool.quarantine(pool_key, seconds, "rate limit")
+            return True
+        if isinstance(e, (openai.error.AuthenticationError, openai.error.PermissionError)):
+            self.key_pool.quarantine(pool_key, quarantine_seconds.get("auth", 600), type(e).__name__)
+            return True
+        return False
+
+    def get_key_pool_stats(self) -> list:
+        """每个key的请求数、token数、最近一分钟的用量和隔离状态"""
+        return self.key_pool.stats()
+
+
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
         super().__init__()
-        openai.api_type = "azure"
-        openai.api_version = conf().get("azure_api_version", "2023-06-01-preview")
         self.args["deployment_id"] = conf().get("azure_deployment_id")
+        self.retry_policy = get_retry_policy("azure")
+
+    def _client(self, api_key, pool_key) -> OpenAIClient:
+        api_version = conf().get("azure_api_version", "2023-06-01-preview")
+        if api_key or not pool_key:
+            return get_openai_client(api_key=api_key, api_type="azure", api_version=api_version)
+        return get_openai_client(pool_key.api_base, pool_key.key, api_type="azure", api_version=api_version)
+
+    def reply(self, query, context=None):
+        # dall-e-2是异步接口，有channel时提交后立即回复，图片生成后由任务引擎回调发送
+        if context.type == ContextType.IMAGE_CREATE and conf().get("text_to_image") == "dall-e-2" and context.get("channel"):
+            return self._reply_img_async(query, context)
+        return super().reply(query, context)
+
+    def _reply_img_async(self, query, context) -> Reply:
+        def on_done(job):
+            if job.status == SUCCEEDED:
+                reply = Reply(ReplyType.IMAGE_URL, job.result)
+            else:
+                reply = Reply(ReplyType.ERROR, "图片生成失败")
+            channel = context["channel"]
+            try:
+                # 与同步回复相同，经过回复装饰和ON_SEND_REPLY插件，发送失败时由channel重试
+                channel._send_reply(context, channel._decorate_reply(context, reply))
+            except Exception as e:
+                logger.error("[CHATGPT] send image error: {}".format(e))
+
+        try:
+            self._submit_dalle2(query, context["session_id"], on_done)
+        except ImageJobQuotaExceeded as e:
+            return Reply(ReplyType.INFO, str(e))
+        except Exception as e:
+            logger.error("create image error: {}".format(e))
+            return Reply(ReplyType.ERROR, "图片生成失败")
+        return Reply(ReplyType.INFO, "🚀图片生成中，完成后会自动发送，请耐心等待")
+
+    def _submit_dalle2(self, query, user_id=None, on_done=None):
+        api_version = "2023-06-01-preview"
+        endpoint = conf().get("azure_openai_dalle_api_base","open_ai_api_base")
+        # 检查endpoint是否以/结尾
+        if not endpoint.endswith("/"):
+            endpoint = endpoint + "/"
+        url = "{}openai/images/generations:submit?api-version={}".format(endpoint, api_version)
+        api_key = conf().get("azure_openai_dalle_api_key","open_ai_api_key")
+        headers = {"api-key": api_key, "Content-Type": "application/json"}
+        body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
+
+        def start():
+            submission = requests.post(url, headers=headers, json=body, timeout=(5, 30))
+            if "operation-location" not in submission.headers:
+                raise Exception("submit failed, status_code={}, res={}".format(submission.status_code, submission.text))
+            return submission.headers["operation-location"]
+
+        def poll(job):
+            data = requests.get(job.remote_id, headers=headers, timeout=(5, 10)).json()
+            status = data.get("status")
+            if status == "succeeded":
+                return data["result"]["data"][0]["url"]
+            if status in ("failed", "canceled", "deleted"):
+                raise ImageJobFailed((data.get("error") or {}).get("message") or status)
+            return None
+
+        return image_job_engine().submit("azure_dall-e-2", user_id, start, poll, on_done,
+                                         timeout=conf().get("image_job_timeout", 120), first_delay=1)
 
     def create_img(self, query, retry_count=0, api_key=None):
         text_to_image_model = conf().get("text_to_image")
         if text_to_image_model == "dall-e-2":
-            api_version = "2023-06-01-preview"
-            endpoint = conf().get("azure_openai_dalle_api_base","open_ai_api_base")
-            # 检查endpoint是否以/结尾
-            if not endpoint.endswith("/"):
-                endpoint = endpoint + "/"
-            url = "{}openai/images/generations:submit?api-version={}".format(endpoint, api_version)
-            api_key = conf().get("azure_openai_dalle_api_key","open_ai_api_key")
-            headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
-                body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
-                operation_location = submission.headers['operation-location']
-                status = ""
-                while (status != "succeeded"):
-                    if retry_count > 3:
-                        return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
-                    status = response.json()['status']
-                    retry_count += 1
-                image_url = response.json()['result']['data'][0]['url']
-                return True, image_url
+                job = self._submit_dalle2(query)
+            except ImageJobQuotaExceeded as e:
+                return False, str(e)
             except Exception as e:
                 logger.error("create image error: {}".format(e))
                 return False, "图片生成失败"
+            # 没有channel可以回调时同步等待，由任务引擎按退避间隔查询状态
+            job.wait()
+            if job.status != SUCCEEDED:
+                logger.error("create image error: {}".format(job.error))
+                return False, "图片生成失败"
+            return True, job.result
         elif text_to_image_model == "dall-e-3":
             api_version = conf().get("azure_api_version", "2024-02-15-preview")
             endpoint = conf().get("azure_openai_dalle_api_base","open_ai_api_base")
@@ -10,6 +10,7 @@ from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy
 from config import conf
 
 
@@ -118,18 +119,21 @@ class ClaudeAIBot(Bot, OpenAIImage):
         # Returns JSON of the newly created conversation information
         return response.json()
         
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    def _chat(self, query, context, retry_count=0, deadline=None) -> Reply:
         """
         发起对话请求
         :param query: 请求提示词
         :param context: 对话上下文
         :param retry_count: 当前递归重试次数
+        :param deadline: 所有重试的截止时间
         :return: 回复
         """
         if retry_count >= 2:
             # exit from retry 2 times
             logger.warn("[CLAUDEAI] failed after maximum number of retry times")
             return Reply(ReplyType.ERROR, "请再问我一次吧")
+        policy = get_retry_policy("claude_ai")
+        deadline = deadline or policy.deadline()
 
         try:
             session_id = context["session_id"]
@@ -176,7 +180,11 @@ class ClaudeAIBot(Bot, OpenAIImage):
                 'TE': 'trailers'
             }
 
-            res = requests.post(base_url + "/api/append_message", headers=headers, data=payload,impersonate="chrome110",proxies= self.proxies,timeout=400)
+            with policy.attempt() as attempt:
+                res = requests.post(base_url + "/api/append_message", headers=headers, data=payload,impersonate="chrome110",proxies= self.proxies,
+                                    timeout=policy.timeout(deadline, 400))
+                if res.status_code >= 500:
+                    attempt.fail()
             if res.status_code == 200 or "pemission" in res.text:
                 # execute success
                 decoded_data = res.content.decode("utf-8")
@@ -207,16 +215,20 @@ class ClaudeAIBot(Bot, OpenAIImage):
                 logger.error(f"[CLAUDE] chat failed, status_code={res.status_code}, "
                              f"msg={error.get('message')}, type={error.get('type')}, detail: {res.text}, uuid: {con_uuid}")
 
-                if res.status_code >= 500:
+                if res.status_code >= 500 and policy.wait_retry(retry_count, context.get("cancel_token"), deadline):
                     # server error, need retry
-                    time.sleep(2)
                     logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    return self._chat(query, context, retry_count + 1, deadline)
                 return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
 
+        except CircuitOpenError as e:
+            logger.warn("[CLAUDE] {}".format(e))
+            return Reply(ReplyType.ERROR, "服务暂时不可用，请稍后再试")
         except Exception as e:
             logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            # curl_cffi的网络异常不在通用的判断范围内
+            transient = policy.is_transient(e) or isinstance(e, requests.RequestsError)
+            if transient and policy.wait_retry(retry_count, context.get("cancel_token"), deadline):
+                logger.warn(f"[CLAUDE] do retry, times={retry_count}")
+                return self._chat(query, context, retry_count + 1, deadline)
+            return Reply(ReplyType.ERROR, "请再问我一次吧")
@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 import anthropic
@@ -13,7 +11,8 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common import const
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
+from common import const, metering
 from config import conf
 
 user_session = dict()
@@ -47,7 +46,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.INFO, "所有人记忆已清除")
                 else:
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)
+                    result = self.reply_text(session, cancel_token=context.get("cancel_token"))
                     logger.info(result)
                     total_tokens, completion_tokens, reply_content = (
                         result["total_tokens"],
@@ -61,6 +60,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     if total_tokens == 0:
                         reply = Reply(ReplyType.ERROR, reply_content)
                     else:
+                        metering.report_usage(context, self._model_mapping(conf().get("model")), total_tokens, completion_tokens)
                         self.sessions.session_reply(reply_content, session_id, total_tokens)
                         reply = Reply(ReplyType.TEXT, reply_content)
                 return reply
@@ -73,15 +73,19 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: BaiduWenxinSession, retry_count=0):
+    def reply_text(self, session: BaiduWenxinSession, retry_count=0, cancel_token=None, deadline=None):
+        policy = get_retry_policy("claude_api")
+        deadline = deadline or policy.deadline()
         try:
             actual_model = self._model_mapping(conf().get("model"))
-            response = self.claudeClient.messages.create(
-                model=actual_model,
-                max_tokens=4096,
-                system=conf().get("character_desc", ""),
-                messages=session.messages
-            )
+            with policy.attempt():
+                response = self.claudeClient.messages.create(
+                    model=actual_model,
+                    max_tokens=4096,
+                    system=conf().get("character_desc", ""),
+                    messages=session.messages,
+                    timeout=policy.timeout(deadline, conf().get("request_timeout")),
+                )
             # response = openai.Completion.create(prompt=str(session), **self.args)
             res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
             total_tokens = response.usage.input_tokens+response.usage.output_tokens
@@ -93,30 +97,32 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 "content": res_content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            need_retry = policy.is_transient(e)
             result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[CLAUDE_API] {}".format(e))
+                result["content"] = "服务暂时不可用，请稍后再试"
+            elif isinstance(e, (openai.error.RateLimitError, anthropic.RateLimitError)):
                 logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
+            elif isinstance(e, (openai.error.Timeout, anthropic.APITimeoutError)):
                 logger.warn("[CLAUDE_API] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIConnectionError):
+            elif isinstance(e, (openai.error.APIConnectionError, anthropic.APIConnectionError)):
                 logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
                 need_retry = False
                 result["content"] = "我连接不到你的网络"
+            elif need_retry:
+                logger.warn("[CLAUDE_API] {}: {}".format(type(e).__name__, e))
+                result["content"] = "请再问我一次"
             else:
                 logger.warn("[CLAUDE_API] Exception: {}".format(e))
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
+            if need_retry and policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(e), policy.is_rate_limited(e)):
                 logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
+                return self.reply_text(session, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
             else:
                 return result
 
@@ -4,7 +4,9 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import metering
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy
 from config import conf, load_config
 from .dashscope_session import DashscopeSession
 import os
@@ -51,7 +53,7 @@ class DashscopeBot(Bot):
             session = self.sessions.session_query(query, session_id)
             logger.debug("[DASHSCOPE] session query={}".format(session.messages))
 
-            reply_content = self.reply_text(session)
+            reply_content = self.reply_text(session, cancel_token=context.get("cancel_token"))
             logger.debug(
                 "[DASHSCOPE] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -63,6 +65,7 @@ class DashscopeBot(Bot):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                metering.report_usage(context, self.model_name, reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -73,21 +76,28 @@ class DashscopeBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: DashscopeSession, retry_count=0) -> dict:
+    def reply_text(self, session: DashscopeSession, retry_count=0, cancel_token=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param cancel_token: cancel token of the context, checked during retry waits
+        :param deadline: monotonic time after which no more retries are made
         :return: {}
         """
+        policy = get_retry_policy("dashscope")
+        deadline = deadline or policy.deadline()
         try:
             dashscope.api_key = self.api_key
-            response = self.client.call(
-                dashscope_models[self.model_name],
-                messages=session.messages,
-                result_format="message"
-            )
+            with policy.attempt() as attempt:
+                response = self.client.call(
+                    dashscope_models[self.model_name],
+                    messages=session.messages,
+                    result_format="message"
+                )
+                if response.status_code >= 500:
+                    attempt.fail()
             if response.status_code == HTTPStatus.OK:
                 content = response.output.choices[0]["message"]["content"]
                 return {
@@ -101,17 +111,21 @@ class DashscopeBot(Bot):
                     response.code, response.message
                 ))
                 result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-                need_retry = retry_count < 2
-                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-                if need_retry:
-                    return self.reply_text(session, retry_count + 1)
+                # 只有限流和服务端错误需要重试，参数错误等重试也不会成功
+                rate_limited = response.status_code == HTTPStatus.TOO_MANY_REQUESTS
+                need_retry = rate_limited or response.status_code >= 500
+                if need_retry and policy.wait_retry(retry_count, cancel_token, deadline, rate_limited=rate_limited):
+                    return self.reply_text(session, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
                 else:
                     return result
         except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, retry_count + 1)
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[DASHSCOPE] {}".format(e))
+                result["content"] = "服务暂时不可用，请稍后再试"
+                return result
+            logger.exception(e)
+            if policy.is_transient(e) and policy.wait_retry(retry_count, cancel_token, deadline):
+                return self.reply_text(session, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
             else:
                 return result
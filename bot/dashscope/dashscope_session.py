@@ -1,10 +1,12 @@
 from bot.session_manager import Session
+from common import token_estimator
 from common.log import logger
 
 
 class DashscopeSession(Session):
     def __init__(self, session_id, system_prompt=None, model="qwen-turbo"):
         super().__init__(session_id)
+        self.model = model
         self.reset()
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
@@ -40,12 +42,9 @@ class DashscopeSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages)
+        return num_tokens_from_messages(self.messages, self.model)
 
 
-def num_tokens_from_messages(messages):
-    # 只是大概，具体计算规则：https://help.aliyun.com/zh/dashscope/developer-reference/token-api?spm=a2c4g.11186623.0.0.4d8b12b0BkP3K9
-    tokens = 0
-    for msg in messages:
-        tokens += len(msg["content"])
-    return tokens
+def num_tokens_from_messages(messages, model="qwen-turbo"):
+    # 具体计算规则：https://help.aliyun.com/zh/dashscope/developer-reference/token-api?spm=a2c4g.11186623.0.0.4d8b12b0BkP3K9
+    return token_estimator.num_tokens_from_messages(messages, model)
@@ -11,7 +11,10 @@ import google.generativeai as genai
 from bot.session_manager import SessionManager
 from bridge.context import ContextType, Context
 from bridge.reply import Reply, ReplyType
+from common import metering
+from common.cancel_token import is_cancelled
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
 from config import conf
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
@@ -29,6 +32,8 @@ class GoogleGeminiBot(Bot):
         self.model = conf().get("model") or "gemini-pro"
         if self.model == "gemini":
             self.model = "gemini-pro"
+        self.retry_policy = get_retry_policy("gemini")
+
     def reply(self, query, context: Context = None) -> Reply:
         try:
             if context.type != ContextType.TEXT:
@@ -39,22 +44,13 @@ class GoogleGeminiBot(Bot):
             session = self.sessions.session_query(query, session_id)
             gemini_messages = self._convert_to_gemini_messages(self.filter_messages(session.messages))
             logger.debug(f"[Gemini] messages={gemini_messages}")
-            genai.configure(api_key=self.api_key)
-            model = genai.GenerativeModel(self.model)
-            
-            # 添加安全设置
-            safety_settings = {
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-            }
-            
-            # 生成回复，包含安全设置
-            response = model.generate_content(
-                gemini_messages,
-                safety_settings=safety_settings
-            )
+            response = self.reply_text(gemini_messages, cancel_token=context.get("cancel_token"))
+            if response is None:
+                return Reply(ReplyType.ERROR, "请求已取消")
+            # 被安全策略拦截的请求也按prompt计费
+            usage = getattr(response, "usage_metadata", None)
+            if usage is not None:
+                metering.report_usage(context, self.model, usage.total_token_count, usage.candidates_token_count)
             if response.candidates and response.candidates[0].content:
                 reply_text = response.candidates[0].content.parts[0].text
                 logger.info(f"[Gemini] reply={reply_text}")
@@ -69,13 +65,53 @@ class GoogleGeminiBot(Bot):
                 error_message = "No valid response generated due to safety constraints."
                 self.sessions.session_reply(error_message, session_id)
                 return Reply(ReplyType.ERROR, error_message)
-                    
+
+        except CircuitOpenError as e:
+            logger.warn(f"[Gemini] {e}")
+            return Reply(ReplyType.ERROR, "服务暂时不可用，请稍后再试")
         except Exception as e:
             logger.error(f"[Gemini] Error generating response: {str(e)}", exc_info=True)
             error_message = "Failed to invoke [Gemini] api!"
             self.sessions.session_reply(error_message, session_id)
             return Reply(ReplyType.ERROR, error_message)
-            
+
+    def reply_text(self, gemini_messages, retry_count=0, cancel_token=None, deadline=None):
+        """
+        调用gemini生成回复，超时、限流和服务端错误按重试策略重试
+        :return: GenerateContentResponse，请求被取消时返回None，重试用完后抛出最后一次的异常
+        """
+        if is_cancelled(cancel_token):
+            logger.info("[Gemini] request cancelled")
+            return None
+        deadline = deadline or self.retry_policy.deadline()
+        try:
+            genai.configure(api_key=self.api_key)
+            model = genai.GenerativeModel(self.model)
+
+            # 添加安全设置
+            safety_settings = {
+                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+            }
+
+            # 生成回复，包含安全设置
+            with self.retry_policy.attempt():
+                return model.generate_content(
+                    gemini_messages,
+                    safety_settings=safety_settings,
+                    request_options={"timeout": self.retry_policy.timeout(deadline, conf().get("request_timeout"))},
+                )
+        except Exception as e:
+            if self.retry_policy.is_transient(e) and self.retry_policy.wait_retry(
+                    retry_count, cancel_token, deadline, retry_after_seconds(e), self.retry_policy.is_rate_limited(e)):
+                logger.warn(f"[Gemini] {e}, 第{retry_count + 1}次重试")
+                return self.reply_text(gemini_messages, retry_count + 1, cancel_token, deadline)
+            if is_cancelled(cancel_token):
+                return None
+            raise
+
     def _convert_to_gemini_messages(self, messages: list):
         res = []
         for msg in messages:
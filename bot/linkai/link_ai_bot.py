@@ -10,11 +10,12 @@ from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common.cancel_token import RequestCancelled, cancellable_post, is_cancelled
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
 from config import conf, pconf
 import threading
-from common import memory, utils
-import base64
+from common import memory, metering, utils, vision_image
 import os
 
 class LinkAIBot(Bot):
@@ -44,18 +45,25 @@ class LinkAIBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    def _chat(self, query, context, retry_count=0, deadline=None) -> Reply:
         """
         发起对话请求
         :param query: 请求提示词
         :param context: 对话上下文
         :param retry_count: 当前递归重试次数
+        :param deadline: 所有重试的截止时间
         :return: 回复
         """
         if retry_count > 2:
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
             return Reply(ReplyType.TEXT, "请再问我一次吧")
+        cancel_token = context.get("cancel_token")
+        if is_cancelled(cancel_token):
+            logger.info("[LINKAI] request cancelled, session_id={}".format(context.get("session_id")))
+            return Reply(ReplyType.INFO, "请求已取消")
+        policy = get_retry_policy("linkai")
+        deadline = deadline or policy.deadline()
 
         try:
             # load config
@@ -123,13 +131,17 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            with policy.attempt() as attempt:
+                res = cancellable_post(base_url + "/v1/chat/completions", cancel_token=cancel_token, json=body, headers=headers,
+                                       timeout=policy.timeout(deadline, conf().get("request_timeout", 180)))
+                if res.status_code >= 500:
+                    attempt.fail()
             if res.status_code == 200:
                 # execute success
                 response = res.json()
                 reply_content = response["choices"][0]["message"]["content"]
                 total_tokens = response["usage"]["total_tokens"]
+                metering.report_usage(context, response.get("model") or body.get("model"), total_tokens, response["usage"].get("completion_tokens"))
                 res_code = response.get('code')
                 logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
                 if res_code == 429:
@@ -158,23 +170,28 @@ class LinkAIBot(Bot):
                 logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
                              f"msg={error.get('message')}, type={error.get('type')}")
 
-                if res.status_code >= 500:
+                if res.status_code >= 500 and policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(res)):
                     # server error, need retry
-                    time.sleep(2)
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    return self._chat(query, context, retry_count + 1, deadline)
 
                 error_reply = "提问太快啦，请休息一下再问我吧"
                 if res.status_code == 409:
                     error_reply = "这个问题我还没有学会，请问我其它问题吧"
                 return Reply(ReplyType.TEXT, error_reply)
 
+        except RequestCancelled:
+            logger.info("[LINKAI] request aborted, session_id={}".format(context.get("session_id")))
+            return Reply(ReplyType.INFO, "请求已取消")
+        except CircuitOpenError as e:
+            logger.warn("[LINKAI] {}".format(e))
+            return Reply(ReplyType.TEXT, "服务暂时不可用，请稍后再试")
         except Exception as e:
             logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            if policy.is_transient(e) and policy.wait_retry(retry_count, cancel_token, deadline):
+                logger.warn(f"[LINKAI] do retry, times={retry_count}")
+                return self._chat(query, context, retry_count + 1, deadline)
+            return Reply(ReplyType.TEXT, "请再问我一次吧")
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
@@ -214,29 +231,28 @@ class LinkAIBot(Bot):
 
     def _build_vision_msg(self, query: str, path: str):
         try:
-            suffix = utils.get_path_suffix(path)
-            with open(path, "rb") as file:
-                base64_str = base64.b64encode(file.read()).decode('utf-8')
-                messages = [{
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": query
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{suffix};base64,{base64_str}"
-                            }
+            # 缩小、重新压缩后再编码，同一张图片在缓存有效期内不重复处理
+            image_url = vision_image.image_to_data_url(path)
+            messages = [{
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": query
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url
                         }
-                    ]
-                }]
-                return messages
+                    }
+                ]
+            }]
+            return messages
         except Exception as e:
             logger.exception(e)
 
-    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
+    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0, deadline=None) -> dict:
         if retry_count >= 2:
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
@@ -245,6 +261,8 @@ class LinkAIBot(Bot):
                 "completion_tokens": 0,
                 "content": "请再问我一次吧"
             }
+        policy = get_retry_policy("linkai")
+        deadline = deadline or policy.deadline()
 
         try:
             body = {
@@ -262,8 +280,11 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            with policy.attempt() as attempt:
+                res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                                    timeout=policy.timeout(deadline, conf().get("request_timeout", 180)))
+                if res.status_code >= 500:
+                    attempt.fail()
             if res.status_code == 200:
                 # execute success
                 response = res.json()
@@ -282,11 +303,10 @@ class LinkAIBot(Bot):
                 logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
                              f"msg={error.get('message')}, type={error.get('type')}")
 
-                if res.status_code >= 500:
+                if res.status_code >= 500 and policy.wait_retry(retry_count, deadline=deadline, retry_after=retry_after_seconds(res)):
                     # server error, need retry
-                    time.sleep(2)
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
+                    return self.reply_text(session, app_code, retry_count + 1, deadline)
 
                 return {
                     "total_tokens": 0,
@@ -295,11 +315,14 @@ class LinkAIBot(Bot):
                 }
 
         except Exception as e:
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[LINKAI] {}".format(e))
+                return {"total_tokens": 0, "completion_tokens": 0, "content": "服务暂时不可用，请稍后再试"}
             logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+            if policy.is_transient(e) and policy.wait_retry(retry_count, deadline=deadline):
+                logger.warn(f"[LINKAI] do retry, times={retry_count}")
+                return self.reply_text(session, app_code, retry_count + 1, deadline)
+            return {"total_tokens": 0, "completion_tokens": 0, "content": "请再问我一次吧"}
 
     def _fetch_app_info(self, app_code: str):
         headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
@@ -440,21 +463,27 @@ def _download_file(url: str):
 
 class LinkAISessionManager(SessionManager):
     def session_msg_query(self, query, session_id):
-        session = self.build_session(session_id)
-        messages = session.messages + [{"role": "user", "content": query}]
+        with self.lock(session_id):
+            session = self.build_session(session_id)
+            messages = session.messages + [{"role": "user", "content": query}]
         return messages
 
     def session_reply(self, reply, session_id, total_tokens=None, query=None):
-        session = self.build_session(session_id)
-        if query:
-            session.add_query(query)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 2500)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with self.lock(session_id):
+            session = self.build_session(session_id)
+            if query:
+                session.add_query(query)
+            session.add_reply(reply)
+            self.summarize_exceeding(session)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 2500)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+            self.save_session(session)
+            session.compact()
+            self.sessions.touch(session_id)
         return session
 
 
@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -10,10 +8,11 @@ from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 import requests
-from common import const
+from common import const, metering
 
 
 # ZhipuAI对话模型API
@@ -72,7 +71,7 @@ class MinimaxBot(Bot):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, args=new_args)
+            reply_content = self.reply_text(session, args=new_args, cancel_token=context.get("cancel_token"))
             logger.debug(
                 "[Minimax_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -84,6 +83,7 @@ class MinimaxBot(Bot):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                metering.report_usage(context, new_args["model"], reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -94,20 +94,28 @@ class MinimaxBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: MinimaxSession, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: MinimaxSession, args=None, retry_count=0, cancel_token=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param cancel_token: cancel token of the context, checked during retry waits
+        :param deadline: monotonic time after which no more retries are made
         :return: {}
         """
+        policy = get_retry_policy("minimax")
+        deadline = deadline or policy.deadline()
         try:
             headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
             self.request_body["messages"].extend(session.messages)
             logger.info("[Minimax_AI] request_body={}".format(self.request_body))
             # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+            with policy.attempt() as attempt:
+                res = requests.post(self.base_url, headers=headers, json=self.request_body,
+                                    timeout=policy.timeout(deadline, conf().get("request_timeout")))
+                if res.status_code >= 500:
+                    attempt.fail()
 
             # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
             if res.status_code == 200:
@@ -127,25 +135,27 @@ class MinimaxBot(Bot):
                 if res.status_code >= 500:
                     # server error, need retry
                     logger.warn(f"[Minimax_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
+                    need_retry = True
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                    need_retry = True
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
+                if need_retry and policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(res), res.status_code == 429):
+                    return self.reply_text(session, args, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
                 else:
                     return result
         except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[Minimax_AI] {}".format(e))
+                result["content"] = "服务暂时不可用，请稍后再试"
+                return result
+            logger.exception(e)
+            if policy.is_transient(e) and policy.wait_retry(retry_count, cancel_token, deadline):
+                return self.reply_text(session, args, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
             else:
                 return result
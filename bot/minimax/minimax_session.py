@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from common import token_estimator
 from common.log import logger
 
 """
@@ -63,10 +64,4 @@ class MinimaxSession(Session):
 
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
-    # 官方token计算规则："对于中文文本来说，1个token通常对应一个汉字；对于英文文本来说，1个token通常对应3至4个字母或1个单词"
-    # 详情请产看文档：https://help.aliyun.com/document_detail/2586397.html
-    # 目前根据字符串长度粗略估计token数，不影响正常使用
-    tokens = 0
-    for msg in messages:
-        tokens += len(msg["text"])
-    return tokens
+    return token_estimator.num_tokens_from_messages(messages, model, key="text")
@@ -8,7 +8,11 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.cancel_token import RequestCancelled, is_cancelled
+from common import metering
 from common.log import logger
+from common.openai_client import OpenAIClient, get_openai_client
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
 import requests
@@ -30,6 +34,13 @@ class MoonshotBot(Bot):
         self.api_key = conf().get("moonshot_api_key")
         self.base_url = conf().get("moonshot_base_url", "https://api.moonshot.cn/v1/chat/completions")
 
+    def _client(self) -> OpenAIClient:
+        # moonshot_base_url配置的是完整的对话接口地址，客户端按api base缓存
+        api_base = self.base_url
+        if api_base.endswith("/chat/completions"):
+            api_base = api_base[:-len("/chat/completions")]
+        return get_openai_client(api_base, self.api_key)
+
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
@@ -60,7 +71,7 @@ class MoonshotBot(Bot):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, args=new_args)
+            reply_content = self.reply_text(session, args=new_args, cancel_token=context.get("cancel_token"))
             logger.debug(
                 "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -72,6 +83,7 @@ class MoonshotBot(Bot):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                metering.report_usage(context, new_args["model"], reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -82,28 +94,35 @@ class MoonshotBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: MoonshotSession, args=None, retry_count=0, cancel_token=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param cancel_token: cancel token of the context, aborts the http request and retries
+        :param deadline: monotonic time after which no more retries are made
         :return: {}
         """
+        if is_cancelled(cancel_token):
+            logger.info("[MOONSHOT_AI] request cancelled, session_id={}".format(session.session_id))
+            return {"completion_tokens": 0, "content": "请求已取消"}
+        policy = get_retry_policy("moonshot")
+        deadline = deadline or policy.deadline()
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
             body = args
             body["messages"] = session.messages
             # logger.debug("[MOONSHOT_AI] response={}".format(response))
             # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                json=body
-            )
+            with policy.attempt() as attempt:
+                res = self._client().post(
+                    "/chat/completions",
+                    cancel_token=cancel_token,
+                    json=body,
+                    timeout=policy.timeout(deadline, conf().get("request_timeout")),
+                )
+                if res.status_code >= 500:
+                    attempt.fail()
             if res.status_code == 200:
                 response = res.json()
                 return {
@@ -122,25 +141,30 @@ class MoonshotBot(Bot):
                 if res.status_code >= 500:
                     # server error, need retry
                     logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
+                    need_retry = True
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                    need_retry = True
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
+                if need_retry and policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(res), res.status_code == 429):
+                    return self.reply_text(session, args, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
                 else:
                     return result
+        except RequestCancelled:
+            logger.info("[MOONSHOT_AI] request cancelled, session_id={}".format(session.session_id))
+            return {"completion_tokens": 0, "content": "请求已取消"}
         except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[MOONSHOT_AI] {}".format(e))
+                result["content"] = "服务暂时不可用，请稍后再试"
+                return result
+            logger.exception(e)
+            if policy.is_transient(e) and policy.wait_retry(retry_count, cancel_token, deadline):
+                return self.reply_text(session, args, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
             else:
                 return result
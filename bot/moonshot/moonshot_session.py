@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from common import token_estimator
 from common.log import logger
 
 
@@ -45,7 +46,5 @@ class MoonshotSession(Session):
 
 
 def num_tokens_from_messages(messages, model):
-    tokens = 0
-    for msg in messages:
-        tokens += len(msg["content"])
-    return tokens
+    """Returns the number of tokens used by a list of messages."""
+    return token_estimator.num_tokens_from_messages(messages, model)
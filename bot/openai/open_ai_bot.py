@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 
@@ -11,7 +9,9 @@ from bot.openai.open_ai_session import OpenAISession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import metering
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
 from config import conf
 
 user_session = dict()
@@ -40,6 +40,7 @@ class OpenAIBot(Bot, OpenAIImage):
             "timeout": conf().get("request_timeout", None),  # 重试超时时间，在这个时间内，将会自动重试
             "stop": ["\n\n\n"],
         }
+        self.retry_policy = get_retry_policy("openai")
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -56,7 +57,7 @@ class OpenAIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.INFO, "所有人记忆已清除")
                 else:
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)
+                    result = self.reply_text(session, cancel_token=context.get("cancel_token"))
                     total_tokens, completion_tokens, reply_content = (
                         result["total_tokens"],
                         result["completion_tokens"],
@@ -69,6 +70,7 @@ class OpenAIBot(Bot, OpenAIImage):
                     if total_tokens == 0:
                         reply = Reply(ReplyType.ERROR, reply_content)
                     else:
+                        metering.report_usage(context, self.args["model"], total_tokens, completion_tokens)
                         self.sessions.session_reply(reply_content, session_id, total_tokens)
                         reply = Reply(ReplyType.TEXT, reply_content)
                 return reply
@@ -81,9 +83,12 @@ class OpenAIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: OpenAISession, retry_count=0):
+    def reply_text(self, session: OpenAISession, retry_count=0, cancel_token=None, deadline=None):
+        deadline = deadline or self.retry_policy.deadline()
         try:
-            response = openai.Completion.create(prompt=str(session), **self.args)
+            args = dict(self.args, request_timeout=self.retry_policy.timeout(deadline, self.args.get("request_timeout")))
+            with self.retry_policy.attempt():
+                response = openai.Completion.create(prompt=str(session), **args)
             res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "")
             total_tokens = response["usage"]["total_tokens"]
             completion_tokens = response["usage"]["completion_tokens"]
@@ -94,18 +99,17 @@ class OpenAIBot(Bot, OpenAIImage):
                 "content": res_content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            need_retry = self.retry_policy.is_transient(e)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[OPEN_AI] {}".format(e))
+                result["content"] = "服务暂时不可用，请稍后再试"
+            elif isinstance(e, openai.error.RateLimitError):
                 logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[OPEN_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -115,8 +119,9 @@ class OpenAIBot(Bot, OpenAIImage):
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
+            if need_retry and self.retry_policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(e),
+                                                           self.retry_policy.is_rate_limited(e)):
                 logger.warn("[OPEN_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
+                return self.reply_text(session, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
             else:
                 return result
@@ -1,9 +1,8 @@
-import time
-
-import openai
 import openai.error
 
 from common.log import logger
+from common.openai_client import get_openai_client
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
 from common.token_bucket import TokenBucket
 from config import conf
 
@@ -11,7 +10,6 @@ from config import conf
 # OPENAI提供的画图接口
 class OpenAIImage(object):
     def __init__(self):
-        openai.api_key = conf().get("open_ai_api_key")
         if conf().get("rate_limit_dalle"):
             self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
 
@@ -20,24 +18,27 @@ class OpenAIImage(object):
             if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
                 return False, "请求太快了，请休息一下再问我吧"
             logger.info("[OPEN_AI] image_query={}".format(query))
-            response = openai.Image.create(
-                api_key=api_key,
-                prompt=query,  # 图片描述
-                n=1,  # 每次生成图片的数量
-                model=conf().get("text_to_image") or "dall-e-2",
-                # size=conf().get("image_create_size", "256x256"),  # 图片大小,可选有 256x256, 512x512, 1024x1024
-            )
+            with get_retry_policy("openai").attempt():
+                response = get_openai_client(api_base, api_key).create_image(
+                    query,  # 图片描述
+                    n=1,  # 每次生成图片的数量
+                    model=conf().get("text_to_image") or "dall-e-2",
+                    timeout=conf().get("request_timeout", 180),
+                    # size=conf().get("image_create_size", "256x256"),  # 图片大小,可选有 256x256, 512x512, 1024x1024
+                )
             image_url = response["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
             return True, image_url
         except openai.error.RateLimitError as e:
             logger.warn(e)
-            if retry_count < 1:
-                time.sleep(5)
+            if get_retry_policy("openai").wait_retry(retry_count, retry_after=retry_after_seconds(e), rate_limited=True):
                 logger.warn("[OPEN_AI] ImgCreate RateLimit exceed, 第{}次重试".format(retry_count + 1))
-                return self.create_img(query, retry_count + 1)
+                return self.create_img(query, retry_count + 1, api_key=api_key, api_base=api_base)
             else:
                 return False, "画图出现问题，请休息一下再问我吧"
+        except CircuitOpenError as e:
+            logger.warn("[OPEN_AI] {}".format(e))
+            return False, "画图服务暂时不可用，请稍后再试"
         except Exception as e:
             logger.exception(e)
             return False, "画图出现问题，请休息一下再问我吧"
@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from common import token_estimator
 from common.log import logger
 
 
@@ -63,11 +64,6 @@ class OpenAISession(Session):
         return num_tokens_from_string(str(self), self.model)
 
 
-# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_string(string: str, model: str) -> int:
     """Returns the number of tokens in a text string."""
-    import tiktoken
-
-    encoding = tiktoken.encoding_for_model(model)
-    num_tokens = len(encoding.encode(string, disallowed_special=()))
-    return num_tokens
+    return token_estimator.count_tokens(string, model)
@@ -0,0 +1,222 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionBackend(object):
+    """
+    会话持久化后端，按(namespace, session_id)保存序列化后的会话
+    expire_at为过期的时间戳，None表示不过期，过期的会话读取时视为不存在并在写入时顺带清理
+    """
+
+    def load(self, namespace, session_id):
+        """返回保存的数据(str)，不存在或已过期时返回None"""
+        raise NotImplementedError
+
+    def save_many(self, items):
+        """批量写入[(namespace, session_id, data, expire_at)]，data为None表示删除"""
+        raise NotImplementedError
+
+    def clear(self, namespace):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionBackend(SessionBackend):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()  # 每个线程一个连接，WAL模式下读写互不阻塞
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "namespace TEXT NOT NULL, session_id TEXT NOT NULL, data TEXT NOT NULL, "
+                "expire_at REAL, updated_at REAL NOT NULL, PRIMARY KEY (namespace, session_id))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expire_at ON sessions (expire_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def load(self, namespace, session_id):
+        row = self._conn().execute(
+            "SELECT data FROM sessions WHERE namespace = ? AND session_id = ? AND (expire_at IS NULL OR expire_at > ?)",
+            (namespace, session_id, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_many(self, items):
+        now = time.time()
+        with self._conn() as conn:
+            for namespace, session_id, data, expire_at in items:
+                if data is None:
+                    conn.execute("DELETE FROM sessions WHERE namespace = ? AND session_id = ?", (namespace, session_id))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO sessions (namespace, session_id, data, expire_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                        (namespace, session_id, data, expire_at, now),
+                    )
+            conn.execute("DELETE FROM sessions WHERE expire_at IS NOT NULL AND expire_at <= ?", (now,))
+
+    def clear(self, namespace):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM sessions WHERE namespace = ?", (namespace,))
+
+
+class LMDBSessionBackend(SessionBackend):
+    """key为namespace\\0session_id，value为"过期时间戳\\n数据"，过期时间为0表示不过期"""
+
+    PURGE_EVERY = 100  # 每写入多少批清理一次过期会话，清理需要遍历整个库
+
+    def __init__(self, path, map_size):
+        import lmdb
+
+        self.env = lmdb.open(path, map_size=map_size)
+        self.writes = 0
+
+    @staticmethod
+    def _key(namespace, session_id) -> bytes:
+        return "{}\0{}".format(namespace, session_id).encode("utf-8")
+
+    @staticmethod
+    def _expired(value: bytes, now) -> bool:
+        expire_at = float(value[: value.index(b"\n")])
+        return 0 < expire_at <= now
+
+    def load(self, namespace, session_id):
+        with self.env.begin() as txn:
+            value = txn.get(self._key(namespace, session_id))
+        if value is None or self._expired(value, time.time()):
+            return None
+        return value[value.index(b"\n") + 1:].decode("utf-8")
+
+    def save_many(self, items):
+        now = time.time()
+        with self.env.begin(write=True) as txn:
+            for namespace, session_id, data, expire_at in items:
+                key = self._key(namespace, session_id)
+                if data is None:
+                    txn.delete(key)
+                else:
+                    txn.put(key, "{}\n{}".format(expire_at or 0, data).encode("utf-8"))
+            self.writes += 1
+            if self.writes % self.PURGE_EVERY == 0:
+                expired = [key for key, value in txn.cursor() if self._expired(value, now)]
+                for key in expired:
+                    txn.delete(key)
+
+    def clear(self, namespace):
+        prefix = "{}\0".format(namespace).encode("utf-8")
+        with self.env.begin(write=True) as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(prefix):
+                while cursor.key().startswith(prefix):
+                    if not cursor.delete():
+                        break
+
+    def close(self):
+        self.env.close()
+
+
+class WriteBehindBackend(object):
+    """
+    在后端之上做批量延迟写入：save只记录会话快照，由后台线程每隔flush_interval秒(或积压达到batch_size时)
+    序列化后在一个事务里写入；同一会话多次修改只写最后一次。load优先读取尚未写入的快照
+    """
+
+    def __init__(self, backend: SessionBackend, flush_interval=2, batch_size=100):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # 保证写入批次和clear的先后顺序
+        self.wakeup = threading.Event()
+        self.pending = {}  # (namespace, session_id) -> (快照, expire_at)，快照为None表示删除
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def load(self, namespace, session_id):
+        with self.lock:
+            if (namespace, session_id) in self.pending:
+                return self.pending[(namespace, session_id)][0]
+        data = self.backend.load(namespace, session_id)
+        return json.loads(data) if data else None
+
+    def save(self, namespace, session_id, snapshot, expire_at=None):
+        with self.lock:
+            self.pending[(namespace, session_id)] = (snapshot, expire_at)
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.set()
+
+    def delete(self, namespace, session_id):
+        self.save(namespace, session_id, None)
+
+    def clear(self, namespace):
+        with self.flush_lock:
+            with self.lock:
+                for key in [key for key in self.pending if key[0] == namespace]:
+                    del self.pending[key]
+            self.backend.clear(namespace)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return
+            items = []
+            for (namespace, session_id), (snapshot, expire_at) in batch.items():
+                data = json.dumps(snapshot, ensure_ascii=False) if snapshot is not None else None
+                items.append((namespace, session_id, data, expire_at))
+            try:
+                self.backend.save_many(items)
+                logger.debug("[SessionBackend] flushed {} sessions".format(len(items)))
+            except Exception as e:
+                logger.exception("[SessionBackend] flush failed, {} sessions not saved: {}".format(len(items), e))
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_session_backend():
+    """
+    根据session_backend配置创建全局共享的持久化后端，memory(默认)返回None，会话只保存在内存中
+    """
+    global _backend
+    backend_type = conf().get("session_backend", "memory")
+    if backend_type == "memory":
+        return None
+    with _backend_lock:
+        if _backend is None:
+            path = conf().get("session_backend_path")
+            if backend_type == "sqlite":
+                backend = SQLiteSessionBackend(path or os.path.join(get_appdata_dir(), "sessions.db"))
+            elif backend_type == "lmdb":
+                map_size = int(conf().get("session_lmdb_map_size_mb", 1024) * 1024 * 1024)
+                backend = LMDBSessionBackend(path or os.path.join(get_appdata_dir(), "sessions.lmdb"), map_size)
+            else:
+                raise ValueError("unknown session_backend: {}".format(backend_type))
+            _backend = WriteBehindBackend(backend, conf().get("session_flush_interval", 2), conf().get("session_flush_batch_size", 100))
+            logger.info("[SessionBackend] sessions persisted with {}".format(backend_type))
+        return _backend
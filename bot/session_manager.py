@@ -1,16 +1,90 @@
-from common.expired_dict import ExpiredDict
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from bot.session_backend import get_session_backend
 from common.log import logger
 from config import conf
 
+MESSAGE_OVERHEAD = 120  # 估算每条消息记录本身(dict或元组)占用的字节数
+SHARED_FIELDS = ("role", "sender_type", "sender_name")  # 取值有限的字段，字符串驻留后所有会话共享
+_key_tuples = {}  # 所有消息记录共享的字段名元组
+LOCK_STRIPES = 64  # SessionManager按session_id哈希分段加锁，不同分段的会话互不阻塞
+_records_lock = threading.Lock()  # 保护消息在dict列表和紧凑记录之间的转换，只在转换的瞬间持有
+SUMMARY_PREFIX = "以下是我们之前对话的摘要，请在后续回答中参考：\n"
+SUMMARY_ACK = "好的，我会参考之前的对话摘要。"
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")  # 在回复路径之外生成对话摘要
+
+
+def _pack_message(message: dict) -> tuple:
+    """把{"role", "content"}等dict转成紧凑的元组记录: (字段名元组, 值1, 值2, ...)"""
+    keys = tuple(message)
+    keys = _key_tuples.setdefault(keys, keys)
+    return (keys,) + tuple(sys.intern(v) if k in SHARED_FIELDS and type(v) is str else v for k, v in message.items())
+
+
+def _unpack_message(record: tuple) -> dict:
+    return dict(zip(record[0], record[1:]))
+
 
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        self.summary = None  # 较早对话的滚动摘要，开启conversation_summary时使用
         if system_prompt is None:
-            self.system_prompt = conf().get("character_desc", "")
+            system_prompt = conf().get("character_desc", "")
+        self.system_prompt = sys.intern(system_prompt) if type(system_prompt) is str else system_prompt  # 相同的人设在会话间共享
+
+    @property
+    def messages(self):
+        # 会话空闲时消息以紧凑的元组记录保存，访问时还原成原来的dict列表
+        while True:
+            messages = self._messages
+            if messages is not None:
+                return messages
+            records = self._records
+            if records is None:  # 其他线程刚还原过，重新读取
+                continue
+            messages = [_unpack_message(record) for record in records]
+            with _records_lock:
+                if self._records is records:
+                    self._messages = messages
+                    self._records = None
+                    return messages
+            # 还原期间其他线程已还原并再次压缩，重试
+
+    @messages.setter
+    def messages(self, messages):
+        self._messages = messages
+        self._records = None
+
+    def compact(self):
+        """一轮对话结束后调用，把消息转成紧凑记录以节省内存"""
+        messages = self._messages
+        if self._records is None and messages is not None:
+            records = tuple(_pack_message(message) for message in messages)
+            with _records_lock:
+                if self._messages is messages:
+                    self._records = records
+                    self._messages = None
+
+    def size_bytes(self) -> int:
+        """估算会话占用的内存，共享的字段和人设不计入"""
+        records = self._records
+        if records is not None:
+            items = (zip(record[0], record[1:]) for record in records)
         else:
-            self.system_prompt = system_prompt
+            items = (message.items() for message in self._messages)
+        size = 0
+        for fields in items:
+            size += MESSAGE_OVERHEAD
+            for key, value in fields:
+                if key not in SHARED_FIELDS and value is not self.system_prompt:
+                    size += sys.getsizeof(value)
+        return size
 
     # 重置会话
     def reset(self):
@@ -18,7 +92,7 @@ class Session(object):
         self.messages = [system_item]
 
     def set_system_prompt(self, system_prompt):
-        self.system_prompt = system_prompt
+        self.system_prompt = sys.intern(system_prompt) if type(system_prompt) is str else system_prompt
         self.reset()
 
     def add_query(self, query):
@@ -36,15 +110,127 @@ class Session(object):
         raise NotImplementedError
 
 
+class SessionStore(object):
+    """
+    会话的LRU存储，最久未访问的会话排在最前面:
+    超过expires_in_seconds未访问的会话在每次访问时从前面清理，总字节数或会话数超过上限时从前面淘汰
+    """
+
+    def __init__(self, expires_in_seconds=None, max_bytes=0, max_sessions=0):
+        self.expires_in_seconds = expires_in_seconds
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()  # session_id -> [session, 最后访问时间, 估算字节数]
+        self.total_bytes = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def get(self, session_id, default=None):
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(session_id)
+            if entry is None:
+                return default
+            self.entries.move_to_end(session_id)
+            entry[1] = time.monotonic()
+            return entry[0]
+
+    def __getitem__(self, session_id):
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __setitem__(self, session_id, session):
+        size = session.size_bytes()
+        with self.lock:
+            self._pop(session_id)
+            self.entries[session_id] = [session, time.monotonic(), size]
+            self.total_bytes += size
+            self._evict()
+
+    def __delitem__(self, session_id):
+        with self.lock:
+            if self._pop(session_id) is None:
+                raise KeyError(session_id)
+
+    def __contains__(self, session_id):
+        with self.lock:
+            self._expire()
+            return session_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def touch(self, session_id):
+        """会话内容变化后重新估算大小，并在超出上限时淘汰最久未访问的会话，调用方需持有会话的分段锁"""
+        entry = self.entries.get(session_id)
+        if entry is None:
+            return
+        size = entry[0].size_bytes()  # 在store的锁外估算，会话内容由SessionManager的分段锁保护
+        with self.lock:
+            if self.entries.get(session_id) is not entry:
+                return
+            self.total_bytes += size - entry[2]
+            entry[2] = size
+            self._evict()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"sessions": len(self.entries), "bytes": self.total_bytes, "evicted": self.evicted, "expired": self.expired}
+
+    def _pop(self, session_id):
+        entry = self.entries.pop(session_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+        return entry
+
+    def _expire(self):
+        if not self.expires_in_seconds:
+            return
+        deadline = time.monotonic() - self.expires_in_seconds
+        while self.entries:
+            session_id, entry = next(iter(self.entries.items()))
+            if entry[1] > deadline:
+                break
+            self._pop(session_id)
+            self.expired += 1
+
+    def _evict(self):
+        # 至少保留最近访问的一个会话
+        while len(self.entries) > 1 and (
+            (self.max_bytes and self.total_bytes > self.max_bytes) or (self.max_sessions and len(self.entries) > self.max_sessions)
+        ):
+            session_id, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry[2]
+            self.evicted += 1
+            logger.debug("[SessionStore] evict session {}, stats={}".format(session_id, self.stats()))
+
+
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            sessions = dict()
-        self.sessions = sessions
+        self.sessions = SessionStore(
+            conf().get("expires_in_seconds"),
+            max_bytes=int(conf().get("session_max_memory_mb", 0) * 1024 * 1024),
+            max_sessions=conf().get("session_max_count", 0),
+        )
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.backend = get_session_backend()  # 持久化后端，内存中的sessions作为它的读缓存
+        self.namespace = sessioncls.__name__
+        self.summarizer = None  # 由bot设置，summarizer(之前的摘要, 对话记录, session_id) -> 新的摘要，用于把旧的对话压缩成摘要，用量按session_id计量
+        self.summarizing = set()  # 正在生成摘要的session_id
+        self.locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+
+    def lock(self, session_id) -> threading.RLock:
+        """session_id对应的分段锁，修改会话的消息列表时需要持有"""
+        return self.locks[hash(session_id) % LOCK_STRIPES]
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -54,38 +240,142 @@ class SessionManager(object):
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
-        elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
-        return session
+        with self.lock(session_id):
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self._load_session(session_id) if system_prompt is None else None
+                if session is None:
+                    session = self.sessioncls(session_id, system_prompt, **self.session_args)
+                self.sessions[session_id] = session
+            elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
+                session.set_system_prompt(system_prompt)
+            return session
 
     def session_query(self, query, session_id):
-        session = self.build_session(session_id)
-        session.add_query(query)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        with self.lock(session_id):
+            session = self.build_session(session_id)
+            session.add_query(query)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                total_tokens = session.discard_exceeding(max_tokens, None)
+                logger.debug("prompt tokens used={}".format(total_tokens))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+            self.save_session(session)
+            self.sessions.touch(session_id)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
-        session = self.build_session(session_id)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with self.lock(session_id):
+            session = self.build_session(session_id)
+            session.add_reply(reply)
+            self.summarize_exceeding(session)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+            self.save_session(session)
+            session.compact()
+            self.sessions.touch(session_id)
         return session
 
     def clear_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        with self.lock(session_id):
+            if session_id in self.sessions:
+                del self.sessions[session_id]
+            if self.backend:
+                self.backend.delete(self.namespace, session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        if self.backend:
+            self.backend.clear(self.namespace)
+
+    def summarize_exceeding(self, session):
+        """
+        开启conversation_summary时，对话接近conversation_max_tokens后在后台把较早的对话(连同之前的摘要)压缩成一条摘要，
+        下次请求直接使用已生成的摘要；摘要生成前仍由discard_exceeding保证不超出上限
+        """
+        if not self.summarizer or not conf().get("conversation_summary") or session.session_id is None:
+            return
+        if session.session_id in self.summarizing:
+            return
+        try:
+            tokens = session.calc_tokens()
+        except Exception:
+            return
+        if tokens <= conf().get("conversation_max_tokens", 1000) * conf().get("conversation_summary_threshold", 0.8):
+            return
+        messages = session.messages
+        start = 1 if messages and messages[0].get("role") == "system" else 0
+        end = len(messages) - conf().get("conversation_summary_keep_turns", 2) * 2
+        folded = messages[start:end]
+        if len(folded) < 2 or any("role" not in message for message in folded):
+            return
+        self.summarizing.add(session.session_id)
+        summary_executor.submit(self._summarize, session.session_id, folded, session.summary)
+
+    def _summarize(self, session_id, folded, previous):
+        try:
+            # 之前的摘要单独传入(它在消息里可能已被discard_exceeding丢弃)，对话记录里跳过摘要消息
+            turns = [message for message in folded if not (message["role"] == "user" and message["content"].startswith(SUMMARY_PREFIX))]
+            turns = [message for message in turns if not (message["role"] == "assistant" and message["content"] == SUMMARY_ACK)]
+            transcript = "\n".join("{}: {}".format(message["role"], message["content"]) for message in turns)
+            start_time = time.time()
+            summary = self.summarizer(previous, transcript, session_id)
+            if not summary:
+                return
+            with self.lock(session_id):
+                session = self.sessions.get(session_id)
+                if session is None:
+                    return
+                messages = session.messages
+                start = 1 if messages and messages[0].get("role") == "system" else 0
+                # 摘要生成期间最早的几条可能已被discard_exceeding丢弃，从仍保留的第一条开始去掉已压缩的消息
+                i, j = start, 0
+                while j < len(folded) and i < len(messages) and messages[i] != folded[j]:
+                    j += 1
+                while j < len(folded) and i < len(messages) and messages[i] == folded[j]:
+                    i += 1
+                    j += 1
+                summary_items = [{"role": "user", "content": SUMMARY_PREFIX + summary}, {"role": "assistant", "content": SUMMARY_ACK}]
+                session.messages = messages[:start] + summary_items + messages[i:]
+                session.summary = summary
+                self.save_session(session)
+                self.sessions.touch(session_id)
+            logger.debug("[SessionManager] summarized {} messages of session {} in {:.2f}s".format(len(folded), session_id, time.time() - start_time))
+        except Exception as e:
+            logger.warning("[SessionManager] summarize session {} failed: {}".format(session_id, e))
+        finally:
+            with self.lock(session_id):
+                self.summarizing.discard(session_id)
+
+    def _load_session(self, session_id):
+        if not self.backend:
+            return None
+        try:
+            snapshot = self.backend.load(self.namespace, session_id)
+        except Exception as e:
+            logger.warning("[SessionManager] load session {} failed: {}".format(session_id, e))
+            return None
+        if snapshot is None:
+            return None
+        session = self.sessioncls(session_id, snapshot["system_prompt"], **self.session_args)
+        session.messages = list(snapshot["messages"])
+        session.summary = snapshot.get("summary")
+        return session
+
+    def save_session(self, session):
+        """记录会话快照，由后端在后台批量写入"""
+        if not self.backend or session.session_id is None:
+            return
+        expires_in_seconds = conf().get("expires_in_seconds")
+        expire_at = time.time() + expires_in_seconds if expires_in_seconds else None
+        snapshot = {"system_prompt": session.system_prompt, "messages": list(session.messages), "summary": session.summary}
+        self.backend.save(self.namespace, session.session_id, snapshot, expire_at)
+
+    def stats(self) -> dict:
+        """会话数、估算占用字节数、被淘汰和过期的会话数"""
+        return self.sessions.stats()
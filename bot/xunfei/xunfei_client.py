@@ -0,0 +1,221 @@
+# encoding:utf-8
+"""
+讯飞星火websocket客户端：在调用方线程中同步收发，每个分片直接交给调用方，不再经过全局队列轮询
+
+星火协议每次问答结束后服务端会关闭连接，连接无法复用；为减少建连(TLS握手、鉴权)的耗时，
+可以预先建立若干空闲连接，请求到来时直接取用，取用后在后台补充
+"""
+import base64
+import hashlib
+import hmac
+import json
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import mktime
+from urllib.parse import urlencode, urlparse
+from wsgiref.handlers import format_date_time
+
+import websocket
+
+from common.cancel_token import RequestCancelled
+from common.log import logger
+
+SPARE_MAX_AGE = 30  # 空闲连接的最长保留时间(秒)，超过后服务端可能已断开
+RATE_LIMIT_CODES = (11202, 11203)  # 秒级流控超限、并发流控超限
+
+_prewarm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="xunfei_prewarm")
+
+
+class SparkError(Exception):
+    """星火接口返回了非0的错误码"""
+
+    def __init__(self, code, message):
+        super().__init__("[{}] {}".format(code, message))
+        self.code = code
+
+    @property
+    def rate_limited(self) -> bool:
+        return self.code in RATE_LIMIT_CODES
+
+
+class SparkStream(object):
+    """
+    一次问答的流式结果，迭代得到增量文本；迭代结束后content为完整回复，usage为token用量
+    迭代过程中取消令牌被取消时关闭连接并抛出RequestCancelled
+    """
+
+    def __init__(self, client, messages, cancel_token=None, temperature=0.5):
+        self.client = client
+        self.messages = messages
+        self.cancel_token = cancel_token
+        self.temperature = temperature
+        self.content = ""
+        self.usage = {}
+
+    def __iter__(self):
+        cancel_token = self.cancel_token
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        ws, spare = self.client._get_connection()
+        # 取消时中断连接，阻塞在recv上的线程立即返回
+        abort = lambda: ws.abort()
+        if cancel_token is not None:
+            cancel_token.add_callback(abort)
+        try:
+            try:
+                message = self._send(ws)
+            except (websocket.WebSocketException, OSError) as e:
+                if not spare or (cancel_token is not None and cancel_token.cancelled):
+                    raise
+                # 空闲连接已被服务端断开，换新连接重发
+                logger.debug("[XunFei] spare connection is closed, reconnect: {}".format(e))
+                ws.close()
+                ws = self.client._connect()
+                message = self._send(ws)
+            while True:
+                data = json.loads(message)
+                code = data["header"]["code"]
+                if code != 0:
+                    raise SparkError(code, data["header"].get("message"))
+                choices = data["payload"]["choices"]
+                content = choices["text"][0]["content"]
+                self.content += content
+                if content:
+                    yield content
+                if choices["status"] == 2:
+                    self.usage = (data["payload"].get("usage") or {}).get("text") or {}
+                    return
+                message = self._recv(ws)
+        except (websocket.WebSocketException, OSError):
+            if cancel_token is not None and cancel_token.cancelled:
+                raise RequestCancelled("request cancelled")
+            raise
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(abort)
+            ws.close()
+
+    def _send(self, ws):
+        ws.send(json.dumps(self.client.gen_params(self.messages, self.temperature)))
+        return self._recv(ws)
+
+    @staticmethod
+    def _recv(ws):
+        message = ws.recv()
+        if not message:
+            raise websocket.WebSocketConnectionClosedException("connection closed before the reply finished")
+        return message
+
+
+class SparkClient(object):
+    def __init__(self, app_id, api_key, api_secret, spark_url, domain, spare_connections=0, timeout=60):
+        self.app_id = app_id
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.spark_url = spark_url
+        self.domain = domain
+        self.host = urlparse(spark_url).netloc
+        self.path = urlparse(spark_url).path
+        self.spare_connections = spare_connections
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.spares = []  # [(ws, opened_at)]
+        self.refilling = 0
+
+    def chat(self, messages, cancel_token=None, temperature=0.5) -> SparkStream:
+        return SparkStream(self, messages, cancel_token, temperature)
+
+    def _connect(self):
+        return websocket.create_connection(self.create_url(), timeout=self.timeout, sslopt={"cert_reqs": ssl.CERT_NONE})
+
+    def _get_connection(self):
+        """优先取用预先建立的空闲连接，返回(连接, 是否为空闲连接)"""
+        ws = None
+        now = time.monotonic()
+        with self.lock:
+            while self.spares and ws is None:
+                spare, opened_at = self.spares.pop()
+                if now - opened_at < SPARE_MAX_AGE and spare.connected:
+                    ws = spare
+                else:
+                    spare.close()
+        self._refill()
+        if ws is not None:
+            return ws, True
+        return self._connect(), False
+
+    def _refill(self):
+        with self.lock:
+            missing = self.spare_connections - len(self.spares) - self.refilling
+            self.refilling += max(0, missing)
+        for _ in range(missing):
+            _prewarm_executor.submit(self._open_spare)
+
+    def _open_spare(self):
+        try:
+            ws = self._connect()
+        except Exception as e:
+            logger.warning("[XunFei] open spare connection failed: {}".format(e))
+            ws = None
+        with self.lock:
+            self.refilling -= 1
+            if ws is not None:
+                self.spares.append((ws, time.monotonic()))
+
+    # 生成url
+    def create_url(self):
+        # 生成RFC1123格式的时间戳
+        now = datetime.now()
+        date = format_date_time(mktime(now.timetuple()))
+
+        # 拼接字符串
+        signature_origin = "host: " + self.host + "\n"
+        signature_origin += "date: " + date + "\n"
+        signature_origin += "GET " + self.path + " HTTP/1.1"
+
+        # 进行hmac-sha256进行加密
+        signature_sha = hmac.new(self.api_secret.encode('utf-8'),
+                                 signature_origin.encode('utf-8'),
+                                 digestmod=hashlib.sha256).digest()
+
+        signature_sha_base64 = base64.b64encode(signature_sha).decode(
+            encoding='utf-8')
+
+        authorization_origin = f'api_key="{self.api_key}", algorithm="hmac-sha256", headers="host date request-line", ' \
+                               f'signature="{signature_sha_base64}"'
+
+        authorization = base64.b64encode(
+            authorization_origin.encode('utf-8')).decode(encoding='utf-8')
+
+        # 将请求的鉴权参数组合为字典
+        v = {"authorization": authorization, "date": date, "host": self.host}
+        # 拼接鉴权参数，生成url
+        return self.spark_url + '?' + urlencode(v)
+
+    def gen_params(self, messages, temperature=0.5):
+        """
+        通过appid和用户的提问来生成请参数
+        """
+        return {
+            "header": {
+                "app_id": self.app_id,
+                "uid": "1234"
+            },
+            "parameter": {
+                "chat": {
+                    "domain": self.domain,
+                    "temperature": temperature,
+                    "random_threshold": 0.5,
+                    "max_tokens": 2048,
+                    "auditing": "default"
+                }
+            },
+            "payload": {
+                "message": {
+                    "text": messages
+                }
+            }
+        }
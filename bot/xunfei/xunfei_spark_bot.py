@@ -1,37 +1,20 @@
 # encoding:utf-8
 
-import requests, json
+import time
+
+import websocket
+
 from bot.bot import Bot
-from bot.session_manager import SessionManager
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.session_manager import SessionManager
+from bot.xunfei.xunfei_client import SparkClient, SparkError
 from bridge.context import ContextType, Context
 from bridge.reply import Reply, ReplyType
+from common import const, metering
+from common.cancel_token import RequestCancelled
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy
 from config import conf
-from common import const
-import time
-import _thread as thread
-import datetime
-from datetime import datetime
-from wsgiref.handlers import format_date_time
-from urllib.parse import urlencode
-import base64
-import ssl
-import hashlib
-import hmac
-import json
-from time import mktime
-from urllib.parse import urlparse
-import websocket
-import queue
-import threading
-import random
-
-# 消息队列 map
-queue_map = dict()
-
-# 响应队列 map
-reply_map = dict()
 
 
 class XunFeiBot(Bot):
@@ -50,8 +33,9 @@ class XunFeiBot(Bot):
         # 后续模型更新，对应的参数可以参考官网文档获取：https://www.xfyun.cn/doc/spark/Web.html
         self.domain = conf().get("xunfei_domain", "generalv3.5")
         self.spark_url = conf().get("xunfei_spark_url", "wss://spark-api.xf-yun.com/v3.5/chat")
-        self.host = urlparse(self.spark_url).netloc
-        self.path = urlparse(self.spark_url).path
+        self.client = SparkClient(self.app_id, self.api_key, self.api_secret, self.spark_url, self.domain,
+                                  spare_connections=conf().get("xunfei_spare_connections", 1),
+                                  timeout=conf().get("request_timeout", 180))
         # 和wenxin使用相同的session机制
         self.sessions = SessionManager(ChatGPTSession, model=const.XUNFEI)
 
@@ -59,211 +43,47 @@ class XunFeiBot(Bot):
         if context.type == ContextType.TEXT:
             logger.info("[XunFei] query={}".format(query))
             session_id = context["session_id"]
-            request_id = self.gen_request_id(session_id)
-            reply_map[request_id] = ""
             session = self.sessions.session_query(query, session_id)
-            threading.Thread(target=self.create_web_socket,
-                             args=(session.messages, request_id)).start()
-            depth = 0
-            time.sleep(0.1)
-            t1 = time.time()
-            usage = {}
-            while depth <= 300:
-                try:
-                    data_queue = queue_map.get(request_id)
-                    if not data_queue:
-                        depth += 1
-                        time.sleep(0.1)
-                        continue
-                    data_item = data_queue.get(block=True, timeout=0.1)
-                    if data_item.is_end:
-                        # 请求结束
-                        del queue_map[request_id]
-                        if data_item.reply:
-                            reply_map[request_id] += data_item.reply
-                        usage = data_item.usage
-                        break
-
-                    reply_map[request_id] += data_item.reply
-                    depth += 1
-                except Exception as e:
-                    depth += 1
-                    continue
-            t2 = time.time()
-            logger.info(
-                f"[XunFei-API] response={reply_map[request_id]}, time={t2 - t1}s, usage={usage}"
-            )
-            self.sessions.session_reply(reply_map[request_id], session_id,
-                                        usage.get("total_tokens"))
-            reply = Reply(ReplyType.TEXT, reply_map[request_id])
-            del reply_map[request_id]
-            return reply
+            return self.reply_text(session, context)
         else:
             reply = Reply(ReplyType.ERROR,
                           "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def create_web_socket(self, prompt, session_id, temperature=0.5):
-        logger.info(f"[XunFei] start connect, prompt={prompt}")
-        websocket.enableTrace(False)
-        wsUrl = self.create_url()
-        ws = websocket.WebSocketApp(wsUrl,
-                                    on_message=on_message,
-                                    on_error=on_error,
-                                    on_close=on_close,
-                                    on_open=on_open)
-        data_queue = queue.Queue(1000)
-        queue_map[session_id] = data_queue
-        ws.appid = self.app_id
-        ws.question = prompt
-        ws.domain = self.domain
-        ws.session_id = session_id
-        ws.temperature = temperature
-        ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
-
-    def gen_request_id(self, session_id: str):
-        return session_id + "_" + str(int(time.time())) + "" + str(
-            random.randint(0, 100))
-
-    # 生成url
-    def create_url(self):
-        # 生成RFC1123格式的时间戳
-        now = datetime.now()
-        date = format_date_time(mktime(now.timetuple()))
-
-        # 拼接字符串
-        signature_origin = "host: " + self.host + "\n"
-        signature_origin += "date: " + date + "\n"
-        signature_origin += "GET " + self.path + " HTTP/1.1"
-
-        # 进行hmac-sha256进行加密
-        signature_sha = hmac.new(self.api_secret.encode('utf-8'),
-                                 signature_origin.encode('utf-8'),
-                                 digestmod=hashlib.sha256).digest()
-
-        signature_sha_base64 = base64.b64encode(signature_sha).decode(
-            encoding='utf-8')
-
-        authorization_origin = f'api_key="{self.api_key}", algorithm="hmac-sha256", headers="host date request-line", ' \
-                               f'signature="{signature_sha_base64}"'
-
-        authorization = base64.b64encode(
-            authorization_origin.encode('utf-8')).decode(encoding='utf-8')
-
-        # 将请求的鉴权参数组合为字典
-        v = {"authorization": authorization, "date": date, "host": self.host}
-        # 拼接鉴权参数，生成url
-        url = self.spark_url + '?' + urlencode(v)
-        # 此处打印出建立连接时候的url,参考本demo的时候可取消上方打印的注释，比对相同参数时生成的url与自己代码生成的url是否一致
-        return url
-
-    def gen_params(self, appid, domain, question):
+    def reply_text(self, session: ChatGPTSession, context: Context, retry_count=0, deadline=None) -> Reply:
         """
-        通过appid和用户的提问来生成请参数
+        在当前线程中流式接收星火的回复，收完后返回完整回复；重试用完后仍失败时返回已收到的部分
         """
-        data = {
-            "header": {
-                "app_id": appid,
-                "uid": "1234"
-            },
-            "parameter": {
-                "chat": {
-                    "domain": domain,
-                    "random_threshold": 0.5,
-                    "max_tokens": 2048,
-                    "auditing": "default"
-                }
-            },
-            "payload": {
-                "message": {
-                    "text": question
-                }
-            }
-        }
-        return data
-
-
-class ReplyItem:
-    def __init__(self, reply, usage=None, is_end=False):
-        self.is_end = is_end
-        self.reply = reply
-        self.usage = usage
-
-
-# 收到websocket错误的处理
-def on_error(ws, error):
-    logger.error(f"[XunFei] error: {str(error)}")
-
-
-# 收到websocket关闭的处理
-def on_close(ws, one, two):
-    data_queue = queue_map.get(ws.session_id)
-    data_queue.put("END")
-
-
-# 收到websocket连接建立的处理
-def on_open(ws):
-    logger.info(f"[XunFei] Start websocket, session_id={ws.session_id}")
-    thread.start_new_thread(run, (ws, ))
-
-
-def run(ws, *args):
-    data = json.dumps(
-        gen_params(appid=ws.appid,
-                   domain=ws.domain,
-                   question=ws.question,
-                   temperature=ws.temperature))
-    ws.send(data)
-
-
-# Websocket 操作
-# 收到websocket消息的处理
-def on_message(ws, message):
-    data = json.loads(message)
-    code = data['header']['code']
-    if code != 0:
-        logger.error(f'请求错误: {code}, {data}')
-        ws.close()
-    else:
-        choices = data["payload"]["choices"]
-        status = choices["status"]
-        content = choices["text"][0]["content"]
-        data_queue = queue_map.get(ws.session_id)
-        if not data_queue:
-            logger.error(
-                f"[XunFei] can't find data queue, session_id={ws.session_id}")
-            return
-        reply_item = ReplyItem(content)
-        if status == 2:
-            usage = data["payload"].get("usage")
-            reply_item = ReplyItem(content, usage)
-            reply_item.is_end = True
-            ws.close()
-        data_queue.put(reply_item)
-
-
-def gen_params(appid, domain, question, temperature=0.5):
-    """
-    通过appid和用户的提问来生成请参数
-    """
-    data = {
-        "header": {
-            "app_id": appid,
-            "uid": "1234"
-        },
-        "parameter": {
-            "chat": {
-                "domain": domain,
-                "temperature": temperature,
-                "random_threshold": 0.5,
-                "max_tokens": 2048,
-                "auditing": "default"
-            }
-        },
-        "payload": {
-            "message": {
-                "text": question
-            }
-        }
-    }
-    return data
+        policy = get_retry_policy("xunfei")
+        deadline = deadline or policy.deadline()
+        cancel_token = context.get("cancel_token")
+        stream = self.client.chat(session.messages, cancel_token)
+        t1 = time.time()
+        try:
+            with policy.attempt() as attempt:
+                try:
+                    for _ in stream:
+                        pass
+                except (websocket.WebSocketException, OSError):
+                    attempt.fail()
+                    raise
+        except RequestCancelled:
+            logger.info("[XunFei] request cancelled, session_id={}".format(session.session_id))
+            return Reply(ReplyType.INFO, "请求已取消")
+        except CircuitOpenError as e:
+            logger.warn("[XunFei] {}".format(e))
+            return Reply(ReplyType.ERROR, "服务暂时不可用，请稍后再试")
+        except Exception as e:
+            logger.error("[XunFei] request failed: {}".format(e))
+            rate_limited = isinstance(e, SparkError) and e.rate_limited
+            transient = rate_limited or isinstance(e, (websocket.WebSocketException, OSError))
+            if transient and policy.wait_retry(retry_count, cancel_token, deadline, rate_limited=rate_limited):
+                logger.warn("[XunFei] do retry, times={}".format(retry_count))
+                return self.reply_text(session, context, retry_count + 1, deadline)
+            if stream.content:
+                return Reply(ReplyType.TEXT, stream.content)
+            return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+        logger.info(f"[XunFei-API] response={stream.content}, time={time.time() - t1}s, usage={stream.usage}")
+        metering.report_usage(context, self.client.domain, stream.usage.get("total_tokens"), stream.usage.get("completion_tokens"))
+        self.sessions.session_reply(stream.content, session.session_id, stream.usage.get("total_tokens"))
+        return Reply(ReplyType.TEXT, stream.content)
@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from common import token_estimator
 from common.log import logger
 
 
@@ -47,7 +48,5 @@ class ZhipuAISession(Session):
 
 
 def num_tokens_from_messages(messages, model):
-    tokens = 0
-    for msg in messages:
-        tokens += len(msg["content"])
-    return tokens
+    """Returns the number of tokens used by a list of messages."""
+    return token_estimator.num_tokens_from_messages(messages, model)
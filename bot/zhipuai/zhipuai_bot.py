@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -10,7 +8,9 @@ from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import metering
 from common.log import logger
+from common.retry_policy import CircuitOpenError, get_retry_policy, retry_after_seconds
 from config import conf, load_config
 from zhipuai import ZhipuAI
 
@@ -59,7 +59,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
+            reply_content = self.reply_text(session, api_key, args=new_args, cancel_token=context.get("cancel_token"))
             logger.debug(
                 "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -71,6 +71,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                metering.report_usage(context, (new_args or self.args)["model"], reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -90,14 +91,18 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0, cancel_token=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param cancel_token: cancel token of the context, checked during retry waits
+        :param deadline: monotonic time after which no more retries are made
         :return: {}
         """
+        policy = get_retry_policy("zhipu")
+        deadline = deadline or policy.deadline()
         try:
             # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
             #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
@@ -105,7 +110,8 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             if args is None:
                 args = self.args
             # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            response = self.client.chat.completions.create(messages=session.messages, **args)
+            with policy.attempt():
+                response = self.client.chat.completions.create(messages=session.messages, **args)
             # logger.debug("[ZHIPU_AI] response={}".format(response))
             # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
 
@@ -115,35 +121,34 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 "content": response.choices[0].message.content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            need_retry = policy.is_transient(e)
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            if isinstance(e, CircuitOpenError):
+                logger.warn("[ZHIPU_AI] {}".format(e))
+                result["content"] = "服务暂时不可用，请稍后再试"
+            elif isinstance(e, openai.error.RateLimitError) or policy.is_rate_limited(e):
                 logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+            elif need_retry:
+                # zhipuai sdk的超时、连接失败和5xx错误
+                logger.warn("[ZHIPU_AI] {}: {}".format(type(e).__name__, e))
+                result["content"] = "请再问我一次"
             else:
                 logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
+            if need_retry and policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(e), policy.is_rate_limited(e)):
                 logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                return self.reply_text(session, api_key, args, retry_count + 1, cancel_token=cancel_token, deadline=deadline)
             else:
                 return result
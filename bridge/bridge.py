@@ -1,13 +1,28 @@
+import threading
+import time
+
 from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
-from common import const
+from bot.bot_router import BotRouter
+from bot.session_manager import SessionManager
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common import const, memory, metering
+from common.cancel_token import is_cancelled
 from common.log import logger
+from common.single_flight import SingleFlight
 from common.singleton import singleton
+from common.warmup import warm_up
 from config import conf
 from translate.factory import create_translator
 from voice.factory import create_voice
 
+# 合并并发的相同提问，reset_bot时不重建，保证计数持续累计
+reply_flight = SingleFlight()
+
+# 按bot类型加锁，并发的首次请求只创建一个bot；reset_bot时不重建
+_create_locks = {typename: threading.Lock() for typename in ("chat", "voice_to_text", "text_to_voice", "translate")}
+_chat_bots_lock = threading.Lock()
+
 
 @singleton
 class Bridge(object):
@@ -64,23 +79,96 @@ class Bridge(object):
 
     # 模型对应的接口
     def get_bot(self, typename):
-        if self.bots.get(typename) is None:
-            logger.info("create bot {} for {}".format(self.btype[typename], typename))
-            if typename == "text_to_voice":
-                self.bots[typename] = create_voice(self.btype[typename])
-            elif typename == "voice_to_text":
-                self.bots[typename] = create_voice(self.btype[typename])
-            elif typename == "chat":
-                self.bots[typename] = create_bot(self.btype[typename])
-            elif typename == "translate":
-                self.bots[typename] = create_translator(self.btype[typename])
-        return self.bots[typename]
+        # reset_bot会替换self.bots，创建期间被重置时新建的bot只放入旧的字典
+        bots = self.bots
+        if bots.get(typename) is None:
+            with _create_locks[typename]:
+                if bots.get(typename) is None:
+                    bots[typename] = self._create_bot(typename)
+        return bots[typename]
+
+    def _create_bot(self, typename):
+        logger.info("create bot {} for {}".format(self.btype[typename], typename))
+        if typename == "text_to_voice":
+            return create_voice(self.btype[typename])
+        elif typename == "voice_to_text":
+            return create_voice(self.btype[typename])
+        elif typename == "chat":
+            if conf().get("bot_failover"):
+                return BotRouter(self.btype[typename], conf().get("bot_failover"))
+            return create_bot(self.btype[typename])
+        elif typename == "translate":
+            return create_translator(self.btype[typename])
 
     def get_bot_type(self, typename):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        start = time.monotonic()
+        reply = None
+        try:
+            if conf().get("single_flight_reply") and self._can_share_reply(query, context):
+                reply = self._fetch_shared_reply(query, context)
+            else:
+                reply = self.get_bot("chat").reply(query, context)
+            return reply
+        finally:
+            metering.record_request(context, time.monotonic() - start, reply is None or reply.type == ReplyType.ERROR)
+
+    def _can_share_reply(self, query, context: Context) -> bool:
+        """
+        只有不依赖个人上下文的文本提问才能共享回复：非管理命令、无待识别图片、会话中没有历史消息
+        """
+        if context is None or context.type != ContextType.TEXT or not query or query.startswith("#"):
+            return False
+        session_id = context.get("session_id")
+        if memory.USER_IMAGE_CACHE.get(session_id):
+            return False
+        sessions = getattr(self.get_bot("chat"), "sessions", None)
+        if not isinstance(sessions, SessionManager):
+            return False
+        session = sessions.sessions.get(session_id)
+        return session is None or all(msg["role"] == "system" for msg in session.messages)
+
+    def _fetch_shared_reply(self, query, context: Context) -> Reply:
+        bot = self.get_bot("chat")
+        session_id = context["session_id"]
+        session = bot.sessions.sessions.get(session_id)
+        system_prompt = session.system_prompt if session else conf().get("character_desc", "")
+        key = (
+            self.btype["chat"],
+            context.get("gpt_model") or conf().get("model"),
+            system_prompt,
+            context.get("openai_api_key"),
+            context.get("app_code"),
+            context["msg"].other_user_id if context.get("isgroup") and context.get("msg") else None,
+            query,
+        )
+        while True:
+            (reply, leader_cancelled), shared = reply_flight.do(key, self._shared_reply, bot, query, context)
+            # 发起请求的会话被重置时请求随之取消，等待者不能拿取消的结果，重新发起或等待新的在途请求
+            if not shared or not leader_cancelled or is_cancelled(context.get("cancel_token")):
+                break
+            logger.info("[Bridge] shared reply cancelled by its session, retry, session_id={}".format(session_id))
+        if shared:
+            logger.info("[Bridge] share in-flight reply, session_id={}, stats={}".format(session_id, reply_flight.stats()))
+            # 共享者没有经过bot，需要补记自己的会话历史
+            if reply and reply.type == ReplyType.TEXT:
+                bot.sessions.session_query(query, session_id)
+                bot.sessions.session_reply(reply.content, session_id)
+        if reply is None:
+            return reply
+        # 回复会在装饰阶段被修改，每个等待者都拿一份拷贝
+        return Reply(reply.type, reply.content)
+
+    @staticmethod
+    def _shared_reply(bot, query, context: Context):
+        """:return: (reply, 发起者的请求是否已被取消)"""
+        reply = bot.reply(query, context)
+        return reply, is_cancelled(context.get("cancel_token"))
+
+    def get_reply_flight_stats(self) -> dict:
+        return reply_flight.stats()
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
@@ -93,11 +181,15 @@ class Bridge(object):
 
     def find_chat_bot(self, bot_type: str):
         if self.chat_bots.get(bot_type) is None:
-            self.chat_bots[bot_type] = create_bot(bot_type)
+            with _chat_bots_lock:
+                if self.chat_bots.get(bot_type) is None:
+                    self.chat_bots[bot_type] = create_bot(bot_type)
         return self.chat_bots.get(bot_type)
 
     def reset_bot(self):
         """
-        重置bot路由
+        重置bot路由，切换模型后在后台预热新的bot
         """
         self.__init__()
+        if conf().get("warmup", True):
+            threading.Thread(target=warm_up, args=(self,), daemon=True, name="warmup").start()
@@ -0,0 +1,101 @@
+"""
+取消在途请求的测试：本地起一个在返回响应头前长时间等待的服务(模拟非流式的对话接口在生成结束后才返回)，
+请求发出后取消令牌，检查cancellable_post立即抛出RequestCancelled，而不是等到服务返回；
+连接池中的其他连接不受影响，之后的请求仍然正常
+
+用法:
+    python cancel_token_test.py [--delay 10]
+"""
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.cancel_token import CancelToken, RequestCancelled, cancellable_post, cancellable_session
+
+CANCEL_AFTER = 0.5
+MAX_RETURN_DELAY = 1.5  # 取消后应在这个时间内返回
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    delay = 10
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path == "/slow":
+            time.sleep(self.delay)
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def cancel_slow_request(url, session=None) -> float:
+    """返回从取消到请求返回的耗时"""
+    cancel_token = CancelToken()
+    cancelled_at = []
+
+    def cancel():
+        cancelled_at.append(time.monotonic())
+        cancel_token.cancel()
+
+    timer = threading.Timer(CANCEL_AFTER, cancel)
+    timer.start()
+    try:
+        cancellable_post(url + "/slow", cancel_token=cancel_token, session=session, json={"q": "hi"}, timeout=60)
+    except RequestCancelled:
+        return time.monotonic() - cancelled_at[0]
+    finally:
+        timer.cancel()
+    raise AssertionError("request was not cancelled")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=10, help="seconds the server waits before sending headers")
+    args = parser.parse_args()
+
+    SlowHandler.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    # 每次新建连接
+    cost = cancel_slow_request(url)
+    print("cancel without session: returned {:.2f}s after cancel".format(cost))
+    assert cost < MAX_RETURN_DELAY, "request returned {:.2f}s after cancel".format(cost)
+
+    # 连接池中复用的连接
+    session = cancellable_session(pool_maxsize=2)
+    response = cancellable_post(url + "/fast", cancel_token=CancelToken(), session=session, json={})
+    assert response.json() == {"ok": True}
+    cost = cancel_slow_request(url, session)
+    print("cancel with pooled session: returned {:.2f}s after cancel".format(cost))
+    assert cost < MAX_RETURN_DELAY, "request returned {:.2f}s after cancel".format(cost)
+
+    # 已取消的令牌不再发出请求
+    cancel_token = CancelToken()
+    cancel_token.cancel()
+    try:
+        cancellable_post(url + "/fast", cancel_token=cancel_token, session=session, json={})
+        raise AssertionError("cancelled token sent a request")
+    except RequestCancelled:
+        pass
+
+    # 被中断的连接不放回连接池，之后的请求和没有令牌的请求正常完成
+    response = cancellable_post(url + "/fast", cancel_token=CancelToken(), session=session, json={})
+    assert response.json() == {"ok": True}
+    response = cancellable_post(url + "/fast", session=session, json={})
+    assert response.json() == {"ok": True}
+    server.shutdown()
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
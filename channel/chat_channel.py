@@ -1,14 +1,25 @@
+import math
 import os
+import random
 import re
 import threading
 import time
 from asyncio import CancelledError
+from collections import Counter, deque
+from queue import Empty
 from concurrent.futures import Future, ThreadPoolExecutor
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from common.cancel_token import CancelToken
+from common.compute_pool import compute_pool
+from common.delay_queue import DelayQueue
 from common.dequeue import Dequeue
+from common.expired_dict import ExpiredDict
+from common.sequencer import Sequencer
+from common.sliding_window import SlidingWindowLimiter
+from common.worker_pool import WorkerPool
 from common import memory
 from plugins import *
 
@@ -17,7 +28,52 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+# 按负载类型隔离的处理消息线程池，避免慢任务(语音转码、画图、插件长任务)占满线程影响普通对话
+WORKLOAD_TEXT = "text"  # 文本对话
+WORKLOAD_MEDIA = "media"  # 语音、图片、视频等媒体消息
+WORKLOAD_IMAGE = "image"  # 图片生成
+WORKLOAD_PLUGIN = "plugin"  # 插件指令、文件和分享总结等长任务
+default_pool_sizes = {WORKLOAD_TEXT: 8, WORKLOAD_MEDIA: 2, WORKLOAD_IMAGE: 2, WORKLOAD_PLUGIN: 2}
+worker_pools = {}  # workload -> WorkerPool，首次使用时按配置创建
+worker_pools_lock = threading.Lock()
+worker_initializer = None
+
+
+def get_worker_pool(workload) -> WorkerPool:
+    pool = worker_pools.get(workload)
+    if pool is None:
+        with worker_pools_lock:
+            pool = worker_pools.get(workload)
+            if pool is None:
+                size = (conf().get("worker_pool_sizes") or {}).get(workload) or default_pool_sizes.get(workload, 2)
+                pool = WorkerPool(workload, size, initializer=worker_initializer)
+                worker_pools[workload] = pool
+    return pool
+
+
+def set_worker_initializer(initializer):
+    """设置处理线程的初始化函数(如绑定asyncio事件循环)，对已创建的线程池同样生效"""
+    global worker_initializer
+    with worker_pools_lock:
+        worker_initializer = initializer
+        for pool in worker_pools.values():
+            pool._initializer = initializer
+
+
+def get_worker_pool_stats() -> dict:
+    with worker_pools_lock:
+        return {workload: pool.stats() for workload, pool in worker_pools.items()}
+
+
+# 会话调度的优先级类别，按权重做加权公平调度(差额轮询)，权重越大分到的处理机会越多
+PRIORITY_ADMIN = "admin"  # #开头的管理命令
+PRIORITY_VIP = "vip"  # user_datas中标记了vip的用户
+PRIORITY_PRIVATE = "private"  # 私聊
+PRIORITY_GROUP = "group"  # 群聊
+PRIORITY_PRIORITY_GROUP = "priority_group"  # priority_group_list中的群
+default_schedule_weights = {PRIORITY_ADMIN: 8, PRIORITY_VIP: 4, PRIORITY_PRIVATE: 2, PRIORITY_PRIORITY_GROUP: 2, PRIORITY_GROUP: 1}
+
+send_retry_queue = DelayQueue(ThreadPoolExecutor(max_workers=2))  # 发送失败的消息在这里延时重试，不占用处理消息的线程
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
@@ -26,7 +82,20 @@ class ChatChannel(Channel):
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
+    pending_contexts = {}  # 合并窗口内暂存的文本消息, session_id -> [context, 首条时间, 末条时间]
+    cancel_tokens = {}  # 记录每个session_id已提交线程池的context的取消令牌，用于重置会话时中止正在执行的任务
+    queued_total = 0  # 所有会话队列中排队的消息总数
+    shed_counts = {"drop_oldest": 0, "drop_newest": 0, "reply_busy": 0, "stale": 0, "flood": 0}  # 过载时丢弃的消息数，按原因统计
+    flood_limiter = None  # 按群、群成员、私聊用户的滑动窗口限流器，首次使用时按配置创建
+    flood_notified = {}  # 已回复过限流提示的key -> 冷却结束时间，冷却期内不重复提示
+    busy_replied = ExpiredDict(60)  # 最近回复过繁忙提示的会话，避免刷屏
+    deficits = {}  # 差额轮询中每个session_id剩余的发送额度
+    schedule_round = 0  # 调度轮次，用于轮换同权重会话的先后顺序
+    dispatch_event = threading.Event()  # 有新消息入队或任务完成时唤醒消费线程
+    reply_sequencers = {}  # session_id -> Sequencer，同一会话并发处理时按消息顺序发送回复
+    retrying_replies = {}  # 发送失败等待重试的回复, receiver -> deque([reply, context, 已尝试次数])，同一接收者按顺序发送
     lock = threading.Lock()  # 用于控制对sessions的访问
+    retry_lock = threading.Lock()  # 用于控制对retrying_replies的访问
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
@@ -160,14 +229,62 @@ class ChatChannel(Channel):
         elif context.type == ContextType.VOICE:
             if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
+        if first_in and not self._check_flood(context):
+            return None
         return context
 
+    def _check_flood(self, context: Context) -> bool:
+        """按群、群成员、私聊用户做滑动窗口限流，返回False表示消息应被丢弃"""
+        window = conf().get("flood_control_window", 60)
+        cmsg = context["msg"]
+        if context.get("isgroup", False):
+            group_limits = conf().get("flood_limit_group") or {}
+            limits = dict(group_limits.get("default") or {})
+            limits.update(group_limits.get(cmsg.other_user_nickname) or {})  # 按群名单独配置的限制覆盖默认值
+            keys = {
+                ("group", cmsg.other_user_id): limits.get("group", 0),
+                ("group_user", cmsg.other_user_id, cmsg.actual_user_id): limits.get("user", 0),
+            }
+        else:
+            keys = {("private", cmsg.other_user_id): conf().get("flood_limit_private", 0)}
+        if not any(keys.values()):
+            return True
+        limiter = self.flood_limiter
+        if limiter is None or limiter.window_seconds != window:
+            limiter = ChatChannel.flood_limiter = SlidingWindowLimiter(window)
+        limited_key = limiter.acquire(keys)
+        if limited_key is None:
+            return True
+        with self.lock:
+            self._record_shed("flood", context)
+        logger.warning("[chat_channel] flood control triggered, key={}, limit={}/{}s".format(limited_key, keys[limited_key], window))
+        self._reply_cooldown(limited_key, window, context)
+        return False
+
+    def _reply_cooldown(self, limited_key, window, context: Context):
+        text = conf().get("flood_cooldown_reply", "")
+        if not text:
+            return
+        now = time.time()
+        with self.lock:
+            if self.flood_notified.get(limited_key, 0) > now:
+                return
+            for key in [k for k, until in self.flood_notified.items() if until <= now]:
+                del self.flood_notified[key]
+            self.flood_notified[limited_key] = now + window
+        if limited_key[0] == "group_user":
+            text = "@" + context["msg"].actual_user_nickname + "\n" + text
+        send_retry_queue.schedule(0, self._send, Reply(ReplyType.TEXT, text), context)
+
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
         logger.debug("[chat_channel] ready to handle context: {}".format(context))
         # reply的构建步骤
         reply = self._generate_reply(context)
+        if self._is_cancelled(context):
+            logger.info("[chat_channel] context cancelled, drop reply, session_id={}".format(context.get("session_id")))
+            return
 
         logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
@@ -197,7 +314,7 @@ class ChatChannel(Channel):
                 file_path = context.content
                 wav_path = os.path.splitext(file_path)[0] + ".wav"
                 try:
-                    any_to_wav(file_path, wav_path)
+                    compute_pool().run(any_to_wav, file_path, wav_path)
                 except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
                     logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
                     wav_path = file_path
@@ -282,19 +399,104 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
-                self._send(reply, context)
+                self._send_in_order(reply, context)
+
+    def _send_in_order(self, reply: Reply, context: Context):
+        # 同一会话并发处理时，先收到的消息的回复先发送，队首超过reply_order_timeout未完成时不再等待它
+        # 编号所属的sequencer已被移除(会话处理完毕后异步任务才返回的回复)时，它之前的回复都已发送，直接发送
+        sequencer = context.get("reply_sequencer")
+        if sequencer is None or sequencer is not self.reply_sequencers.get(context["session_id"]):
+            self._send(reply, context)
+        elif not sequencer.emit(context["reply_seq"], (reply, context)):
+            logger.debug("[chat_channel] hold reply until earlier replies are sent, session_id={}, seq={}".format(context["session_id"], context["reply_seq"]))
+            send_retry_queue.schedule(conf().get("reply_order_timeout", 30), self._check_reply_order, context["session_id"])
+
+    def _check_reply_order(self, session_id):
+        sequencer = self.reply_sequencers.get(session_id)
+        if sequencer is None or not sequencer.has_pending():
+            return
+        timeout = conf().get("reply_order_timeout", 30)
+        if sequencer.skip_head(timeout):
+            logger.warning("[chat_channel] earliest reply timed out, send later replies first, session_id={}".format(session_id))
+        if sequencer.has_pending():
+            send_retry_queue.schedule(timeout, self._check_reply_order, session_id)
+
+    def _send(self, reply: Reply, context: Context):
+        if self._is_cancelled(context):
+            return
+        receiver = context.get("receiver")
+        with self.retry_lock:
+            if receiver in self.retrying_replies:  # 该接收者有待重试的消息，排在其后发送，保证顺序
+                self.retrying_replies[receiver].append([reply, context, 0])
+                return
+        if self._try_send(reply, context):
+            return
+        with self.retry_lock:
+            if receiver in self.retrying_replies:
+                self.retrying_replies[receiver].appendleft([reply, context, 1])
+                return
+            self.retrying_replies[receiver] = deque([[reply, context, 1]])
+        send_retry_queue.schedule(self._retry_delay(1), self._retry_send, receiver)
 
-    def _send(self, reply: Reply, context: Context, retry_cnt=0):
+    def _try_send(self, reply: Reply, context: Context) -> bool:
+        """发送一次，返回False表示需要重试"""
         try:
             self.send(reply, context)
+            return True
         except Exception as e:
             logger.error("[chat_channel] sendMsg error: {}".format(str(e)))
             if isinstance(e, NotImplementedError):
-                return
+                return True
             logger.exception(e)
-            if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+            return False
+
+    def _retry_send(self, receiver):
+        # 在重试线程中按顺序发送该接收者积压的回复，失败则重新延时
+        while True:
+            with self.retry_lock:
+                pending = self.retrying_replies.get(receiver)
+                if not pending:
+                    self.retrying_replies.pop(receiver, None)
+                    return
+                item = pending[0]
+            reply, context, attempts = item
+            if not self._is_cancelled(context):
+                if attempts > 0:
+                    logger.warn("[chat_channel] retry sending, attempt={}, receiver={}".format(attempts + 1, receiver))
+                if not self._try_send(reply, context):
+                    item[2] = attempts + 1
+                    if item[2] < conf().get("send_retry_max_attempts", 3):
+                        send_retry_queue.schedule(self._retry_delay(item[2]), self._retry_send, receiver)
+                        return
+                    # 死信，记录后丢弃
+                    logger.error("[chat_channel] send failed after {} attempts, drop reply: {}, receiver={}".format(item[2], reply, receiver))
+            with self.retry_lock:
+                pending.popleft()
+
+    def _retry_delay(self, attempts) -> float:
+        # 指数退避 + 随机抖动
+        base = conf().get("send_retry_base_delay", 3)
+        delay = min(base * 2 ** (attempts - 1), conf().get("send_retry_max_delay", 60))
+        jitter = conf().get("send_retry_jitter", 0.2)
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
+    def _classify_workload(self, context: Context) -> str:
+        # 插件可以在ON_RECEIVE_MESSAGE事件中设置context["workload"]指定线程池
+        if context.get("workload") in default_pool_sizes:
+            return context["workload"]
+        if context.type in [ContextType.VOICE, ContextType.IMAGE, ContextType.VIDEO]:
+            return WORKLOAD_MEDIA
+        if context.type == ContextType.IMAGE_CREATE:
+            return WORKLOAD_IMAGE
+        if context.type in [ContextType.FILE, ContextType.SHARING]:
+            return WORKLOAD_PLUGIN
+        if context.type == ContextType.TEXT and context.content.startswith(conf().get("plugin_trigger_prefix", "$")):
+            return WORKLOAD_PLUGIN
+        return WORKLOAD_TEXT
+
+    def _is_cancelled(self, context: Context) -> bool:
+        cancel_token = context.get("cancel_token")
+        return cancel_token is not None and cancel_token.cancelled
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
@@ -314,71 +516,332 @@ class ChatChannel(Channel):
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
+            if "reply_seq" in kwargs["context"]:
+                kwargs["context"]["reply_sequencer"].finish(kwargs["context"]["reply_seq"])
             with self.lock:
                 self.sessions[session_id][1].release()
+                cancel_token = kwargs["context"].get("cancel_token")
+                if session_id in self.cancel_tokens:
+                    self.cancel_tokens[session_id].discard(cancel_token)
+                    if not self.cancel_tokens[session_id]:
+                        del self.cancel_tokens[session_id]
+            self.dispatch_event.set()
 
         return func
 
     def produce(self, context: Context):
         session_id = context["session_id"]
+        if context.type == ContextType.TEXT and context.content in conf().get("clear_memory_commands", ["#清除记忆"]):
+            self.cancel_session(session_id)  # 清除记忆时中止该会话排队和正在处理的请求
         with self.lock:
-            if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
-                ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+            if self._can_merge(context):
+                pending = self.pending_contexts.get(session_id)
+                now = time.time()
+                if pending and self._same_sender(pending[0], context):
+                    # 合并窗口内同一发送者的连续文本
+                    pending[0].content = pending[0].content + "\n" + context.content
+                    pending[0]["merged_count"] = pending[0].get("merged_count", 1) + 1
+                    pending[2] = now
+                    return
+                if pending:
+                    self._enqueue(session_id, self.pending_contexts.pop(session_id)[0])
+                self.pending_contexts[session_id] = [context, now, now]  # [context, 首条时间, 末条时间]
+                return
+            if session_id in self.pending_contexts:  # 先放行暂存的文本，保证顺序
+                self._enqueue(session_id, self.pending_contexts.pop(session_id)[0])
+            self._enqueue(session_id, context)
+
+    def _enqueue(self, session_id, context: Context):
+        # 调用方需持有self.lock
+        if "cancel_token" not in context:
+            context["cancel_token"] = CancelToken()
+        if session_id not in self.sessions:
+            self.sessions[session_id] = [
+                Dequeue(),
+                threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+            ]
+        if "enqueue_time" not in context:
+            context["enqueue_time"] = time.time()
+        if "priority" not in context:
+            context["priority"] = self._priority_class(context)
+        if context.type == ContextType.TEXT and context.content.startswith("#"):
+            self.sessions[session_id][0].putleft(context)  # 优先处理管理命令，不参与过载丢弃
+        elif self._make_room(session_id, context):
+            self.sessions[session_id][0].put(context)
+        else:
+            return
+        self.queued_total += 1
+        self.dispatch_event.set()
+
+    def _priority_class(self, context: Context) -> str:
+        if context.type == ContextType.TEXT and context.content.startswith("#"):
+            return PRIORITY_ADMIN
+        cmsg = context.get("msg")
+        isgroup = context.get("isgroup", False)
+        user_id = getattr(cmsg, "actual_user_id" if isgroup else "from_user_id", None)
+        if conf().user_datas.get(user_id, {}).get("vip"):
+            return PRIORITY_VIP
+        if not isgroup:
+            return PRIORITY_PRIVATE
+        if getattr(cmsg, "other_user_nickname", None) in conf().get("priority_group_list", []):
+            return PRIORITY_PRIORITY_GROUP
+        return PRIORITY_GROUP
+
+    def _make_room(self, session_id, context: Context) -> bool:
+        """
+        检查会话队列和全局队列上限，超限时按queue_overflow_policy丢弃消息，返回False表示丢弃当前消息
+        调用方需持有self.lock
+        """
+        session_cap = conf().get("max_queue_per_session", 0)
+        global_cap = conf().get("max_queue_total", 0)
+        if session_cap and self.sessions[session_id][0].qsize() >= session_cap:
+            victim = session_id
+        elif global_cap and self.queued_total >= global_cap:
+            # 全局超限时优先从当前会话丢弃，当前会话没有积压时从积压最多的会话里丢弃
+            victim = session_id
+            if self.sessions[session_id][0].empty():
+                victim = max(self.sessions, key=lambda sid: len(self.sessions[sid][0].queue))  # 持有self.lock，直接读长度免去逐个加锁
+        else:
+            return True
+        policy = conf().get("queue_overflow_policy", "drop_oldest")
+        if policy == "drop_oldest" and self._drop_oldest(victim):
+            return True
+        if policy == "reply_busy":
+            self._record_shed("reply_busy", context)
+            self._reply_busy(context)
+        else:
+            self._record_shed("drop_newest", context)
+        return False
+
+    def _drop_oldest(self, session_id) -> bool:
+        # 丢弃会话队列中最早的一条非管理命令消息，调用方需持有self.lock
+        context_queue = self.sessions[session_id][0]
+        with context_queue.mutex:
+            for i, queued in enumerate(context_queue.queue):
+                if not (queued.type == ContextType.TEXT and queued.content.startswith("#")):
+                    del context_queue.queue[i]
+                    break
             else:
-                self.sessions[session_id][0].put(context)
+                return False
+        self.queued_total -= 1
+        self._record_shed("drop_oldest", queued)
+        return True
+
+    def _record_shed(self, reason, context: Context):
+        # 调用方需持有self.lock
+        self.shed_counts[reason] += 1
+        logger.debug("[chat_channel] shed context, reason={}, session_id={}, shed_counts={}".format(reason, context.get("session_id"), self.shed_counts))
+
+    def _reply_busy(self, context: Context):
+        session_id = context["session_id"]
+        if session_id in self.busy_replied:
+            return
+        self.busy_replied[session_id] = True
+        reply = Reply(ReplyType.TEXT, conf().get("queue_busy_reply", "当前消息太多，请稍后再试"))
+        send_retry_queue.schedule(0, self._send, reply, context)
+
+    def _next_context(self, session_id, context_queue: Dequeue):
+        """取出下一条待处理的消息，丢弃排队时间超过max_queue_age的消息"""
+        max_age = conf().get("max_queue_age", 0)
+        while True:
+            try:
+                context = context_queue.get_nowait()
+            except Empty:
+                return None
+            with self.lock:
+                if self.sessions.get(session_id, [None])[0] is context_queue:  # 队列可能已被重置会话替换
+                    self.queued_total -= 1
+                is_command = context.type == ContextType.TEXT and context.content.startswith("#")
+                if max_age and not is_command and time.time() - context.get("enqueue_time", time.time()) > max_age:
+                    self._record_shed("stale", context)
+                    continue
+            return context
+
+    def get_shed_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.shed_counts)
+            stats["queued_total"] = self.queued_total
+            return stats
+
+    def _can_merge(self, context: Context) -> bool:
+        if not conf().get("merge_msg_window", 0):
+            return False
+        if context.type != ContextType.TEXT or context.content.startswith("#"):
+            return False
+        return context.get("origin_ctype") != ContextType.VOICE
+
+    def _same_sender(self, a: Context, b: Context) -> bool:
+        return getattr(a.get("msg"), "actual_user_id", None) == getattr(b.get("msg"), "actual_user_id", None)
+
+    def _flush_pending(self):
+        """把超过合并窗口(或达到最长等待)的暂存文本放入会话队列"""
+        window = conf().get("merge_msg_window", 0)
+        max_wait = conf().get("merge_msg_max_wait", 5)
+        now = time.time()
+        with self.lock:
+            for session_id in list(self.pending_contexts.keys()):
+                context, first_time, last_time = self.pending_contexts[session_id]
+                if now - last_time >= window or now - first_time >= max_wait:
+                    del self.pending_contexts[session_id]
+                    if context.get("merged_count"):
+                        logger.debug("[chat_channel] merged {} messages in session {}".format(context["merged_count"], session_id))
+                    self._enqueue(session_id, context)
 
     # 消费者函数，单独线程，用于从消息队列中取出消息并处理
     def consume(self):
         while True:
+            self.dispatch_event.wait(0.2)
+            time.sleep(0.01)  # 合并短时间内的多次唤醒，避免高负载时频繁扫描所有会话
+            self.dispatch_event.clear()
+            if self.pending_contexts:
+                self._flush_pending()
+            flows = self._schedule_order()
+            # 差额轮询：每轮给会话增加与权重成比例的额度，额度满1才能发送一条消息，跳过没有会话额度足够的空轮次
+            while flows:
+                rounds = max(min(math.ceil((1 - self.deficits.get(sid, 0)) / weight) for sid, weight in flows), 1)
+                next_flows = []
+                for session_id, weight in flows:
+                    self.deficits[session_id] = self.deficits.get(session_id, 0) + rounds * weight
+                    status = "sent"
+                    while self.deficits[session_id] >= 1:
+                        status = self._dispatch(session_id)
+                        if status != "sent":
+                            break
+                        self.deficits[session_id] -= 1
+                    if status == "empty":
+                        self.deficits.pop(session_id, None)
+                    elif status == "sent":
+                        next_flows.append((session_id, weight))
+                    else:  # 会话并发已满或线程池已满，保留有限的额度等下次调度
+                        self.deficits[session_id] = min(self.deficits[session_id], max(weight, 1))
+                flows = next_flows
+
+    def _schedule_order(self) -> list:
+        """
+        返回本次调度的[(session_id, 权重)]，按权重从高到低排序，同权重的会话每次轮换先后顺序
+        同一个群里的多个会话共享该群的权重，避免一个活跃的群占满线程池；同时清理已处理完毕的会话
+        """
+        weights = dict(default_schedule_weights)
+        weights.update(conf().get("schedule_weights") or {})
+        with self.lock:
+            self.schedule_round += 1
+            sessions = list(self.sessions.items())
+        if sessions:
+            k = self.schedule_round % len(sessions)
+            sessions = sessions[k:] + sessions[:k]
+        heads = {}
+        finished = []
+        for session_id, (context_queue, semaphore) in sessions:
+            head = context_queue.peek()
+            if head is not None:
+                heads[session_id] = head
+            elif semaphore._initial_value == semaphore._value:  # 没有排队也没有处理中的任务，说明会话处理完毕
+                finished.append(session_id)
+        if finished:
             with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                    else:
-                        semaphore.release()
-            time.sleep(0.2)
-
-    # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
-    def cancel_session(self, session_id):
+                for session_id in finished:
+                    context_queue, semaphore = self.sessions.get(session_id, [None, None])
+                    if context_queue is None or not context_queue.empty() or semaphore._initial_value != semaphore._value:
+                        continue  # 检查之后又有了新消息
+                    self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+                    assert len(self.futures[session_id]) == 0, "thread pool error"
+                    del self.sessions[session_id]
+                    self.deficits.pop(session_id, None)
+                    self.reply_sequencers.pop(session_id, None)
+        flow_sizes = Counter(head.get("receiver") for head in heads.values())
+        flows = []
+        for session_id, head in heads.items():
+            weight = weights.get(head.get("priority"), 1)
+            if head.get("priority") != PRIORITY_ADMIN:
+                weight = weight / flow_sizes[head.get("receiver")]
+            flows.append((session_id, weight))
+        flows.sort(key=lambda flow: -flow[1])
+        return flows
+
+    def _dispatch(self, session_id) -> str:
+        """
+        把会话队首的消息提交到线程池
+        :return: sent(已提交), empty(队列为空), busy(会话并发已满), full(线程池没有空闲线程)
+        """
+        with self.lock:
+            if session_id not in self.sessions:
+                return "empty"
+            context_queue, semaphore = self.sessions[session_id]
+        head = context_queue.peek()
+        if head is None:
+            return "empty"
+        # 只在线程池有空闲时提交，积压留在会话队列里由调度决定先后；管理命令不受限制
+        if head.get("priority") != PRIORITY_ADMIN and not get_worker_pool(self._classify_workload(head)).has_capacity():
+            return "full"
+        if not semaphore.acquire(blocking=False):
+            return "busy"
+        context = self._next_context(session_id, context_queue)
+        if context is None:
+            semaphore.release()
+            return "empty"
+        logger.debug("[chat_channel] consume context: {}".format(context))
+        if semaphore._initial_value > 1 and context.get("priority") != PRIORITY_ADMIN and conf().get("reply_in_order", True):
+            # 按提交到线程池的顺序编号(即会话队列的顺序)，每个编号都会在任务结束的回调里完成
+            with self.lock:
+                sequencer = self.reply_sequencers.get(session_id)
+                if sequencer is None:
+                    sequencer = self.reply_sequencers[session_id] = Sequencer(lambda item: self._send(*item))
+            context["reply_sequencer"] = sequencer
+            context["reply_seq"] = sequencer.acquire()
+        pool = get_worker_pool(self._classify_workload(context))
+        future: Future = pool.submit(self._handle, context)
+        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+        with self.lock:
+            if session_id not in self.futures:
+                self.futures[session_id] = []
+            self.futures[session_id].append(future)
+            self.cancel_tokens.setdefault(session_id, set()).add(context["cancel_token"])
+        return "sent"
+
+    # 取消session_id对应的所有任务：丢弃排队的消息，取消未执行的future，并通知正在执行的任务中止
+    # exclude_context用于在处理中的指令(如#reset)里重置会话时，不取消指令自身
+    def cancel_session(self, session_id, exclude_context: Context = None):
+        futures = []
         with self.lock:
-            if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
-
-    def cancel_all_session(self):
+            cnt = self._cancel_session(session_id, futures, exclude_context)
+        self._cancel_futures(futures)
+        return cnt
+
+    def cancel_all_session(self, exclude_context: Context = None):
+        total = {"queued": 0, "running": 0}
+        futures = []
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            for session_id in set(self.sessions) | set(self.cancel_tokens) | set(self.pending_contexts):
+                cnt = self._cancel_session(session_id, futures, exclude_context)
+                total["queued"] += cnt["queued"]
+                total["running"] += cnt["running"]
+        self._cancel_futures(futures)
+        return total
+
+    def _cancel_session(self, session_id, futures: list, exclude_context: Context = None) -> dict:
+        # 调用方需持有self.lock；要取消的future放入futures，由调用方在释放锁后调用_cancel_futures
+        cnt = {"queued": 0, "running": 0}
+        if self.pending_contexts.pop(session_id, None):
+            cnt["queued"] += 1
+        if session_id in self.sessions:
+            futures.extend(self.futures.get(session_id, []))
+            cnt["queued"] += self.sessions[session_id][0].qsize()
+            self.queued_total -= self.sessions[session_id][0].qsize()
+            self.sessions[session_id][0] = Dequeue()
+        exclude_token = exclude_context.get("cancel_token") if exclude_context else None
+        for cancel_token in self.cancel_tokens.get(session_id, set()):
+            if cancel_token is not exclude_token and not cancel_token.cancelled:
+                cancel_token.cancel()
+                cnt["running"] += 1
+        if cnt["queued"] > 0 or cnt["running"] > 0:
+            logger.info("Cancel {} queued and {} running messages in session {}".format(cnt["queued"], cnt["running"], session_id))
+        return cnt
+
+    @staticmethod
+    def _cancel_futures(futures):
+        # 未开始的future取消时会在当前线程同步执行回调，回调需要获取self.lock，不能在持有锁时调用
+        for future in futures:
+            future.cancel()
 
 
 def check_prefix(content, prefix_list):
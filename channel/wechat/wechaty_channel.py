@@ -16,8 +16,9 @@ from wechaty_puppet import FileBox
 from bridge.context import *
 from bridge.context import Context
 from bridge.reply import *
-from channel.chat_channel import ChatChannel
+from channel.chat_channel import ChatChannel, set_worker_initializer
 from channel.wechat.wechaty_message import WechatyMessage
+from common.compute_pool import compute_pool
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -44,7 +45,7 @@ class WechatyChannel(ChatChannel):
     async def main(self):
         loop = asyncio.get_event_loop()
         # 将asyncio的loop传入处理线程
-        self.handler_pool._initializer = lambda: asyncio.set_event_loop(loop)
+        set_worker_initializer(lambda: asyncio.set_event_loop(loop))
         self.bot = Wechaty()
         self.bot.on("login", self.on_login)
         self.bot.on("message", self.on_message)
@@ -76,7 +77,7 @@ class WechatyChannel(ChatChannel):
             voiceLength = None
             file_path = reply.content
             sil_file = os.path.splitext(file_path)[0] + ".sil"
-            voiceLength = int(any_to_sil(file_path, sil_file))
+            voiceLength = int(compute_pool().run(any_to_sil, file_path, sil_file))
             if voiceLength >= 60000:
                 voiceLength = 60000
                 logger.info("[WX] voice too long, length={}, set to 60s".format(voiceLength))
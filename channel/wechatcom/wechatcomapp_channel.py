@@ -15,6 +15,7 @@ from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
+from common.compute_pool import compute_pool
 from common.log import logger
 from common.singleton import singleton
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length, convert_webp_to_png, \
@@ -69,8 +70,8 @@ class WechatComAppChannel(ChatChannel):
                 media_ids = []
                 file_path = reply.content
                 amr_file = os.path.splitext(file_path)[0] + ".amr"
-                any_to_amr(file_path, amr_file)
-                duration, files = split_audio(amr_file, 60 * 1000)
+                compute_pool().run(any_to_amr, file_path, amr_file)
+                duration, files = compute_pool().run(split_audio, amr_file, 60 * 1000)
                 if len(files) > 1:
                     logger.info("[wechatcom] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
                 for path in files:
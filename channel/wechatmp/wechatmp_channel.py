@@ -17,6 +17,7 @@ from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common.compute_pool import compute_pool
 from common.log import logger
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length, remove_markdown_symbol
@@ -86,7 +87,7 @@ class WechatMPChannel(ChatChannel):
                 self.cache_dict[receiver].append(("text", reply_text))
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
-                duration, files = split_audio(voice_file_path, 60 * 1000)
+                duration, files = compute_pool().run(split_audio, voice_file_path, 60 * 1000)
                 if len(files) > 1:
                     logger.info("[wechatmp] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
 
@@ -198,13 +199,13 @@ class WechatMPChannel(ChatChannel):
                         file_type = "audio/amr"
                     else:
                         mp3_file = os.path.splitext(file_path)[0] + ".mp3"
-                        any_to_mp3(file_path, mp3_file)
+                        compute_pool().run(any_to_mp3, file_path, mp3_file)
                         file_path = mp3_file
                         file_name = os.path.basename(file_path)
                         file_type = "audio/mpeg"
                     logger.info("[wechatmp] file_name: {}, file_type: {} ".format(file_name, file_type))
                     media_ids = []
-                    duration, files = split_audio(file_path, 60 * 1000)
+                    duration, files = compute_pool().run(split_audio, file_path, 60 * 1000)
                     if len(files) > 1:
                         logger.info("[wechatmp] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
                     for path in files:
@@ -0,0 +1,137 @@
+"""
+消息洪峰压测：向ChatChannel.produce灌入10万条消息，由消费线程调度处理，检查队列上限、内存上限，
+以及每条消息都被处理、丢弃或仍在排队，没有凭空丢失
+
+用法:
+    python channel_flood_test.py [--policy drop_oldest|drop_newest|reply_busy] [--messages 100000] [--sessions 1000]
+"""
+import argparse
+import resource
+import threading
+import time
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply
+from channel.chat_channel import ChatChannel
+from config import conf, load_config
+
+MAX_QUEUE_PER_SESSION = 20
+MAX_QUEUE_TOTAL = 2000
+MEMORY_CEILING_MB = 200  # 压测期间进程常驻内存的增长上限
+
+
+class FakeMsg(object):
+    def __init__(self, user_id):
+        self.actual_user_id = user_id
+        self.from_user_id = user_id
+
+
+class FloodChannel(ChatChannel):
+    NOT_SUPPORT_REPLYTYPE = []
+
+    def __init__(self):
+        super().__init__()
+        self.handled = 0
+        self.sent = 0
+        self.cancelled = 0  # 清除记忆时丢弃的排队消息和未开始的任务
+        self.counter_lock = threading.Lock()
+
+    def _handle(self, context):
+        # 模拟一次很快的模型调用
+        time.sleep(0.001)
+        with self.counter_lock:
+            self.handled += 1
+
+    def cancel_session(self, session_id, exclude_context: Context = None):
+        cnt = super().cancel_session(session_id, exclude_context)
+        with self.counter_lock:
+            self.cancelled += cnt["queued"]
+        return cnt
+
+    def _cancel_futures(self, futures):
+        cancelled = sum(1 for future in futures if future.cancel())
+        with self.counter_lock:
+            self.cancelled += cancelled
+
+    def _decorate_reply(self, context, reply):
+        return reply
+
+    def send(self, reply: Reply, context: Context):
+        with self.counter_lock:
+            self.sent += 1
+
+
+def make_context(content, session_id):
+    return Context(ContextType.TEXT, content, kwargs={"session_id": session_id, "receiver": session_id,
+                                                       "msg": FakeMsg(session_id), "origin_ctype": ContextType.TEXT})
+
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--policy", default="reply_busy", choices=["drop_oldest", "drop_newest", "reply_busy"])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--sessions", type=int, default=1000)
+    args = parser.parse_args()
+
+    load_config()
+    conf().update({
+        "max_queue_per_session": MAX_QUEUE_PER_SESSION,
+        "max_queue_total": MAX_QUEUE_TOTAL,
+        "max_queue_age": 2,
+        "queue_overflow_policy": args.policy,
+        "concurrency_in_session": 1,
+        "merge_msg_window": 0,
+        "flood_limit_private": 0,
+    })
+    channel = FloodChannel()
+    clear_command = conf().get("clear_memory_commands", ["#清除记忆"])[0]
+    rss_before = rss_mb()
+    max_total = 0
+    max_session = 0
+    commands = 0
+
+    start = time.time()
+    for i in range(args.messages):
+        session_id = "s{}".format(i % args.sessions)
+        if i % 10000 == 9999:
+            # 夹杂清除记忆命令，覆盖洪峰中取消排队任务的路径
+            channel.produce(make_context(clear_command, session_id))
+            commands += 1
+        channel.produce(make_context("m{}".format(i), session_id))
+        if i % 100 == 0:
+            with channel.lock:
+                max_total = max(max_total, channel.queued_total)
+                max_session = max(max_session, max(q.qsize() for q, _ in channel.sessions.values()))
+    produce_cost = time.time() - start
+
+    # 等待消费线程处理完或按排队时长丢弃剩余的消息
+    deadline = time.time() + 60
+    while channel.get_shed_stats()["queued_total"] > 0 and time.time() < deadline:
+        time.sleep(0.2)
+    time.sleep(1)
+
+    stats = channel.get_shed_stats()
+    dropped = sum(stats[reason] for reason in ("drop_oldest", "drop_newest", "reply_busy", "stale", "flood"))
+    accounted = dropped + channel.cancelled + channel.handled + stats["queued_total"]
+    rss_growth = rss_mb() - rss_before
+    print("policy={}, produce {} messages in {:.2f}s ({:.0f}/s)".format(args.policy, args.messages, produce_cost, args.messages / produce_cost))
+    print("shed stats: {}".format(stats))
+    print("handled={}, cancelled={}, sent={}, max_queue_total={}, max_queue_per_session={}, rss_growth={:.1f}MB".format(
+        channel.handled, channel.cancelled, channel.sent, max_total, max_session, rss_growth))
+
+    # 管理命令不参与过载丢弃，可能超出上限
+    assert max_total <= MAX_QUEUE_TOTAL + commands, "global queue exceeded: {}".format(max_total)
+    assert max_session <= MAX_QUEUE_PER_SESSION + commands, "session queue exceeded: {}".format(max_session)
+    assert stats["queued_total"] == 0, "messages left in queue: {}".format(stats["queued_total"])
+    # 清除记忆命令本身也会被处理，计入总数
+    assert accounted == args.messages + commands, "lost messages: accounted {} of {}".format(accounted, args.messages + commands)
+    assert rss_growth < MEMORY_CEILING_MB, "memory grew {:.1f}MB".format(rss_growth)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
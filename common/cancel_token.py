@@ -0,0 +1,178 @@
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from common.log import logger
+
+# 当前线程正在发送的请求的取消令牌，以及发送期间登记到令牌上的回调
+_local = threading.local()
+
+
+class RequestCancelled(Exception):
+    """请求已被取消(重置会话、清除记忆等)"""
+
+
+class CancelToken(object):
+    """
+    协作式取消令牌，随Context传递：
+    channel在重置会话时调用cancel()，bot在重试间隔、流式分片之间检查，HTTP层通过回调中断连接
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug("[CancelToken] callback error: {}".format(e))
+
+    def add_callback(self, callback):
+        """注册取消时的回调(如关闭连接)，已取消时立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait(self, seconds) -> bool:
+        """可被取消打断的sleep，返回True表示已取消"""
+        return self._event.wait(seconds)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise RequestCancelled("request cancelled")
+
+
+def is_cancelled(cancel_token) -> bool:
+    return cancel_token is not None and cancel_token.cancelled
+
+
+def cancellable_sleep(cancel_token, seconds) -> bool:
+    """替代time.sleep，没有令牌时普通等待，返回True表示已取消"""
+    if cancel_token is None:
+        threading.Event().wait(seconds)
+        return False
+    return cancel_token.wait(seconds)
+
+
+class _AbortOnCancelPool(object):
+    """请求发送前把连接登记到当前线程的取消令牌上，取消时关闭socket，等待响应头的线程也会立即返回"""
+
+    def _validate_conn(self, conn):
+        super()._validate_conn(conn)
+        cancel_token = getattr(_local, "cancel_token", None)
+        if cancel_token is None:
+            conn.cancel_token = None
+            return
+        if getattr(conn, "sock", None) is None:
+            conn.connect()  # http连接默认在发送时才建立，提前建立后取消时才有socket可以关闭
+        conn.cancel_token = cancel_token
+        callback = lambda: _shutdown(conn, cancel_token)
+        _local.callbacks.append(callback)
+        cancel_token.add_callback(callback)
+
+
+class _CancellableHTTPConnectionPool(_AbortOnCancelPool, HTTPConnectionPool):
+    pass
+
+
+class _CancellableHTTPSConnectionPool(_AbortOnCancelPool, HTTPSConnectionPool):
+    pass
+
+
+def _shutdown(conn, cancel_token):
+    # 连接可能已经放回连接池被其他请求使用，只关闭仍属于这次请求的连接
+    sock = getattr(conn, "sock", None)
+    if sock is None or getattr(conn, "cancel_token", None) is not cancel_token:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass
+
+
+def _use_cancellable_pools(manager):
+    manager.pool_classes_by_scheme = {"http": _CancellableHTTPConnectionPool, "https": _CancellableHTTPSConnectionPool}
+
+
+class CancellableAdapter(HTTPAdapter):
+    """
+    通过cancellable_post发送的请求在建立连接后、发送前登记取消回调，响应头返回前也可以中断；
+    socks代理的连接池不替换，只能在收到响应头后中断
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        _use_cancellable_pools(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if not proxy.lower().startswith("socks"):
+            _use_cancellable_pools(manager)
+        return manager
+
+
+def cancellable_session(**adapter_kwargs) -> requests.Session:
+    """创建挂载了CancellableAdapter的session，参数同HTTPAdapter"""
+    session = requests.Session()
+    adapter = CancellableAdapter(**adapter_kwargs)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def cancellable_post(url, cancel_token=None, session: requests.Session = None, **kwargs) -> requests.Response:
+    """
+    requests.post的可取消版本：取消时关闭底层连接，等待响应或正在读取响应的线程会立即抛出RequestCancelled
+    :param session: 复用连接的session，应通过cancellable_session创建；为None时每次请求新建连接
+    """
+    if cancel_token is None:
+        return (session or requests).post(url, **kwargs)
+    cancel_token.raise_if_cancelled()
+    if session is None:
+        with cancellable_session() as session:
+            return _post_until_cancelled(session, url, cancel_token, **kwargs)
+    return _post_until_cancelled(session, url, cancel_token, **kwargs)
+
+
+def _post_until_cancelled(session, url, cancel_token, **kwargs) -> requests.Response:
+    _local.cancel_token = cancel_token
+    _local.callbacks = callbacks = []
+    try:
+        try:
+            response = session.post(url, stream=True, **kwargs)
+        finally:
+            _local.cancel_token = None
+        # 没有挂载CancellableAdapter的session只能在收到响应头后中断
+        callbacks.append(response.close)
+        cancel_token.add_callback(response.close)
+        response.content  # 读取完整响应体，取消时在这里中断；被关闭的连接不会放回连接池
+    except Exception:
+        cancel_token.raise_if_cancelled()
+        raise
+    finally:
+        for callback in callbacks:
+            cancel_token.remove_callback(callback)
+    cancel_token.raise_if_cancelled()
+    return response
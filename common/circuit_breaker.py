@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """
+    熔断器：连续失败failure_threshold次后打开，recovery_timeout秒内拒绝请求；
+    之后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = 0
+        self.probing = False  # 半开状态下是否已有探测请求
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.recovery_timeout:
+                    return False
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_cancelled(self):
+        """请求被主动取消，不计入成功或失败"""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker(object):
+    """记录最近size次成功请求的耗时(秒)，用于计算分位数"""
+
+    def __init__(self, size=200):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=size)
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, p):
+        """p取0~100，没有样本时返回None"""
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
@@ -0,0 +1,131 @@
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from common.log import logger
+from config import conf
+
+# /dev/shm是内存文件系统，在这里交换的临时文件不落盘
+_SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class ComputePool(object):
+    """
+    CPU密集任务(音频转码、图片压缩等)的进程池，避免和处理线程争抢GIL
+    只传递文件路径，不传递文件内容；进程池不可用时退回在当前线程执行
+    提交的函数和参数必须可以pickle，即模块级别的函数
+    """
+
+    MAX_BROKEN = 3  # 进程池累计崩溃的次数上限，超过后不再使用进程池
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.executor = None
+        self.broken = 0
+        self.submitted = 0
+        self.fallback = 0  # 退回当前线程执行的次数
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_workers > 0 and self.broken < self.MAX_BROKEN
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None and self.enabled:
+                try:
+                    # fork多线程的进程容易死锁(如子进程继承了被占用的日志锁)，用forkserver/spawn启动子进程
+                    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                    self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(method))
+                    logger.info("[ComputePool] started with {} processes ({})".format(self.max_workers, method))
+                except Exception as e:
+                    logger.warning("[ComputePool] start failed, run in thread: {}".format(e))
+                    self.broken = self.MAX_BROKEN
+            return self.executor
+
+    def _reset(self, executor, e):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+                self.broken += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.warning("[ComputePool] process pool broken ({} times), restart on next task: {}".format(self.broken, e))
+
+    def run(self, fn, *args):
+        """在进程池中执行fn(*args)并返回结果，fn自身抛出的异常原样抛出，进程池无法提交任务时在当前线程执行"""
+        executor = self._get_executor()
+        if executor is not None:
+            try:
+                future = executor.submit(fn, *args)
+            except RuntimeError as e:  # 进程池已崩溃或已关闭
+                self._reset(executor, e)
+            else:
+                self.submitted += 1
+                try:
+                    return future.result()
+                except BrokenProcessPool as e:
+                    # 子进程异常退出，可能正是这个任务导致的(如解码器崩溃)，不在当前线程重试
+                    self._reset(executor, e)
+                    raise
+        self.fallback += 1
+        return fn(*args)
+
+    def run_on_buffer(self, fn, file, *args) -> io.BytesIO:
+        """
+        处理内存中的文件：fn(src, dst, *args)读取src，把结果写入dst，返回结果的BytesIO
+        使用进程池时src、dst是临时文件的路径，否则直接是file和BytesIO
+        """
+        file.seek(0)
+        if not self.enabled:
+            out = io.BytesIO()
+            fn(file, out, *args)
+            out.seek(0)
+            return out
+        paths = []
+        try:
+            src = _temp_path(paths)
+            with open(src, "wb") as f:
+                f.write(file.getbuffer() if isinstance(file, io.BytesIO) else file.read())
+            dst = _temp_path(paths)
+            self.run(fn, src, dst, *args)
+            with open(dst, "rb") as f:
+                return io.BytesIO(f.read())
+        finally:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "enabled": self.enabled,
+            "submitted": self.submitted,
+            "fallback": self.fallback,
+            "broken": self.broken,
+        }
+
+
+def _temp_path(paths) -> str:
+    fd, path = tempfile.mkstemp(prefix="cow_compute_", dir=_SHM_DIR)
+    os.close(fd)
+    paths.append(path)
+    return path
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def compute_pool() -> ComputePool:
+    """全局共享的计算进程池，进程在第一次提交任务时才启动，compute_pool_size为0时在当前线程执行"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ComputePool(conf().get("compute_pool_size", 2))
+        return _pool
@@ -0,0 +1,55 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Executor
+
+from common.log import logger
+
+
+class DelayQueue(object):
+    """
+    基于最小堆的延时任务队列，由一个调度线程在任务到期时执行(或提交到executor执行)
+    调度线程在第一次schedule时启动
+    """
+
+    def __init__(self, executor: Executor = None):
+        self.executor = executor
+        self.heap = []
+        self.cond = threading.Condition()
+        self.counter = itertools.count()  # 相同到期时间时按提交顺序执行
+        self.thread = None
+
+    def schedule(self, delay, fn, *args, **kwargs):
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + max(delay, 0), next(self.counter), fn, args, kwargs))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._dispatch, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.heap)
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                remaining = self.heap[0][0] - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                _, _, fn, args, kwargs = heapq.heappop(self.heap)
+            if self.executor:
+                self.executor.submit(self._run, fn, *args, **kwargs)
+            else:
+                self._run(fn, *args, **kwargs)
+
+    @staticmethod
+    def _run(fn, *args, **kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logger.exception("[DelayQueue] task error: {}".format(e))
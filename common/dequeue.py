@@ -31,3 +31,8 @@ class Dequeue(Queue):
 
     def _putleft(self, item):
         self.queue.appendleft(item)
+
+    def peek(self):
+        """返回队首元素但不取出，队列为空时返回None"""
+        with self.mutex:
+            return self.queue[0] if self.queue else None
@@ -0,0 +1,189 @@
+"""
+异步图片生成任务：提交后立即返回，所有未完成的任务由一个调度线程统一按退避间隔查询状态，完成后回调
+
+用法:
+    job = image_job_engine().submit(
+        kind="midjourney", user_id=session_id,
+        start=lambda: 提交任务并返回服务端的任务id,
+        poll=lambda job: 查询job.remote_id的状态，未完成返回None，完成返回结果，失败抛出ImageJobFailed,
+        on_done=lambda job: 按job.status发送job.result或job.error,
+    )
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common.delay_queue import DelayQueue
+from common.log import logger
+from config import conf
+
+PENDING = "pending"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+EXPIRED = "expired"
+
+MAX_POLL_ERRORS = 5  # 连续查询出错(网络异常等)的次数上限，超过后任务失败
+
+
+class ImageJobFailed(Exception):
+    """任务在服务端失败，不再查询"""
+
+
+class ImageJobQuotaExceeded(Exception):
+    """未完成的任务数达到上限，异常信息可以直接回复给用户"""
+
+
+class ImageJob(object):
+    def __init__(self, kind, user_id, poll, on_done, timeout):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.user_id = user_id
+        self.poll = poll
+        self.on_done = on_done
+        self.remote_id = None  # 服务端的任务id，start返回后设置
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.deadline = time.monotonic() + timeout
+        self.next_poll_at = None  # 为None时不查询(尚未提交到服务端或正在查询)
+        self.checks = 0
+        self.errors = 0
+        self.done = threading.Event()
+
+    def wait(self, timeout=None) -> bool:
+        """同步等待任务结束，返回False表示等待超时"""
+        return self.done.wait(timeout)
+
+    def __str__(self):
+        return "id={}, kind={}, user_id={}, remote_id={}, status={}".format(self.id, self.kind, self.user_id, self.remote_id, self.status)
+
+
+class ImageJobEngine(object):
+    """
+    限制同时进行的任务总数和每个用户的任务数；到期的任务在同一轮中一起查询，查询间隔按次数指数增长
+    查询和回调在一个小线程池中执行，不为每个任务单独占用线程
+    """
+
+    def __init__(self, poll_workers=4):
+        self.lock = threading.Lock()
+        self.jobs = {}  # 未完成的任务
+        self.executor = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix="image_job")
+        self.queue = DelayQueue()
+        self.finished = {SUCCEEDED: 0, FAILED: 0, EXPIRED: 0}
+
+    def submit(self, kind, user_id, start, poll, on_done, timeout=360, first_delay=None,
+               max_pending=None, max_pending_per_user=None) -> ImageJob:
+        """
+        先检查配额并占位，再调用start向服务端提交任务，start抛出的异常原样抛出
+        :param max_pending: 该类任务同时进行的上限，另外还受全局的image_job_max_pending限制
+        :param max_pending_per_user: 每个用户该类任务同时进行的上限，另外还受全局的image_job_max_pending_per_user限制
+        :param first_delay: 提交后第一次查询前等待的秒数，默认为image_job_poll_interval
+        """
+        job = ImageJob(kind, user_id, poll, on_done, timeout)
+        with self.lock:
+            self._check_quota(kind, user_id, max_pending, max_pending_per_user)
+            self.jobs[job.id] = job
+        try:
+            job.remote_id = start()
+        except BaseException:
+            with self.lock:
+                self.jobs.pop(job.id, None)
+            raise
+        delay = conf().get("image_job_poll_interval", 2) if first_delay is None else first_delay
+        with self.lock:
+            job.next_poll_at = time.monotonic() + delay
+        logger.info("[ImageJob] submitted {}".format(job))
+        self.queue.schedule(delay, self._tick)
+        return job
+
+    def _check_quota(self, kind, user_id, max_pending, max_pending_per_user):
+        pending = list(self.jobs.values())
+        if len(pending) >= conf().get("image_job_max_pending", 10):
+            raise ImageJobQuotaExceeded("作图任务数已达上限，请稍后再试")
+        if user_id is not None and len([j for j in pending if j.user_id == user_id]) >= conf().get("image_job_max_pending_per_user", 2):
+            raise ImageJobQuotaExceeded("您的作图任务数已达上限，请稍后再试")
+        same_kind = [j for j in pending if j.kind == kind]
+        if max_pending is not None and len(same_kind) >= max_pending:
+            raise ImageJobQuotaExceeded("作图任务数已达上限，请稍后再试")
+        if user_id is not None and max_pending_per_user is not None and len([j for j in same_kind if j.user_id == user_id]) >= max_pending_per_user:
+            raise ImageJobQuotaExceeded("您的作图任务数已达上限，请稍后再试")
+
+    def pending_count(self, kind=None, user_id=None) -> int:
+        with self.lock:
+            return len([j for j in self.jobs.values() if (kind is None or j.kind == kind) and (user_id is None or j.user_id == user_id)])
+
+    def _tick(self):
+        """取出所有到期的任务一起查询"""
+        now = time.monotonic()
+        with self.lock:
+            due = [j for j in self.jobs.values() if j.next_poll_at is not None and j.next_poll_at <= now]
+            for job in due:
+                job.next_poll_at = None
+        for job in due:
+            self.executor.submit(self._check, job)
+
+    def _check(self, job: ImageJob):
+        job.checks += 1
+        try:
+            result = job.poll(job)
+            job.errors = 0
+        except ImageJobFailed as e:
+            self._finish(job, FAILED, error=str(e))
+            return
+        except Exception as e:
+            job.errors += 1
+            logger.warning("[ImageJob] poll {} error ({} times): {}".format(job, job.errors, e))
+            if job.errors >= MAX_POLL_ERRORS:
+                self._finish(job, FAILED, error=str(e))
+                return
+            result = None
+        if result is not None:
+            self._finish(job, SUCCEEDED, result=result)
+        elif time.monotonic() >= job.deadline:
+            self._finish(job, EXPIRED, error="任务超时")
+        else:
+            delay = self._backoff(job.checks)
+            with self.lock:
+                job.next_poll_at = time.monotonic() + delay
+            self.queue.schedule(delay, self._tick)
+
+    @staticmethod
+    def _backoff(checks) -> float:
+        return min(conf().get("image_job_poll_max_interval", 15), conf().get("image_job_poll_interval", 2) * 1.5 ** checks)
+
+    def _finish(self, job: ImageJob, status, result=None, error=None):
+        with self.lock:
+            self.jobs.pop(job.id, None)
+            self.finished[status] += 1
+        job.status = status
+        job.result = result
+        job.error = error
+        job.done.set()
+        logger.info("[ImageJob] finished {}, checks={}, cost={:.1f}s".format(job, job.checks, time.time() - job.created_at))
+        if job.on_done:
+            try:
+                job.on_done(job)
+            except Exception as e:
+                logger.exception("[ImageJob] on_done of {} error: {}".format(job, e))
+
+    def stats(self) -> dict:
+        with self.lock:
+            pending = {}
+            for job in self.jobs.values():
+                pending[job.kind] = pending.get(job.kind, 0) + 1
+            return {"pending": pending, **self.finished}
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def image_job_engine() -> ImageJobEngine:
+    """全局共享的图片任务引擎"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ImageJobEngine(conf().get("image_job_poll_workers", 4))
+        return _engine
@@ -0,0 +1,146 @@
+import itertools
+import threading
+import time
+
+from common.log import logger
+from common.sliding_window import SlidingWindowCounter
+
+LEAST_LOADED = "least_loaded"
+ROUND_ROBIN = "round_robin"
+
+
+class ApiKey(object):
+    """
+    一个api key及其所在的api base，记录最近一分钟的请求数和token数、正在进行的请求数
+    rpm、tpm为该key的限额，0表示不限制，达到限额的key不会被优先选择
+    """
+
+    def __init__(self, key, api_base=None, rpm=0, tpm=0):
+        self.key = key
+        self.api_base = api_base
+        self.rpm = rpm
+        self.tpm = tpm
+        self.in_flight = 0
+        self.requests = 0
+        self.tokens = 0
+        self.errors = 0
+        self.recent_requests = SlidingWindowCounter(60, 12)
+        self.recent_tokens = SlidingWindowCounter(60, 12)
+        self.quarantined_until = 0
+        self.quarantine_reason = None
+
+    @property
+    def name(self) -> str:
+        """日志中显示的key，只保留首尾几位"""
+        if len(self.key) <= 12:
+            return self.key[:3] + "***"
+        return "{}...{}".format(self.key[:7], self.key[-4:])
+
+    def utilization(self, now) -> float:
+        """最近一分钟的用量占限额的比例，未设置限额时为0"""
+        usage = 0
+        if self.rpm:
+            usage = max(usage, self.recent_requests.count(now) / self.rpm)
+        if self.tpm:
+            usage = max(usage, self.recent_tokens.count(now) / self.tpm)
+        return usage
+
+
+class KeyPool(object):
+    """
+    多个api key的调度：按负载最低(least_loaded)或轮询(round_robin)选择key，
+    被限流或鉴权失败的key暂时隔离，同一个请求可以换下一个key重试
+    """
+
+    def __init__(self, keys, strategy=LEAST_LOADED):
+        self.keys = keys
+        self.strategy = strategy
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def acquire(self, exclude=()):
+        """
+        选择一个key并计入正在进行的请求，请求结束后需要调用release
+        :param exclude: 本次请求已经失败过的key
+        :return: 没有隔离的key中负载最低的；全部被隔离时返回最早解除隔离的key；全部被排除时返回None
+        """
+        now = time.time()
+        with self.lock:
+            candidates = [k for k in self.keys if k not in exclude]
+            if not candidates:
+                return None
+            available = [k for k in candidates if k.quarantined_until <= now]
+            if not available:
+                key = min(candidates, key=lambda k: k.quarantined_until)
+            elif self.strategy == ROUND_ROBIN:
+                start = next(self.counter)
+                ordered = [available[(start + i) % len(available)] for i in range(len(available))]
+                # 轮询时跳过已达到限额的key，全部达到限额时按顺序选
+                key = next((k for k in ordered if k.utilization(now) < 1), ordered[0])
+            else:
+                key = min(available, key=lambda k: (k.utilization(now) >= 1, k.in_flight, k.utilization(now), k.recent_requests.count(now)))
+            key.in_flight += 1
+            key.requests += 1
+            key.recent_requests.add(now)
+            return key
+
+    def release(self, key: ApiKey, tokens=0, error=False):
+        now = time.time()
+        with self.lock:
+            key.in_flight -= 1
+            if tokens:
+                key.tokens += tokens
+                key.recent_tokens.add(now, tokens)
+            if error:
+                key.errors += 1
+
+    def quarantine(self, key: ApiKey, seconds, reason):
+        with self.lock:
+            key.quarantined_until = max(key.quarantined_until, time.time() + seconds)
+            key.quarantine_reason = reason
+        logger.warning("[KeyPool] key {} quarantined for {}s: {}".format(key.name, seconds, reason))
+
+    def has_alternative(self, exclude) -> bool:
+        """除exclude外是否还有未被隔离的key"""
+        now = time.time()
+        with self.lock:
+            return any(k not in exclude and k.quarantined_until <= now for k in self.keys)
+
+    def stats(self) -> list:
+        now = time.time()
+        with self.lock:
+            return [
+                {
+                    "key": k.name,
+                    "api_base": k.api_base,
+                    "in_flight": k.in_flight,
+                    "requests": k.requests,
+                    "tokens": k.tokens,
+                    "errors": k.errors,
+                    "rpm": k.recent_requests.count(now),
+                    "tpm": k.recent_tokens.count(now),
+                    "utilization": round(k.utilization(now), 2),
+                    "quarantined": max(0, int(k.quarantined_until - now)),
+                    "quarantine_reason": k.quarantine_reason if k.quarantined_until > now else None,
+                }
+                for k in self.keys
+            ]
+
+
+def build_key_pool(entries, default_key, default_base=None, strategy=LEAST_LOADED) -> KeyPool:
+    """
+    :param entries: 配置的key列表，每一项为key字符串，或{"key", "api_base", "rpm", "tpm"}
+    :param default_key: 未配置列表时使用的单个key
+    """
+    keys = []
+    for entry in entries or []:
+        if isinstance(entry, str):
+            keys.append(ApiKey(entry, default_base))
+        else:
+            keys.append(ApiKey(entry["key"], entry.get("api_base") or default_base, entry.get("rpm", 0), entry.get("tpm", 0)))
+    if not keys and default_key:
+        keys.append(ApiKey(default_key, default_base))
+    return KeyPool(keys, strategy)
@@ -0,0 +1,262 @@
+"""
+bot用量计量：按(CoW, 用户, 群, 模型)统计请求数、失败数、prompt/completion token和耗时，用于按CoW向租户计费
+
+记录时只写当前线程自己的计数字典，不加锁；后台线程定期汇总各线程计数相对上次的增量，累加到内存中的总量，
+并把增量写入本地的sqlite或csv文件
+
+用法:
+    metering.report_usage(context, model, total_tokens, completion_tokens)  # bot拿到模型用量后调用
+    metering.record_request(context, latency, failed)  # bridge在每次请求结束后调用
+"""
+import atexit
+import csv
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+# 计数列表各项的下标
+REQUESTS, ERRORS, PROMPT_TOKENS, COMPLETION_TOKENS, LATENCY_MS = range(5)
+FIELDS = ("requests", "errors", "prompt_tokens", "completion_tokens", "latency_ms")
+
+COW_ID = os.getpid()  # 与管理服务(server.py)中的cow_id一致
+
+_local = threading.local()
+_shards = []  # [(线程弱引用, 计数字典)]，计数字典: (用户, 群, 模型) -> [请求数, 失败数, prompt, completion, 耗时毫秒]
+_shards_lock = threading.Lock()
+
+
+def _counters() -> dict:
+    counters = getattr(_local, "counters", None)
+    if counters is None:
+        counters = _local.counters = {}
+        with _shards_lock:
+            _shards.append((weakref.ref(threading.current_thread()), counters))
+        _meter()
+    return counters
+
+
+def _key(context, model) -> tuple:
+    """群聊按群成员和群统计，私聊按发送者统计，没有消息对象时(如web、终端渠道)按会话统计"""
+    msg = context.get("msg") if context else None
+    if msg is None:
+        return context.get("session_id") if context else None, None, model
+    if context.get("isgroup"):
+        return msg.actual_user_id, msg.other_user_id, model
+    return msg.from_user_id, None, model
+
+
+def _request_model(context):
+    return (context.get("gpt_model") if context else None) or conf().get("model")
+
+
+def report_usage(context, model, total_tokens, completion_tokens=0):
+    """
+    记录一次模型调用的token用量，model为实际请求的模型，为空时使用会话的模型
+    total_tokens为None时不记录(接口没有返回用量)
+    """
+    if total_tokens is None or not conf().get("metering", True):
+        return
+    total_tokens = int(total_tokens or 0)
+    completion_tokens = int(completion_tokens or 0)
+    counter = _counter(_key(context, model or _request_model(context)))
+    counter[PROMPT_TOKENS] += max(0, total_tokens - completion_tokens)
+    counter[COMPLETION_TOKENS] += completion_tokens
+
+
+def record_request(context, latency, failed=False):
+    """
+    记录一次回复请求及其耗时(秒)。请求数和耗时按请求的模型统计；token按实际调用的模型统计，
+    备用bot、对冲请求和重试产生的用量都会计入
+    """
+    if not conf().get("metering", True):
+        return
+    counter = _counter(_key(context, _request_model(context)))
+    counter[REQUESTS] += 1
+    counter[LATENCY_MS] += int(latency * 1000)
+    if failed:
+        counter[ERRORS] += 1
+
+
+def _counter(key) -> list:
+    counters = _counters()
+    counter = counters.get(key)
+    if counter is None:
+        counter = counters[key] = [0, 0, 0, 0, 0]
+    return counter
+
+
+class CSVSink(object):
+    HEADER = ("time", "cow_id", "user_id", "group_id", "model") + FIELDS
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, rows):
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(self.HEADER)
+            writer.writerows(rows)
+
+
+class SQLiteSink(object):
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "time REAL NOT NULL, cow_id INTEGER NOT NULL, user_id TEXT, group_id TEXT, model TEXT, "
+                "requests INTEGER NOT NULL, errors INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, "
+                "completion_tokens INTEGER NOT NULL, latency_ms INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_time ON usage (time)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # 多个CoW进程可能写同一个文件，等待其他进程的写事务
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def write(self, rows):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        finally:
+            conn.close()
+
+
+class Meter(object):
+    """汇总各线程的计数，只有后台线程和查询接口会调用，用锁保证增量不会重复计算"""
+
+    def __init__(self, sink=None, flush_interval=60):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.last = {}  # id(计数字典) -> {key: 上次汇总时的计数}
+        self.totals = {}  # key -> 累计计数
+        self.pending = {}  # key -> 尚未写入sink的增量
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self._run, name="metering", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def collect(self):
+        """把各线程计数相对上次的增量累加到totals和pending"""
+        with _shards_lock:
+            shards = list(_shards)
+        with self.lock:
+            for thread_ref, counters in shards:
+                alive = thread_ref() is not None and thread_ref().is_alive()
+                # 复制时不执行python代码，在GIL下是原子的；读到写了一半的计数也没关系，剩下的部分下次汇总
+                snapshot = [(key, tuple(counter)) for key, counter in list(counters.items())]
+                last = self.last.setdefault(id(counters), {})
+                for key, values in snapshot:
+                    previous = last.get(key)
+                    delta = values if previous is None else [v - p for v, p in zip(values, previous)]
+                    if any(delta):
+                        _add(self.totals, key, delta)
+                        _add(self.pending, key, delta)
+                    last[key] = values
+                if not alive:
+                    # 已结束的线程不会再写入，本次汇总后丢弃
+                    with _shards_lock:
+                        _shards.remove((thread_ref, counters))
+                    del self.last[id(counters)]
+
+    def flush(self):
+        self.collect()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending or self.sink is None:
+            return
+        now = time.time()
+        rows = [(now, COW_ID, user_id, group_id, model, *values) for (user_id, group_id, model), values in pending.items()]
+        try:
+            self.sink.write(rows)
+            logger.debug("[Metering] flushed {} rows".format(len(rows)))
+        except Exception as e:
+            # 写入失败的增量放回，下次一起写入
+            with self.lock:
+                for key, values in pending.items():
+                    _add(self.pending, key, values)
+            logger.warning("[Metering] flush failed, retry later: {}".format(e))
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def summary(self, group_by=("user_id", "group_id", "model")) -> dict:
+        """
+        按group_by中的维度(user_id、group_id、model的子集)汇总的用量，以及合计
+        """
+        self.collect()
+        dims = ("user_id", "group_id", "model")
+        rows = {}
+        with self.lock:
+            items = list(self.totals.items())
+        for key, values in items:
+            row_key = tuple(v for d, v in zip(dims, key) if d in group_by)
+            _add(rows, row_key, values)
+        total = [0] * len(FIELDS)
+        for values in rows.values():
+            total = [t + v for t, v in zip(total, values)]
+        return {
+            "cow_id": COW_ID,
+            "since": self.started_at,
+            "total": dict(zip(FIELDS, total)),
+            "rows": [dict(zip([d for d in dims if d in group_by], row_key), **dict(zip(FIELDS, values))) for row_key, values in rows.items()],
+        }
+
+
+def _add(target, key, values):
+    current = target.get(key)
+    if current is None:
+        target[key] = list(values)
+    else:
+        for i, v in enumerate(values):
+            current[i] += v
+
+
+def _create_sink():
+    sink_type = conf().get("metering_sink", "sqlite")
+    if not sink_type:
+        return None
+    path = conf().get("metering_path")
+    if sink_type == "sqlite":
+        return SQLiteSink(path or os.path.join(get_appdata_dir(), "usage.db"))
+    if sink_type == "csv":
+        return CSVSink(path or os.path.join(get_appdata_dir(), "usage.csv"))
+    raise ValueError("unknown metering_sink: {}".format(sink_type))
+
+
+_meter_instance = None
+_meter_lock = threading.Lock()
+
+
+def _meter() -> Meter:
+    global _meter_instance
+    with _meter_lock:
+        if _meter_instance is None:
+            try:
+                sink = _create_sink()
+            except Exception as e:
+                logger.error("[Metering] create sink failed, usage is only kept in memory: {}".format(e))
+                sink = None
+            _meter_instance = Meter(sink, conf().get("metering_flush_interval", 60))
+        return _meter_instance
+
+
+def summary(group_by=("user_id", "group_id", "model")) -> dict:
+    return _meter().summary(group_by)
+
+
+def flush():
+    _meter().flush()
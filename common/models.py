@@ -81,7 +81,14 @@ class CoWConfig(BaseModel):
     open_ai_api_key: str = Field("", description="OpenAI API兼容的LLM服务的Api Key")
     open_ai_api_base: str = Field("https://api.openai.com/v1",
                                   description="OpenAI API兼容的LLM服务的base URL，可以不以“/v1”结尾")
+    open_ai_api_keys: list = Field(default_factory=list,
+                                   description="多个Api Key，每项为key字符串或{key, api_base, rpm, tpm}，配置后代替open_ai_api_key")
+    api_key_strategy: str = Field("least_loaded", description="多个Api Key的选择方式: least_loaded, round_robin")
+    api_key_quarantine_seconds: dict = Field({"rate_limit": 20, "auth": 600},
+                                             description="Api Key被限流、鉴权失败后暂停使用的秒数")
     proxy: Optional[str] = Field(None, description="Proxy for OpenAI requests")
+    openai_client_pool_size: int = Field(10, description="Max pooled connections of each (api base, key) OpenAI client")
+    openai_client_cache_size: int = Field(32, description="Max cached (api base, key) OpenAI clients, the least recently used is closed beyond it")
 
     # chatgpt模型
     model: str = Field("", description="ChatGPT model")
@@ -124,12 +131,55 @@ class CoWConfig(BaseModel):
     image_proxy: bool = Field(True, description="Whether to use image proxy")
     image_create_prefix: List[str] = Field([], description="Prefixes to enable image creation")
     concurrency_in_session: int = Field(1, description="Max concurrent messages per session")
+    reply_in_order: bool = Field(True, description="Send replies of one session in message order when concurrency_in_session > 1")
+    reply_order_timeout: float = Field(30, description="Seconds to wait for the earliest pending reply before sending later ones")
+    merge_msg_window: float = Field(0, description="Seconds to merge consecutive text messages from the same user, 0 to disable")
+    merge_msg_max_wait: float = Field(5, description="Max seconds a merged message may wait before dispatch")
+    max_queue_per_session: int = Field(0, description="Max queued messages per session, 0 for unlimited")
+    max_queue_total: int = Field(0, description="Max queued messages across all sessions, 0 for unlimited")
+    queue_overflow_policy: str = Field("drop_oldest", description="Overflow policy: drop_oldest, drop_newest or reply_busy")
+    queue_busy_reply: str = Field("当前消息太多，请稍后再试", description="Reply sent under the reply_busy overflow policy")
+    max_queue_age: float = Field(0, description="Drop queued messages older than this many seconds, 0 to disable")
+    worker_pool_sizes: dict = Field({"text": 8, "media": 2, "image": 2, "plugin": 2},
+                                    description="Worker threads per workload class: text chat, media, image creation, plugin tasks")
+    compute_pool_size: int = Field(2, description="Processes for CPU heavy work such as audio transcoding and image compression, 0 runs it in the handler thread")
+    send_retry_max_attempts: int = Field(3, description="Max attempts (including the first) to send a reply before dropping it")
+    send_retry_base_delay: float = Field(3, description="Initial delay in seconds between send retries, doubled each attempt")
+    send_retry_max_delay: float = Field(60, description="Max delay in seconds between send retries")
+    send_retry_jitter: float = Field(0.2, description="Random jitter ratio applied to send retry delays")
+    flood_control_window: float = Field(60, description="Sliding window length in seconds for flood control")
+    flood_limit_group: dict = Field({"default": {"group": 0, "user": 0}},
+                                    description="Per-window limits per group and per group member, 0 for unlimited, overridable by group name")
+    flood_limit_private: int = Field(0, description="Per-window limit per private chat user, 0 for unlimited")
+    flood_cooldown_reply: str = Field("", description="Reply sent once per window when flood control triggers, empty to drop silently")
+    schedule_weights: dict = Field({"admin": 8, "vip": 4, "private": 2, "priority_group": 2, "group": 1},
+                                   description="Weighted fair scheduling weights per priority class, shared by all sessions of one group")
+    priority_group_list: List[str] = Field([], description="Group names scheduled with the priority_group weight")
+    single_flight_reply: bool = Field(False, description="Share one LLM call among concurrent identical questions without history")
     image_create_size: str = Field("256x256", description="Size of generated images")
+    image_job_max_pending: int = Field(10, description="Max asynchronous image jobs in progress")
+    image_job_max_pending_per_user: int = Field(2, description="Max asynchronous image jobs in progress per user")
+    image_job_poll_interval: float = Field(2, description="Initial status polling interval of image jobs in seconds, multiplied by 1.5 each time")
+    image_job_poll_max_interval: float = Field(15, description="Max status polling interval of image jobs in seconds")
+    image_job_poll_workers: int = Field(4, description="Threads that poll image job status")
+    image_job_timeout: int = Field(120, description="Timeout of Azure dall-e-2 image jobs in seconds")
+    vision_image_max_long_side: int = Field(2048, description="Max long side in pixels of images sent to vision models")
+    vision_image_max_short_side: int = Field(768, description="Max short side in pixels of images sent to vision models")
+    vision_image_format: str = Field("JPEG", description="Format images are recompressed to for vision models, JPEG or WEBP")
+    vision_image_quality: int = Field(85, description="Recompression quality of images sent to vision models")
+    vision_image_cache_ttl: int = Field(600, description="Seconds a processed vision image is cached by content hash")
 
     group_chat_exit_group: bool = Field(False, description="Whether to exit group on certain conditions")
 
     # chatgpt会话参数
     expires_in_seconds: int = Field(3600, description="Session expiration time without activity")
+    session_max_memory_mb: float = Field(0, description="Memory budget in MB for all session histories, least recently used evicted first, 0 for unlimited")
+    session_max_count: int = Field(0, description="Max number of stored sessions, least recently used evicted first, 0 for unlimited")
+    session_backend: str = Field("memory", description="Session persistence backend: memory, sqlite or lmdb")
+    session_backend_path: str = Field("", description="Path of the session database, defaults to sessions.db or sessions.lmdb under appdata_dir")
+    session_flush_interval: float = Field(2, description="Seconds between write-behind flushes of changed sessions")
+    session_flush_batch_size: int = Field(100, description="Flush immediately when this many sessions are pending")
+    session_lmdb_map_size_mb: int = Field(1024, description="Max size in MB of the LMDB session database")
 
     # 人格描述
     character_desc: str = Field(
@@ -137,6 +187,12 @@ class CoWConfig(BaseModel):
         description="Character description for the bot")
 
     conversation_max_tokens: int = Field(1000, description="Max tokens for conversation history")
+    conversation_summary: bool = Field(False, description="Fold older turns into a running summary in the background instead of discarding them")
+    conversation_summary_model: str = Field("", description="Model used for summaries, defaults to the chat model")
+    conversation_summary_threshold: float = Field(0.8, description="Start summarizing when history exceeds this ratio of conversation_max_tokens")
+    conversation_summary_keep_turns: int = Field(2, description="Most recent turns kept verbatim when summarizing")
+    token_estimator: dict = Field(default_factory=dict, description="Token counting mode per model, model prefix or default: exact, approximate or character")
+    token_estimator_coefficients: dict = Field(default_factory=dict, description="Per model family or model overrides of approximate token coefficients")
 
     # chatgpt限流配置
     rate_limit_chatgpt: int = Field(20, description="Rate limit for ChatGPT calls")
@@ -148,6 +204,23 @@ class CoWConfig(BaseModel):
     frequency_penalty: float = Field(0, description="Frequency penalty for ChatGPT")
     presence_penalty: float = Field(0, description="Presence penalty for ChatGPT")
     request_timeout: int = Field(180, description="Request timeout for ChatGPT")
+    bot_failover: list = Field(default_factory=list, description="Fallback bots tried in order when the primary fails or times out")
+    bot_hedging: bool = Field(False, description="Also request the next fallback bot once the current one exceeds its p95 latency")
+    bot_circuit_breaker: dict = Field({"failure_threshold": 5, "recovery_timeout": 30},
+                                      description="Consecutive failures that open a bot's circuit, and seconds before a probe is let through")
+    bot_timeout_min: int = Field(10, description="Lower bound of the adaptive per-bot timeout in seconds")
+    bot_timeout_max: int = Field(180, description="Upper bound of the adaptive per-bot timeout in seconds")
+    bot_retry_max_times: int = Field(2, description="Max retries of a bot request after a timeout, rate limit or server error")
+    bot_retry_base_delay: float = Field(2, description="Base of the exponential retry backoff in seconds")
+    bot_retry_max_delay: float = Field(20, description="Upper bound of a single retry wait in seconds, Retry-After included")
+    bot_retry_rate_limit_factor: float = Field(5, description="Multiplier of the backoff base when rate limited")
+    bot_retry_deadline: int = Field(120, description="Total time budget of a bot request including retries in seconds")
+    warmup: bool = Field(True, description="Create bots, load tokenizers and connect to API bases at startup and after a model switch")
+    warmup_timeout: int = Field(30, description="Max seconds startup waits for the warm-up before the rest continues in background")
+    metering: bool = Field(True, description="Whether to meter requests, tokens and latency per user, group and model")
+    metering_sink: str = Field("sqlite", description="Where metered usage is flushed: sqlite, csv, or empty to keep it only in memory")
+    metering_path: str = Field("", description="Path of the usage file, defaults to usage.db or usage.csv under appdata_dir")
+    metering_flush_interval: int = Field(60, description="Seconds between usage flushes to the sink")
     timeout: int = Field(120, description="Retry timeout for ChatGPT")
 
     # Baidu 文心一言参数
@@ -162,6 +235,7 @@ class CoWConfig(BaseModel):
     xunfei_api_secret: Optional[str] = Field(None, description="Xunfei API secret")
     xunfei_domain: Optional[str] = Field(None, description="Xunfei domain")
     xunfei_spark_url: Optional[str] = Field(None, description="Xunfei Spark URL")
+    xunfei_spare_connections: int = Field(1, description="Idle Xunfei websocket connections opened ahead of requests")
 
     # claude 配置
     claude_api_cookie: Optional[str] = Field(None, description="Claude API cookie")
@@ -293,5 +367,23 @@ class ResponseItem(BaseModel):
     data: CowItem | List[CowItem] | None = Field(None, description="Response data")
 
 
+class UsageItem(BaseModel):
+    cow_id: int = Field(-1, description="CoW id")
+    since: float = Field(0, description="Timestamp the usage is counted from, the start of the CoW process")
+    total: dict = Field(default_factory=dict, description="Total requests, errors, prompt_tokens, completion_tokens and latency_ms")
+    rows: List[dict] = Field(default_factory=list, description="Usage grouped by user_id, group_id and model")
+
+
+class UsageSummary(BaseModel):
+    total: dict = Field(default_factory=dict, description="Usage summed over all CoWs")
+    cows: List[UsageItem] = Field(default_factory=list, description="Usage of each CoW")
+
+
+class UsageResponseItem(BaseModel):
+    code: int = Field(200, description="Response code")
+    msg: str = Field("success", description="Response message")
+    data: UsageSummary | None = Field(None, description="Response data")
+
+
 class SwitchItem(BaseModel):
     switch: bool = Field(False, description="Switch status")
@@ -0,0 +1,143 @@
+"""
+兼容OpenAI接口的客户端：每个实例持有自己的api base、key和连接池，不读写openai模块的全局配置，
+不同租户、用户自己的key之间互不影响；按(api base, key)缓存实例，同一个key的请求复用连接
+
+用法:
+    client = get_openai_client(api_base, api_key)
+    response = client.chat_completion(messages, cancel_token=cancel_token, request_timeout=60, **args)
+    response.choices[0]["message"]["content"], response["usage"]["total_tokens"]
+
+请求失败时抛出与openai sdk相同的openai.error异常，调用方原有的异常处理和重试策略不需要修改
+"""
+import threading
+from collections import OrderedDict
+
+import openai.error
+import openai.util
+import requests
+
+from common.cancel_token import cancellable_post, cancellable_session
+from common.log import logger
+from config import conf
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+# 请求体中不属于接口参数的sdk参数
+SDK_ARGS = ("request_timeout", "timeout", "deployment_id", "engine", "api_key", "api_base", "api_type", "api_version")
+
+
+class OpenAIClient(object):
+    def __init__(self, api_base, api_key, api_type="open_ai", api_version=None, proxy=None, pool_size=10):
+        self.api_base = (api_base or DEFAULT_API_BASE).rstrip("/")
+        self.api_key = api_key
+        self.api_type = api_type
+        self.api_version = api_version
+        self.session = cancellable_session(pool_connections=4, pool_maxsize=pool_size)
+        if proxy:
+            self.session.proxies = {"http": proxy, "https": proxy}
+        if api_type == "azure":
+            self.session.headers["api-key"] = api_key or ""
+        else:
+            self.session.headers["Authorization"] = "Bearer {}".format(api_key or "")
+
+    def url(self, path, deployment_id=None) -> str:
+        """azure的接口路径中带部署名，版本号放在查询参数中"""
+        if self.api_type == "azure":
+            return "{}/openai/deployments/{}{}?api-version={}".format(self.api_base, deployment_id, path, self.api_version)
+        return self.api_base + path
+
+    def post(self, path, cancel_token=None, deployment_id=None, timeout=None, **kwargs) -> requests.Response:
+        """发送原始请求，不检查状态码"""
+        return cancellable_post(self.url(path, deployment_id), cancel_token=cancel_token, session=self.session, timeout=timeout, **kwargs)
+
+    def request(self, path, cancel_token=None, deployment_id=None, timeout=None, **kwargs):
+        """发送请求并解析json响应，返回OpenAIObject，失败时抛出openai.error异常"""
+        try:
+            response = self.post(path, cancel_token=cancel_token, deployment_id=deployment_id, timeout=timeout, **kwargs)
+        except requests.exceptions.Timeout as e:
+            raise openai.error.Timeout("Request timed out: {}".format(e)) from e
+        except requests.exceptions.RequestException as e:
+            raise openai.error.APIConnectionError("Error communicating with OpenAI: {}".format(e)) from e
+        return openai.util.convert_to_openai_object(_parse_response(response))
+
+    def chat_completion(self, messages, cancel_token=None, **args):
+        body = {k: v for k, v in args.items() if k not in SDK_ARGS and v is not None}
+        body["messages"] = messages
+        return self.request("/chat/completions", cancel_token=cancel_token, deployment_id=args.get("deployment_id"),
+                            timeout=args.get("request_timeout"), json=body)
+
+    def create_image(self, prompt, timeout=None, **args):
+        return self.request("/images/generations", timeout=timeout, json=dict(args, prompt=prompt))
+
+    def transcribe(self, file, model="whisper-1", timeout=None):
+        return self.request("/audio/transcriptions", timeout=timeout, files={"file": file}, data={"model": model})
+
+    def speech(self, text, model, voice, timeout=None) -> bytes:
+        """返回音频内容，失败时抛出openai.error异常"""
+        try:
+            response = self.post("/audio/speech", timeout=timeout, json={"model": model, "input": text, "voice": voice})
+        except requests.exceptions.RequestException as e:
+            raise openai.error.APIConnectionError("Error communicating with OpenAI: {}".format(e)) from e
+        if not 200 <= response.status_code < 300:
+            _parse_response(response)
+        return response.content
+
+    def close(self):
+        self.session.close()
+
+
+def _parse_response(response: requests.Response) -> dict:
+    """按状态码转换为与openai sdk相同的异常"""
+    status = response.status_code
+    try:
+        data = response.json()
+    except ValueError:
+        data = None
+    if 200 <= status < 300 and isinstance(data, dict):
+        return data
+    error = (data.get("error") if isinstance(data, dict) else None) or {}
+    if not isinstance(error, dict):
+        error = {"message": str(error)}
+    message = error.get("message") or "HTTP code {} from API ({})".format(status, response.text[:200])
+    args = (response.text, status, data, response.headers)
+    if status == 429:
+        raise openai.error.RateLimitError(message, *args)
+    if status in (400, 404, 415):
+        raise openai.error.InvalidRequestError(message, error.get("param"), error.get("code"), *args)
+    if status == 401:
+        raise openai.error.AuthenticationError(message, *args)
+    if status == 403:
+        raise openai.error.PermissionError(message, *args)
+    if status == 409:
+        raise openai.error.TryAgain(message, *args)
+    if status == 503:
+        raise openai.error.ServiceUnavailableError(message, *args)
+    raise openai.error.APIError(message, *args)
+
+
+_clients = OrderedDict()  # (api_base, api_key, api_type, api_version, proxy) -> OpenAIClient，按最近使用排序
+_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_base=None, api_key=None, api_type="open_ai", api_version=None) -> OpenAIClient:
+    """
+    按(api base, key)取得共享的客户端，api_base、api_key为空时使用open_ai_api_base、open_ai_api_key配置；
+    缓存超过openai_client_cache_size个时关闭最久未使用的客户端
+    """
+    api_base = (api_base or conf().get("open_ai_api_base") or DEFAULT_API_BASE).rstrip("/")
+    api_key = api_key or conf().get("open_ai_api_key")
+    key = (api_base, api_key, api_type, api_version, conf().get("proxy") or None)
+    evicted = []
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+        client = OpenAIClient(api_base, api_key, api_type, api_version, key[-1], conf().get("openai_client_pool_size", 10))
+        _clients[key] = client
+        while len(_clients) > max(1, conf().get("openai_client_cache_size", 32)):
+            evicted.append(_clients.popitem(last=False)[1])
+    for old in evicted:
+        # 正在使用的连接在请求结束后关闭，不影响进行中的请求
+        logger.debug("[OpenAIClient] evict client of {}".format(old.api_base))
+        old.close()
+    return client
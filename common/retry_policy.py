@@ -0,0 +1,186 @@
+"""
+bot请求的重试策略：指数退避加随机抖动，优先遵循服务端返回的Retry-After，所有重试受单次请求的总期限约束；
+每个服务商共享一个熔断器，连续失败后熔断打开，期间直接失败，不再占用处理线程等待
+
+用法:
+    policy = get_retry_policy("chatgpt")
+    deadline = deadline or policy.deadline()
+    try:
+        with policy.attempt() as attempt:  # 熔断打开时抛出CircuitOpenError
+            response = ...
+            if response.status_code >= 500:
+                attempt.fail()  # 没有抛出异常的服务端错误需要手动标记
+    except Exception as e:
+        if policy.is_transient(e) and policy.wait_retry(retry_count, cancel_token, deadline, retry_after_seconds(e), policy.is_rate_limited(e)):
+            return 重试
+"""
+import email.utils
+import random
+import threading
+import time
+
+import requests
+
+from common.cancel_token import cancellable_sleep
+from common.circuit_breaker import CLOSED, CircuitBreaker
+from common.log import logger
+from config import conf
+
+
+class CircuitOpenError(Exception):
+    """服务商熔断中，请求未发出"""
+
+
+class _Attempt(object):
+    def __init__(self, policy):
+        self.policy = policy
+        self.failed = False
+
+    def fail(self):
+        """标记本次请求失败(如返回了5xx状态码)，计入熔断"""
+        self.failed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        breaker = self.policy.breaker
+        if self.failed or (exc is not None and self.policy.is_transient(exc) and not self.policy.is_rate_limited(exc)):
+            breaker.record_failure()
+        elif exc is None:
+            breaker.record_success()
+        else:
+            # 限流(按key或账号的配额)、参数错误等与服务商可用性无关的异常，只释放半开状态的探测名额
+            breaker.record_cancelled()
+        return False
+
+
+class RetryPolicy(object):
+    def __init__(self, provider):
+        self.provider = provider
+        breaker = conf().get("bot_circuit_breaker") or {}
+        self.breaker = CircuitBreaker(breaker.get("failure_threshold", 5), breaker.get("recovery_timeout", 30))
+
+    def attempt(self) -> _Attempt:
+        if not self.breaker.allow():
+            raise CircuitOpenError("{} circuit is open".format(self.provider))
+        return _Attempt(self)
+
+    @staticmethod
+    def deadline() -> float:
+        """一次请求(包括所有重试)的截止时间"""
+        return time.monotonic() + conf().get("bot_retry_deadline", 120)
+
+    @staticmethod
+    def timeout(deadline, default=None):
+        """单次请求的超时时间，不超过剩余期限"""
+        if deadline is None:
+            return default
+        remaining = max(1, deadline - time.monotonic())
+        return min(default, remaining) if default else remaining
+
+    @staticmethod
+    def is_transient(e) -> bool:
+        """超时、连接失败、限流和服务端错误可以重试，除限流外都计入熔断"""
+        if isinstance(e, CircuitOpenError):
+            return False
+        if isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, TimeoutError, ConnectionError)):
+            return True
+        try:
+            import openai.error
+
+            if isinstance(e, (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIError,
+                              openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+                return True
+        except ImportError:
+            pass
+        # anthropic、zhipuai等基于httpx的sdk的超时和连接异常同名
+        if type(e).__name__ in ("APITimeoutError", "APIConnectionError"):
+            return True
+        status = _status_code(e)
+        return status is not None and (status == 429 or status >= 500)
+
+    @staticmethod
+    def is_rate_limited(e) -> bool:
+        try:
+            import openai.error
+
+            if isinstance(e, openai.error.RateLimitError):
+                return True
+        except ImportError:
+            pass
+        return _status_code(e) == 429
+
+    @staticmethod
+    def backoff(retry_count, retry_after=None, rate_limited=False) -> float:
+        """
+        第retry_count次重试前等待的秒数：有Retry-After时按它等待，否则按指数退避，在[上限/2, 上限]之间随机，
+        避免大量请求在同一时刻重试；被限流时退避基数更大
+        """
+        max_delay = conf().get("bot_retry_max_delay", 20)
+        if retry_after is not None:
+            return min(retry_after, max_delay)
+        base = conf().get("bot_retry_base_delay", 2) * (conf().get("bot_retry_rate_limit_factor", 5) if rate_limited else 1)
+        cap = min(max_delay, base * 2 ** retry_count)
+        return random.uniform(cap / 2, cap)
+
+    def wait_retry(self, retry_count, cancel_token=None, deadline=None, retry_after=None, rate_limited=False) -> bool:
+        """
+        判断能否重试，能重试时等待退避时间
+        :return: True表示可以重试；重试次数用完、等待后会超过期限、熔断打开或等待期间被取消时返回False
+        """
+        if retry_count >= conf().get("bot_retry_max_times", 2):
+            return False
+        if self.breaker.state != CLOSED:
+            logger.warn("[RetryPolicy] {} circuit is {}, give up retry".format(self.provider, self.breaker.state))
+            return False
+        delay = self.backoff(retry_count, retry_after, rate_limited)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            logger.warn("[RetryPolicy] {} retry deadline exceeded, give up retry".format(self.provider))
+            return False
+        logger.debug("[RetryPolicy] {} retry after {:.1f}s".format(self.provider, delay))
+        return not cancellable_sleep(cancel_token, delay)
+
+
+def _status_code(e):
+    status = getattr(e, "http_status", None) or getattr(e, "status_code", None)
+    if status is None and type(e).__module__.startswith("google.api_core"):
+        status = getattr(e, "code", None)  # gemini sdk的异常在code中记录http状态码
+    response = getattr(e, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after_seconds(source):
+    """
+    从异常或响应中读取Retry-After头，支持秒数和HTTP日期两种格式，没有时返回None
+    """
+    headers = getattr(source, "headers", None)
+    if not headers and getattr(source, "response", None) is not None:
+        headers = getattr(source.response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_retry_policy(provider) -> RetryPolicy:
+    """每个服务商一个策略，熔断状态在该服务商的所有bot实例之间共享"""
+    with _policies_lock:
+        if provider not in _policies:
+            _policies[provider] = RetryPolicy(provider)
+        return _policies[provider]
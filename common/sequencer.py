@@ -0,0 +1,64 @@
+import threading
+import time
+
+
+class Sequencer(object):
+    """
+    按序号顺序放行并发任务的输出：acquire()按提交顺序分配序号，
+    emit()的输出要等前面的序号全部完成(或队首超时被跳过)后才会交给release
+    """
+
+    def __init__(self, release):
+        self.release = release
+        self.lock = threading.Lock()  # release在锁内调用，保证放行顺序
+        self.next_seq = 0
+        self.head = 0  # 当前队首的序号，小于head的输出直接放行
+        self.head_since = time.monotonic()
+        self.finished = set()
+        self.pending = {}  # seq -> [item]，等待放行的输出
+
+    def acquire(self) -> int:
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            return seq
+
+    def emit(self, seq, item) -> bool:
+        """提交输出，返回False表示需要等待前面的序号"""
+        with self.lock:
+            if seq > self.head:
+                self.pending.setdefault(seq, []).append(item)
+                return False
+            self.release(item)
+            return True
+
+    def finish(self, seq):
+        with self.lock:
+            if seq < self.head:
+                return
+            self.finished.add(seq)
+            self._advance()
+
+    def skip_head(self, timeout) -> bool:
+        """队首超过timeout秒未完成且后面有等待的输出时跳过队首，它之后的输出不再等待"""
+        with self.lock:
+            if not self.pending or time.monotonic() - self.head_since < timeout:
+                return False
+            self.head += 1
+            self.head_since = time.monotonic()
+            self._advance()
+            return True
+
+    def has_pending(self) -> bool:
+        with self.lock:
+            return bool(self.pending)
+
+    def _advance(self):
+        while True:
+            for item in self.pending.pop(self.head, []):
+                self.release(item)
+            if self.head not in self.finished:
+                return
+            self.finished.discard(self.head)
+            self.head += 1
+            self.head_since = time.monotonic()
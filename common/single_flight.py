@@ -0,0 +1,56 @@
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """
+    合并并发的相同请求：同一个key同时只会执行一次fn，其余调用方阻塞等待并共享同一个结果
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0  # 真正执行的次数
+        self.shared = 0  # 复用在途结果的次数
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        执行fn或等待同key的在途调用
+        :return: (result, shared)，shared为True表示结果来自其他线程的在途调用
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"executed": self.executed, "shared": self.shared, "inflight": len(self.calls)}
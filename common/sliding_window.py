@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+class SlidingWindowCounter(object):
+    """
+    环形分桶的滑动窗口计数器，窗口被分成若干个桶，更新和查询都是O(桶数)=O(1)
+    """
+
+    __slots__ = ("bucket_seconds", "counts", "head", "total")
+
+    def __init__(self, window_seconds, buckets=10):
+        self.bucket_seconds = window_seconds / buckets
+        self.counts = [0] * buckets
+        self.head = 0  # 最近一次更新所在的桶序号(按时间递增)
+        self.total = 0
+
+    def _advance(self, now):
+        epoch = int(now // self.bucket_seconds)
+        if epoch <= self.head:
+            return
+        size = len(self.counts)
+        # 清空已滑出窗口的桶，最多清空一圈
+        for e in range(self.head + 1, min(epoch, self.head + size) + 1):
+            i = e % size
+            self.total -= self.counts[i]
+            self.counts[i] = 0
+        self.head = epoch
+
+    def count(self, now=None) -> int:
+        self._advance(now or time.time())
+        return self.total
+
+    def add(self, now=None, n=1) -> int:
+        self._advance(now or time.time())
+        self.counts[self.head % len(self.counts)] += n
+        self.total += n
+        return self.total
+
+
+class SlidingWindowLimiter(object):
+    """
+    按key限流：每个key在窗口内最多通过limit次，被拒绝的请求不计数
+    """
+
+    def __init__(self, window_seconds, buckets=10):
+        self.window_seconds = window_seconds
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.calls = 0
+
+    def acquire(self, limits: dict):
+        """
+        :param limits: key -> limit，limit为0表示不限制
+        :return: 触发限流的key，全部通过时返回None并为所有key计数
+        """
+        now = time.time()
+        with self.lock:
+            for key, limit in limits.items():
+                counter = self.counters.get(key)
+                if limit and counter and counter.count(now) >= limit:
+                    return key
+            for key, limit in limits.items():
+                if not limit:
+                    continue
+                counter = self.counters.get(key)
+                if counter is None:
+                    counter = self.counters[key] = SlidingWindowCounter(self.window_seconds, self.buckets)
+                counter.add(now)
+            self.calls += 1
+            if self.calls % 1000 == 0:
+                self._cleanup(now)
+        return None
+
+    def _cleanup(self, now):
+        # 清除窗口内已经没有计数的key
+        for key in [k for k, c in self.counters.items() if c.count(now) == 0]:
+            del self.counters[key]
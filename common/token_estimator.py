@@ -0,0 +1,202 @@
+"""
+token数计算，按模型选择计算方式(token_estimator配置):
+    exact: 使用tiktoken精确计算，编码器按模型缓存，只适用于OpenAI模型，其他模型或tiktoken不可用时退回approximate
+    approximate: 按文字类型(中日韩字符、英文单词、数字、其他符号)乘以模型系数估算，不依赖分词器
+    character: 按字数计算(旧的方式)
+未配置时OpenAI模型使用exact，其他模型使用approximate
+"""
+import re
+import threading
+from functools import lru_cache
+
+from common import const
+from common.log import logger
+from config import conf
+
+EXACT = "exact"
+APPROXIMATE = "approximate"
+CHARACTER = "character"
+
+# 每个中日韩字符(cjk)、英文单词(word)、数字(digit)、其他符号(other)对应的token数，以及每条消息的固定开销(message)
+# openai系列由token_estimator_benchmark.py以tiktoken(cl100k_base)为准拟合，其他系列取自各模型文档给出的换算规则，
+# 可通过token_estimator_coefficients按模型系列校准
+DEFAULT_COEFFICIENTS = {
+    "openai": {"cjk": 1.14, "word": 1.1, "digit": 0.78, "other": 0.49, "message": 4},
+    "wenxin": {"cjk": 1.0, "word": 1.3, "digit": 0.5, "other": 0.5, "message": 0},  # 中文字 + 其他语种单词数 x 1.3
+    "xunfei": {"cjk": 0.67, "word": 1.25, "digit": 0.5, "other": 0.5, "message": 0},  # 1 token约等于1.5个汉字或0.8个英文单词
+    "qwen": {"cjk": 1.0, "word": 1.0, "digit": 0.5, "other": 0.5, "message": 0},  # 1个token通常对应一个汉字或一个英文单词
+    "zhipu": {"cjk": 0.6, "word": 1.3, "digit": 0.5, "other": 0.5, "message": 0},
+    "moonshot": {"cjk": 0.6, "word": 1.3, "digit": 0.5, "other": 0.5, "message": 0},  # 1 token约等于1.5-2个汉字
+    "gemini": {"cjk": 1.0, "word": 1.3, "digit": 0.5, "other": 0.5, "message": 0},
+    "claude": {"cjk": 1.2, "word": 1.3, "digit": 0.35, "other": 1.0, "message": 4},
+    "default": {"cjk": 1.0, "word": 1.3, "digit": 0.5, "other": 1.0, "message": 0},
+}
+
+MODEL_FAMILIES = [
+    ("gpt", "openai"),
+    ("o1", "openai"),
+    ("text-davinci", "openai"),
+    ("linkai", "openai"),
+    ("wenxin", "wenxin"),
+    ("ernie", "wenxin"),
+    ("xunfei", "xunfei"),
+    ("spark", "xunfei"),
+    ("qwen", "qwen"),
+    ("qwq", "qwen"),
+    ("glm", "zhipu"),
+    ("zhipu", "zhipu"),
+    ("moonshot", "moonshot"),
+    ("gemini", "gemini"),
+    ("claude", "claude"),
+]
+
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+_WORD = re.compile(r"[A-Za-z]+")
+_DIGIT = re.compile(r"[0-9]")
+_SPACE = re.compile(r"\s")
+
+_encodings = {}  # 模型 -> tiktoken编码器，加载失败时为None，不再重复加载
+_encodings_lock = threading.Lock()  # 加载编码文件需要数秒，并发的首次调用只加载一次
+
+
+def model_family(model) -> str:
+    model = (model or "").lower()
+    for prefix, family in MODEL_FAMILIES:
+        if model.startswith(prefix):
+            return family
+    return "default"
+
+
+def estimator_for(model) -> str:
+    """配置中按模型名匹配，其次按最长的模型名前缀匹配，最后使用default"""
+    modes = conf().get("token_estimator") or {}
+    if model in modes:
+        return modes[model]
+    prefixes = [prefix for prefix in modes if prefix != "default" and model and model.startswith(prefix)]
+    if prefixes:
+        return modes[max(prefixes, key=len)]
+    if "default" in modes:
+        return modes["default"]
+    return EXACT if model_family(model) == "openai" else APPROXIMATE
+
+
+def coefficients_for(model) -> dict:
+    family = model_family(model)
+    coefficients = dict(DEFAULT_COEFFICIENTS[family])
+    overrides = conf().get("token_estimator_coefficients") or {}
+    coefficients.update(overrides.get(family) or {})
+    coefficients.update(overrides.get(model) or {})
+    return coefficients
+
+
+@lru_cache(maxsize=4096)
+def _script_counts(text) -> tuple:
+    words = _WORD.findall(text)
+    cjk = len(_CJK.findall(text))
+    digits = len(_DIGIT.findall(text))
+    other = len(text) - cjk - digits - sum(map(len, words)) - len(_SPACE.findall(text))
+    return cjk, len(words), digits, other
+
+
+def approximate_tokens(text, coefficients) -> float:
+    if not text:
+        return 0
+    cjk, words, digits, other = _script_counts(text)
+    return cjk * coefficients["cjk"] + words * coefficients["word"] + digits * coefficients["digit"] + other * coefficients["other"]
+
+
+def _encoding(model):
+    if model not in _encodings:
+        with _encodings_lock:
+            if model not in _encodings:
+                _encodings[model] = _load_encoding(model)
+    return _encodings[model]
+
+
+def _load_encoding(model):
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            logger.debug("Warning: model not found. Using cl100k_base encoding.")
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("[TokenEstimator] load tiktoken encoding for {} failed, use approximate count: {}".format(model, e))
+        return None
+
+
+def preload(model):
+    """提前加载模型对应的编码器，只有使用exact计算的模型需要"""
+    if estimator_for(model) == EXACT and model_family(model) == "openai":
+        _encoding(model)
+
+
+@lru_cache(maxsize=4096)
+def _exact_tokens(model, text) -> int:
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+def count_tokens(text, model) -> int:
+    """单段文本的token数"""
+    mode = estimator_for(model)
+    if mode == CHARACTER:
+        return len(text)
+    if mode == EXACT and model_family(model) == "openai" and _encoding(model) is not None:
+        return _exact_tokens(model, text)
+    return int(approximate_tokens(text, coefficients_for(model)) + 0.5)
+
+
+def num_tokens_from_messages(messages, model, key="content") -> int:
+    """消息列表的token数，key为消息正文的字段名"""
+    mode = estimator_for(model)
+    if mode == CHARACTER:
+        return sum(len(message[key]) for message in messages)
+    if mode == EXACT and model_family(model) == "openai":
+        tokens = _openai_tokens_from_messages(messages, model)
+        if tokens is not None:
+            return tokens
+    coefficients = coefficients_for(model)
+    tokens = sum(approximate_tokens(message[key], coefficients) + coefficients["message"] for message in messages)
+    return int(tokens + 0.5)
+
+
+# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+def _openai_tokens_from_messages(messages, model):
+    """使用tiktoken精确计算，编码器不可用时返回None"""
+    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", const.LINKAI_35]:
+        return _openai_tokens_from_messages(messages, model="gpt-3.5-turbo")
+    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+                   const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
+        return _openai_tokens_from_messages(messages, model="gpt-4")
+    if model == "gpt-3.5-turbo":
+        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        tokens_per_name = -1  # if there's a name, the role is omitted
+    elif model == "gpt-4":
+        tokens_per_message = 3
+        tokens_per_name = 1
+    else:
+        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+        return _openai_tokens_from_messages(messages, model="gpt-3.5-turbo")
+    if _encoding(model) is None:
+        return None
+    num_tokens = 0
+    for message in messages:
+        num_tokens += tokens_per_message
+        for key, value in message.items():
+            num_tokens += _exact_tokens(model, value)
+            if key == "name":
+                num_tokens += tokens_per_name
+    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return num_tokens
+
+
+def num_tokens_by_character(messages):
+    """Returns the number of tokens used by a list of messages."""
+    tokens = 0
+    for msg in messages:
+        tokens += len(msg["content"])
+    return tokens
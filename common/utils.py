@@ -4,6 +4,7 @@ import re
 from multiprocessing.connection import Connection
 from urllib.parse import urlparse
 from PIL import Image
+from common.compute_pool import compute_pool
 from common.log import logger
 import xml.sax.saxutils as saxutils
 
@@ -47,16 +48,25 @@ def fsize(file):
 def compress_imgfile(file, max_size):
     if fsize(file) <= max_size:
         return file
-    file.seek(0)
-    img = Image.open(file)
+    return compute_pool().run_on_buffer(_compress_image, file, max_size)
+
+
+def _compress_image(src, dst, max_size):
+    """在计算进程池中执行，src、dst为文件路径或文件对象"""
+    img = Image.open(src)
     rgb_image = img.convert("RGB")
     quality = 95
     while True:
         out_buf = io.BytesIO()
         rgb_image.save(out_buf, "JPEG", quality=quality)
         if fsize(out_buf) <= max_size:
-            return out_buf
+            break
         quality -= 5
+    if isinstance(dst, str):
+        with open(dst, "wb") as f:
+            f.write(out_buf.getbuffer())
+    else:
+        dst.write(out_buf.getbuffer())
 
 
 def split_string_by_utf8_length(string, max_length, max_split=0):
@@ -82,19 +92,19 @@ def get_path_suffix(path):
 
 
 def convert_webp_to_png(webp_image):
-    from PIL import Image
     try:
-        webp_image.seek(0)
-        img = Image.open(webp_image).convert("RGBA")
-        png_image = io.BytesIO()
-        img.save(png_image, format="PNG")
-        png_image.seek(0)
-        return png_image
+        return compute_pool().run_on_buffer(_webp_to_png, webp_image)
     except Exception as e:
         logger.error(f"Failed to convert WEBP to PNG: {e}")
         raise
 
 
+def _webp_to_png(src, dst):
+    """在计算进程池中执行，src、dst为文件路径或文件对象"""
+    img = Image.open(src).convert("RGBA")
+    img.save(dst, format="PNG")
+
+
 def remove_markdown_symbol(text: str):
     # 移除markdown格式，目前先移除**
     if not text:
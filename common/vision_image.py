@@ -0,0 +1,114 @@
+"""
+识图请求的图片预处理：缩小到模型能利用的最大分辨率并重新压缩，按内容哈希缓存编码后的data url
+
+以OpenAI的高精度模式为例，图片会先缩放到2048x2048以内，再把短边缩放到768，超出部分只增加上传耗时
+"""
+import base64
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from common.compute_pool import compute_pool
+from common.log import logger
+from config import conf
+
+MAX_CACHE_ENTRIES = 64  # 缓存的data url数量上限，每个约几百KB
+
+_cache = OrderedDict()  # 内容哈希 -> (data url, 过期时间)
+_cache_lock = threading.Lock()
+_stats = {"requests": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+def image_to_data_url(path) -> str:
+    """读取图片文件，返回预处理后的data url，相同内容的图片在缓存有效期内只处理一次"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    key = hashlib.sha256(raw).hexdigest()
+    now = time.monotonic()
+    with _cache_lock:
+        _stats["requests"] += 1
+        cached = _cache.get(key)
+        if cached and cached[1] > now:
+            _cache.move_to_end(key)
+            _stats["cache_hits"] += 1
+            logger.debug("[VisionImage] cache hit, sha256={}".format(key[:12]))
+            return cached[0]
+    data_url, size = _encode(raw)
+    with _cache_lock:
+        _stats["bytes_in"] += len(raw)
+        _stats["bytes_out"] += size
+        _cache[key] = (data_url, now + conf().get("vision_image_cache_ttl", 600))
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    logger.info("[VisionImage] {} -> {} bytes, saved {:.0%}".format(len(raw), size, 1 - size / len(raw) if raw else 0))
+    return data_url
+
+
+def _encode(raw) -> tuple:
+    fmt = (conf().get("vision_image_format") or "JPEG").upper()
+    try:
+        out = compute_pool().run_on_buffer(_prepare_image, io.BytesIO(raw), fmt, conf().get("vision_image_quality", 85),
+                                           conf().get("vision_image_max_long_side", 2048), conf().get("vision_image_max_short_side", 768))
+        data = out.getvalue()
+    except Exception as e:
+        logger.warning("[VisionImage] prepare image failed, use original: {}".format(e))
+        data = b""
+    if data and len(data) < len(raw):
+        mime = "image/" + fmt.lower()
+    else:
+        # 已经足够小或无法处理(如动图)的图片原样发送
+        data = raw
+        mime = Image.MIME.get(_image_format(raw), "image/jpeg")
+    return "data:{};base64,{}".format(mime, base64.b64encode(data).decode("utf-8")), len(data)
+
+
+def _image_format(raw):
+    try:
+        return Image.open(io.BytesIO(raw)).format
+    except Exception:
+        return None
+
+
+def _prepare_image(src, dst, fmt, quality, max_long_side, max_short_side):
+    """在计算进程池中执行：按长边、短边上限等比缩小，转换为fmt格式，动图不处理"""
+    img = Image.open(src)
+    if getattr(img, "is_animated", False):
+        return
+    size = _target_size(img.size, max_long_side, max_short_side)
+    if size != img.size:
+        img.draft("RGB", size)  # JPEG解码时直接按比例缩小，减少解码耗时
+    # 手机照片的方向记录在EXIF中，重新编码会丢失EXIF，需要先按方向旋转
+    img = ImageOps.exif_transpose(img)
+    size = _target_size(img.size, max_long_side, max_short_side)
+    if size != img.size:
+        img = img.resize(size, Image.LANCZOS)
+    if fmt == "JPEG":
+        if img.mode in ("RGBA", "LA", "P"):
+            # JPEG不支持透明通道，铺白色背景
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA")
+    img.save(dst, format=fmt, quality=quality)
+
+
+def _target_size(size, max_long_side, max_short_side) -> tuple:
+    width, height = size
+    scale = min(1.0, max_long_side / max(width, height), max_short_side / min(width, height))
+    if scale >= 1:
+        return size
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def stats() -> dict:
+    with _cache_lock:
+        return dict(_stats, cache_entries=len(_cache))
@@ -0,0 +1,90 @@
+"""
+启动预热：提前创建配置的bot、加载tokenizer编码、连接各api服务地址，避免重启或切换模型后的第一个用户承担这些耗时
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+from common import const, token_estimator
+from common.log import logger
+from common.openai_client import OpenAIClient, get_openai_client
+from config import conf
+
+# 使用共享连接池(common.openai_client)的bot，预连接这些bot请求时使用的客户端，建立的连接留在池中复用
+POOLED_BOT_TYPES = (const.CHATGPT, const.OPEN_AI, const.CHATGPTONAZURE, const.MOONSHOT)
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="warmup")
+
+
+def warm_up(bridge, timeout=None) -> dict:
+    """
+    并行执行各项预热，最多等待timeout秒，超时未完成的继续在后台执行
+    :return: 已完成的各项预热的耗时(秒)，失败的为None
+    """
+    timeout = conf().get("warmup_timeout", 30) if timeout is None else timeout
+    tasks = {"bot:" + typename: (bridge.get_bot, typename) for typename in bot_types_to_warm()}
+    tasks["tokenizer"] = (token_estimator.preload, conf().get("model"))
+    for client in api_clients(bridge):
+        tasks["preconnect:" + urlparse(client.api_base).netloc] = (preconnect, client)
+
+    start = time.time()
+    futures = {_executor.submit(_timed, name, fn, arg): name for name, (fn, arg) in tasks.items()}
+    done, not_done = wait(futures, timeout=timeout)
+    timings = {futures[f]: f.result() for f in done}
+    logger.info("[Warmup] finished in {:.2f}s: {}".format(time.time() - start, ", ".join(
+        "{}={}".format(name, "failed" if cost is None else "{:.2f}s".format(cost)) for name, cost in timings.items())))
+    if not_done:
+        logger.warning("[Warmup] still running in background: {}".format(", ".join(futures[f] for f in not_done)))
+    return timings
+
+
+def _timed(name, fn, arg):
+    start = time.time()
+    try:
+        fn(arg)
+    except Exception as e:
+        logger.warning("[Warmup] {} failed: {}".format(name, e))
+        return None
+    return time.time() - start
+
+
+def bot_types_to_warm() -> list:
+    """只预热会用到的bot：语音相关的bot在开启对应功能时才创建"""
+    typenames = ["chat"]
+    if conf().get("speech_recognition") or conf().get("group_speech_recognition"):
+        typenames.append("voice_to_text")
+    if conf().get("voice_reply_voice") or conf().get("always_reply_voice"):
+        typenames.append("text_to_voice")
+    if conf().get("translate"):
+        typenames.append("translate")
+    return typenames
+
+
+def api_clients(bridge) -> list:
+    """主bot和备用bot请求时使用的共享客户端，与各bot中get_openai_client的参数一致，按api base和key去重"""
+    bot_types = [bridge.get_bot_type("chat")]
+    for item in conf().get("bot_failover") or []:
+        bot_types.append(item if isinstance(item, str) else item.get("bot_type"))
+    clients = []
+    for bot_type in bot_types:
+        if bot_type not in POOLED_BOT_TYPES:
+            continue
+        if bot_type == const.MOONSHOT:
+            api_base = conf().get("moonshot_base_url", "https://api.moonshot.cn/v1/chat/completions")
+            if api_base.endswith("/chat/completions"):
+                api_base = api_base[:-len("/chat/completions")]
+            candidates = [get_openai_client(api_base, conf().get("moonshot_api_key"))]
+        else:
+            api_type, api_version = ("azure", conf().get("azure_api_version", "2023-06-01-preview")) if bot_type == const.CHATGPTONAZURE else ("open_ai", None)
+            entries = conf().get("open_ai_api_keys") if bot_type != const.OPEN_AI else None
+            keys = [(None, entry) if isinstance(entry, str) else (entry.get("api_base"), entry.get("key")) for entry in entries or []]
+            candidates = [get_openai_client(api_base, key, api_type, api_version) for api_base, key in keys or [(None, None)]]
+        for client in candidates:
+            if client not in clients:
+                clients.append(client)
+    return clients
+
+
+def preconnect(client: OpenAIClient):
+    """通过客户端自己的session完成DNS解析、TCP和TLS握手，任何HTTP响应都算连接成功，连接保留在池中供之后的请求复用"""
+    client.session.head(client.api_base, timeout=(5, 5), allow_redirects=False)
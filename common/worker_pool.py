@@ -0,0 +1,56 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WorkerPool(ThreadPoolExecutor):
+    """
+    带统计的线程池，用于按负载类型隔离的处理线程池(舱壁)
+    """
+
+    def __init__(self, name, max_workers, initializer=None):
+        super().__init__(max_workers=max_workers, thread_name_prefix="{}_pool".format(name), initializer=initializer)
+        self.name = name
+        self._stats_lock = threading.Lock()
+        self.active = 0  # 正在执行的任务数
+        self.submitted = 0
+        self.completed = 0
+        self.peak_queued = 0
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self.submitted += 1
+        future = super().submit(self._run, fn, *args, **kwargs)
+        self.peak_queued = max(self.peak_queued, self._work_queue.qsize())
+        return future
+
+    def _run(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self.active -= 1
+                self.completed += 1
+
+    def queue_depth(self) -> int:
+        return self._work_queue.qsize()
+
+    def has_capacity(self) -> bool:
+        """是否有空闲线程，提交的新任务不需要排队"""
+        return self.active + self.queue_depth() < self._max_workers
+
+    def saturation(self) -> float:
+        """正在执行的任务占线程数的比例，1表示已满，新任务需要排队"""
+        return self.active / self._max_workers
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self._max_workers,
+            "active": self.active,
+            "queued": self.queue_depth(),
+            "peak_queued": self.peak_queued,
+            "saturation": round(self.saturation(), 2),
+            "submitted": self.submitted,
+            "completed": self.completed,
+        }
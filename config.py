@@ -15,7 +15,12 @@ available_setting = {
     "open_ai_api_key": "",  # openai api key
     # openai apibase，当use_azure_chatgpt为true时，需要设置对应的api base
     "open_ai_api_base": "https://api.openai.com/v1",
+    "open_ai_api_keys": [],  # [可选] 多个api key，每项为key字符串或{"key": "", "api_base": "", "rpm": 0, "tpm": 0}，配置后在这些key之间调度，代替open_ai_api_key
+    "api_key_strategy": "least_loaded",  # 多个key的选择方式: least_loaded(负载最低)、round_robin(轮询)
+    "api_key_quarantine_seconds": {"rate_limit": 20, "auth": 600},  # key被限流(未返回Retry-After时)、鉴权失败后暂停使用的秒数，期间请求换用其他key
     "proxy": "",  # openai使用的代理
+    "openai_client_pool_size": 10,  # 每个(api base, key)的客户端保持的最大连接数
+    "openai_client_cache_size": 32,  # 最多缓存多少个(api base, key)的客户端，超过后关闭最久未使用的
     # chatgpt模型， 当use_azure_chatgpt为true时，其名称为Azure上model deployment名称
     "model": "gpt-3.5-turbo",  # 可选择: gpt-4o, pt-4o-mini, gpt-4-turbo, claude-3-sonnet, wenxin, moonshot, qwen-turbo, xunfei, glm-4, minimax, gemini等模型，全部可选模型详见common/const.py文件
     "bot_type": "",  # 可选配置，使用兼容openai格式的三方服务时候，需填"chatGPT"。bot具体名称详见common/const.py文件列出的bot_type，如不填根据model名称判断，
@@ -48,14 +53,60 @@ available_setting = {
     "azure_openai_dalle_deployment_id":"", # [可选] azure openai 用于回复图片的资源 deployment id，默认使用 text_to_image
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
-    "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1时由reply_in_order保证回复顺序
+    "reply_in_order": True,  # concurrency_in_session大于1时，同一会话的回复是否按消息顺序发送
+    "reply_order_timeout": 30,  # 按顺序发送时，最早的消息超过该秒数仍未回复则不再等待它，先发送后面的回复
+    "merge_msg_window": 0,  # 同一用户连续发送的文本消息合并窗口(秒)，窗口内的消息合并为一次请求，0表示不合并，语音和#指令不参与合并
+    "merge_msg_max_wait": 5,  # 合并消息的最长等待时间(秒)，超过后即使仍有新消息也立即处理
+    "max_queue_per_session": 0,  # 单个会话最多排队的消息数，0表示不限制
+    "max_queue_total": 0,  # 所有会话合计最多排队的消息数，0表示不限制
+    "queue_overflow_policy": "drop_oldest",  # 队列超限时的处理方式: drop_oldest(丢弃最早的消息), drop_newest(丢弃新消息), reply_busy(丢弃新消息并回复繁忙提示)
+    "queue_busy_reply": "当前消息太多，请稍后再试",  # reply_busy策略下的提示语
+    "max_queue_age": 0,  # 消息排队超过该秒数后不再处理，0表示不限制
+    "worker_pool_sizes": {"text": 8, "media": 2, "image": 2, "plugin": 2},  # 按负载类型隔离的处理线程数: 文本对话、语音/图片等媒体、图片生成、插件长任务
+    "compute_pool_size": 2,  # 语音转码、图片压缩等CPU密集任务的进程数，0表示在处理线程中直接执行
+    "send_retry_max_attempts": 3,  # 消息发送失败时最多尝试的次数(含首次)，超过后丢弃并记录日志
+    "send_retry_base_delay": 3,  # 发送重试的初始间隔(秒)，之后按指数退避
+    "send_retry_max_delay": 60,  # 发送重试的最大间隔(秒)
+    "send_retry_jitter": 0.2,  # 发送重试间隔的随机抖动比例
+    "flood_control_window": 60,  # 限流的滑动窗口长度(秒)
+    "flood_limit_group": {"default": {"group": 0, "user": 0}},  # 群聊限流: 窗口内每个群(group)、每个群成员(user)最多触发回复的次数，0表示不限制，可按群名单独设置，如{"default": {...}, "群名": {"group": 60, "user": 5}}
+    "flood_limit_private": 0,  # 私聊限流: 窗口内每个私聊用户最多触发回复的次数，0表示不限制
+    "flood_cooldown_reply": "",  # 触发限流时的提示语，每个窗口只提示一次，为空则静默丢弃
+    "schedule_weights": {"admin": 8, "vip": 4, "private": 2, "priority_group": 2, "group": 1},  # 会话间加权公平调度的权重: 管理命令、user_datas中标记vip的用户、私聊、priority_group_list中的群、其他群，同一个群的多个会话共享一份权重
+    "priority_group_list": [],  # 调度时优先处理的群名称
+    "single_flight_reply": False,  # 是否合并不同会话中同时在途的相同提问(无历史上下文时)，只请求一次模型
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
+    "image_job_max_pending": 10,  # 同时进行的异步作图任务(azure dall-e-2、midjourney等)总数上限
+    "image_job_max_pending_per_user": 2,  # 每个用户同时进行的异步作图任务数上限
+    "image_job_poll_interval": 2,  # 查询作图任务状态的初始间隔(秒)，之后每次乘以1.5
+    "image_job_poll_max_interval": 15,  # 查询作图任务状态的最大间隔(秒)
+    "image_job_poll_workers": 4,  # 查询作图任务状态的线程数
+    "image_job_timeout": 120,  # azure dall-e-2作图任务的超时时间(秒)
+    "vision_image_max_long_side": 2048,  # 识图请求的图片长边上限(像素)，超过时等比缩小
+    "vision_image_max_short_side": 768,  # 识图请求的图片短边上限(像素)，OpenAI高精度模式最多使用768
+    "vision_image_format": "JPEG",  # 识图请求的图片重新压缩的格式，支持JPEG、WEBP
+    "vision_image_quality": 85,  # 识图请求的图片压缩质量
+    "vision_image_cache_ttl": 600,  # 处理后的识图图片按内容缓存的秒数
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_max_memory_mb": 0,  # 所有会话上下文占用内存的上限(MB)，超过后淘汰最久未使用的会话，0表示不限制
+    "session_max_count": 0,  # 最多保存的会话数，超过后淘汰最久未使用的会话，0表示不限制
+    "session_backend": "memory",  # 会话持久化后端: memory(只保存在内存中，重启后丢失), sqlite, lmdb(需安装lmdb)，内存中的会话作为读缓存
+    "session_backend_path": "",  # 持久化文件路径，默认为appdata_dir下的sessions.db或sessions.lmdb
+    "session_flush_interval": 2,  # 会话延迟批量写入的间隔(秒)
+    "session_flush_batch_size": 100,  # 积压的会话数达到该值时立即写入
+    "session_lmdb_map_size_mb": 1024,  # lmdb数据库的最大容量(MB)
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "conversation_summary": False,  # 对话接近conversation_max_tokens时，是否在后台把较早的对话压缩成摘要，而不是直接丢弃
+    "conversation_summary_model": "",  # 生成摘要使用的模型，为空时使用对话模型，可配置更便宜的模型
+    "conversation_summary_threshold": 0.8,  # 对话token数超过conversation_max_tokens的该比例时开始生成摘要
+    "conversation_summary_keep_turns": 2,  # 生成摘要时保留最近几轮对话原文
+    "token_estimator": {},  # 按模型(或模型名前缀、default)指定token计算方式: exact(tiktoken精确计算，仅OpenAI模型)、approximate(按文字类型估算)、character(按字数)，未配置时OpenAI模型用exact，其他模型用approximate
+    "token_estimator_coefficients": {},  # 按模型系列或模型名校准approximate的系数，如 {"qwen": {"cjk": 0.8, "word": 1.2}}，可选项见common/token_estimator.py
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
@@ -65,6 +116,22 @@ available_setting = {
     "frequency_penalty": 0,
     "presence_penalty": 0,
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
+    "bot_failover": [],  # 主模型失败或超时后依次尝试的备用bot，每项为bot_type或{"bot_type": "moonshot", "model": "moonshot-v1-8k"}，如 ["moonshot", "dashscope"]
+    "bot_hedging": False,  # 主模型超过其p95耗时未返回时，同时请求下一个备用bot，取先返回的结果
+    "bot_circuit_breaker": {"failure_threshold": 5, "recovery_timeout": 30},  # 每个bot连续失败多少次后熔断，熔断多少秒后再放行一个探测请求
+    "bot_timeout_min": 10,  # 按耗时p99自适应调整的单个bot超时时间下限(秒)
+    "bot_timeout_max": 180,  # 单个bot超时时间上限(秒)，耗时样本不足时使用
+    "bot_retry_max_times": 2,  # bot请求失败(超时、限流、服务端错误)后的最大重试次数
+    "bot_retry_base_delay": 2,  # 重试的指数退避基数(秒)，第n次重试前等待base*2^n秒左右
+    "bot_retry_max_delay": 20,  # 单次重试等待时间上限(秒)，服务端返回的Retry-After也不超过此值
+    "bot_retry_rate_limit_factor": 5,  # 被限流时退避基数放大的倍数
+    "bot_retry_deadline": 120,  # 一次请求(包括所有重试)的总期限(秒)，超过后不再重试
+    "warmup": True,  # 启动和切换模型时预先创建bot、加载tokenizer、连接api服务地址，减少第一个请求的等待
+    "warmup_timeout": 30,  # 启动时最多等待预热多少秒，超时未完成的在后台继续
+    "metering": True,  # 是否按用户、群、模型统计请求数、token用量和耗时，用于计费
+    "metering_sink": "sqlite",  # 用量定期写入的位置: sqlite, csv, 为空则只保存在内存中
+    "metering_path": "",  # 用量文件路径，默认为appdata_dir下的usage.db或usage.csv
+    "metering_flush_interval": 60,  # 用量写入的间隔(秒)
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
@@ -77,6 +144,7 @@ available_setting = {
     "xunfei_api_secret": "",  # 讯飞 API secret
     "xunfei_domain": "",  # 讯飞模型对应的domain参数，Spark4.0 Ultra为 4.0Ultra，其他模型详见: https://www.xfyun.cn/doc/spark/Web.html
     "xunfei_spark_url": "",  # 讯飞模型对应的请求地址，Spark4.0 Ultra为 wss://spark-api.xf-yun.com/v4.0/chat，其他模型参考详见: https://www.xfyun.cn/doc/spark/Web.html
+    "xunfei_spare_connections": 1,  # 预先建立的讯飞websocket空闲连接数，减少每次请求的建连耗时，0表示不预建
     # claude 配置
     "claude_api_cookie": "",
     "claude_uuid": "",
@@ -0,0 +1,290 @@
+"""
+本地的OpenAI兼容模拟服务，用于压测和耗时测试，不产生真实的模型费用，也不需要联网
+
+实现了 /v1/chat/completions(含流式)、/v1/images/generations、/v1/audio/transcriptions、/v1/audio/translations、
+/v1/audio/speech，以及azure格式的 /openai/deployments/{deployment_id}/chat/completions；
+耗时分布、回复token数、429/500/超时的比例都可以配置，/mock/stats 查看请求统计
+
+回复内容由请求内容和随机种子决定，相同的请求总是得到相同的回复；耗时和错误按种子生成的随机序列抽取，
+顺序执行的压测可以完全复现
+
+用法:
+    python mock_llm_server.py --port 8000 --latency lognormal:-0.5,0.4 --completion-tokens uniform:20,200 --error-429 0.05
+    然后在config.json中配置 "open_ai_api_base": "http://127.0.0.1:8000/v1"，open_ai_api_key任意填写
+"""
+import argparse
+import asyncio
+import base64
+import email.parser
+import email.policy
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# 1x1的透明png
+PNG_1X1 = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+# 128kbps、44.1kHz的静音mp3帧，约26ms
+MP3_SILENT_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+WORDS = ("the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "mock", "reply", "token", "latency",
+         "bench", "load", "test", "chat", "wechat", "model", "stream", "cow")
+
+# 各分布的参数个数
+PARAM_COUNTS = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exponential": 1}
+
+
+class Distribution(object):
+    """
+    按"名称:参数"解析的随机分布，如 fixed:0.5、uniform:0.2,1.0、normal:0.8,0.2、lognormal:-0.5,0.4、exponential:0.5
+    """
+
+    def __init__(self, spec):
+        name, _, params = str(spec).partition(":")
+        if not params:
+            # 只写一个数字时为固定值
+            name, params = "fixed", name
+        self.spec = spec
+        self.name = name
+        if name not in PARAM_COUNTS:
+            raise ValueError("unknown distribution: {}".format(spec))
+        try:
+            self.params = [float(p) for p in params.split(",")]
+        except ValueError:
+            raise ValueError("invalid distribution parameters: {}".format(spec))
+        if len(self.params) != PARAM_COUNTS[name]:
+            raise ValueError("{} distribution takes {} parameter(s), got {}: {}".format(name, PARAM_COUNTS[name], len(self.params), spec))
+
+    def sample(self, rng: random.Random) -> float:
+        p = self.params
+        if self.name == "fixed":
+            value = p[0]
+        elif self.name == "uniform":
+            value = rng.uniform(p[0], p[1])
+        elif self.name == "normal":
+            value = rng.gauss(p[0], p[1])
+        elif self.name == "lognormal":
+            value = rng.lognormvariate(p[0], p[1])
+        else:
+            value = rng.expovariate(1 / p[0]) if p[0] > 0 else 0
+        return max(0.0, value)
+
+
+class MockState(object):
+    def __init__(self, args):
+        self.args = args
+        self.latency = Distribution(args.latency)
+        self.token_interval = Distribution(args.token_interval)
+        self.completion_tokens = Distribution(args.completion_tokens)
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "429": 0, "500": 0, "timeout": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.started_at = time.time()
+
+    def draw(self):
+        """按顺序抽取本次请求的错误类型、首个token前的耗时和每个分片的间隔"""
+        with self.lock:
+            self.stats["requests"] += 1
+            r = self.rng.random()
+            latency = self.latency.sample(self.rng)
+            interval = self.token_interval.sample(self.rng)
+        error = None
+        if r < self.args.error_429:
+            error = "429"
+        elif r < self.args.error_429 + self.args.error_500:
+            error = "500"
+        elif r < self.args.error_429 + self.args.error_500 + self.args.timeout_rate:
+            error = "timeout"
+        if error:
+            self.count(error)
+        return error, latency, interval
+
+    def count(self, field, value=1):
+        with self.lock:
+            self.stats[field] += value
+
+
+def _seeded_rng(seed, *parts) -> random.Random:
+    digest = hashlib.sha256(json.dumps([seed, *parts], ensure_ascii=False, sort_keys=True).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def _prompt_tokens(messages) -> int:
+    """粗略按4个字符一个token估算"""
+    chars = 0
+    for message in messages or []:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        chars += len(str(content or "")) + 4
+    return max(1, chars // 4)
+
+
+def _uploaded_file(content_type, body) -> bytes:
+    """取出multipart表单中file字段的内容，用标准库解析，不依赖python-multipart"""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+    for part in message.iter_parts() if message.is_multipart() else []:
+        if part.get_param("name", header="content-disposition") == "file":
+            return part.get_payload(decode=True) or b""
+    return b""
+
+
+def create_app(args) -> FastAPI:
+    state = MockState(args)
+    app = FastAPI(title="Mock OpenAI-compatible LLM server")
+
+    async def simulate_error(error):
+        """返回错误响应，不出错时返回None"""
+        if error == "429":
+            return JSONResponse({"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                                status_code=429, headers={"Retry-After": str(args.retry_after)})
+        if error == "500":
+            return JSONResponse({"error": {"message": "The server had an error (mock)", "type": "server_error"}}, status_code=500)
+        if error == "timeout":
+            # 挂起到客户端超时，客户端没有超时设置时最终返回504
+            await asyncio.sleep(args.timeout_seconds)
+            return JSONResponse({"error": {"message": "Gateway timeout (mock)", "type": "timeout"}}, status_code=504)
+        return None
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        error, latency, interval = state.draw()
+        response = await simulate_error(error)
+        if response is not None:
+            return response
+        messages = body.get("messages") or []
+        model = body.get("model") or "mock"
+        rng = _seeded_rng(args.seed, model, messages)
+        n_tokens = max(1, int(state.completion_tokens.sample(rng)))
+        words = [rng.choice(WORDS) for _ in range(n_tokens)]
+        prompt_tokens = _prompt_tokens(messages)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": n_tokens, "total_tokens": prompt_tokens + n_tokens}
+        state.count("prompt_tokens", prompt_tokens)
+        state.count("completion_tokens", n_tokens)
+        completion_id = "chatcmpl-mock-" + uuid.uuid4().hex[:12]
+        created = int(time.time())
+        await asyncio.sleep(latency)
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        def chunk(delta, finish_reason=None, **extra):
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra}
+            return "data: {}\n\n".format(json.dumps(data, ensure_ascii=False))
+
+        async def events():
+            yield chunk({"role": "assistant", "content": ""})
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(interval)
+                yield chunk({"content": word if i == 0 else " " + word})
+            yield chunk({}, "stop")
+            if include_usage:
+                yield "data: {}\n\n".format(json.dumps({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                                                        "model": model, "choices": [], "usage": usage}))
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    app.post("/v1/chat/completions")(chat_completions)
+    app.post("/openai/deployments/{deployment_id}/chat/completions")(chat_completions)
+
+    @app.post("/v1/images/generations")
+    async def images_generations(request: Request):
+        body = await request.json()
+        error, latency, _ = state.draw()
+        response = await simulate_error(error)
+        if response is not None:
+            return response
+        await asyncio.sleep(latency)
+        n = int(body.get("n") or 1)
+        if body.get("response_format") == "b64_json":
+            data = [{"b64_json": base64.b64encode(PNG_1X1).decode("utf-8")} for _ in range(n)]
+        else:
+            base_url = str(request.base_url).rstrip("/")
+            data = [{"url": "{}/mock/images/{}.png".format(base_url, uuid.uuid4().hex[:12])} for _ in range(n)]
+        return {"created": int(time.time()), "data": data}
+
+    @app.get("/mock/images/{name}")
+    async def image_file(name: str):
+        return Response(PNG_1X1, media_type="image/png")
+
+    async def transcriptions(request: Request):
+        content = _uploaded_file(request.headers.get("content-type", ""), await request.body())
+        error, latency, _ = state.draw()
+        response = await simulate_error(error)
+        if response is not None:
+            return response
+        await asyncio.sleep(latency)
+        rng = _seeded_rng(args.seed, hashlib.sha256(content).hexdigest())
+        return {"text": " ".join(rng.choice(WORDS) for _ in range(8))}
+
+    app.post("/v1/audio/transcriptions")(transcriptions)
+    app.post("/v1/audio/translations")(transcriptions)
+
+    @app.post("/v1/audio/speech")
+    async def speech(request: Request):
+        body = await request.json()
+        error, latency, _ = state.draw()
+        response = await simulate_error(error)
+        if response is not None:
+            return response
+        await asyncio.sleep(latency)
+        # 按输入长度生成静音，每个字约0.1秒
+        frames = max(1, int(len(body.get("input") or "") * 0.1 / 0.026))
+        return Response(MP3_SILENT_FRAME * frames, media_type="audio/mpeg")
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]}
+
+    @app.get("/mock/stats")
+    async def stats():
+        with state.lock:
+            return dict(state.stats, uptime=time.time() - state.started_at)
+
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible LLM server for load and latency testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=0, help="random seed of replies, latencies and errors")
+    parser.add_argument("--latency", default="fixed:0.5", help="seconds before the first token, e.g. uniform:0.2,1.0, lognormal:-0.5,0.4")
+    parser.add_argument("--token-interval", default="fixed:0.02", help="seconds between streamed chunks")
+    parser.add_argument("--completion-tokens", default="fixed:32", help="completion tokens of each reply, e.g. uniform:20,200")
+    parser.add_argument("--error-429", type=float, default=0, help="ratio of requests answered with 429")
+    parser.add_argument("--error-500", type=float, default=0, help="ratio of requests answered with 500")
+    parser.add_argument("--timeout-rate", type=float, default=0, help="ratio of requests that hang for --timeout-seconds")
+    parser.add_argument("--timeout-seconds", type=float, default=600)
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After header of 429 responses")
+    args = parser.parse_args(argv)
+    # 提前检查分布的写法
+    for spec in (args.latency, args.token_interval, args.completion_tokens):
+        try:
+            Distribution(spec)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port)
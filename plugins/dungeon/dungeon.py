@@ -16,12 +16,12 @@ class StoryTeller:
     def __init__(self, bot, sessionid, story):
         self.bot = bot
         self.sessionid = sessionid
-        bot.sessions.clear_session(sessionid)
+        bot.clear_session(sessionid)
         self.first_interact = True
         self.story = story
 
     def reset(self):
-        self.bot.sessions.clear_session(self.sessionid)
+        self.bot.clear_session(self.sessionid)
         self.first_interact = True
 
     def action(self, user_action):
@@ -314,11 +314,13 @@ class Godcmd(Plugin):
                         ok, result = False, "你没有设置私有GPT模型"
                 elif cmd == "reset":
                     if bottype in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI, const.BAIDU, const.XUNFEI, const.QWEN, const.GEMINI, const.ZHIPU_AI, const.CLAUDEAPI]:
-                        bot.sessions.clear_session(session_id)
+                        bot.clear_session(session_id)
                         if Bridge().chat_bots.get(bottype):
-                            Bridge().chat_bots.get(bottype).sessions.clear_session(session_id)
-                        channel.cancel_session(session_id)
+                            Bridge().chat_bots.get(bottype).clear_session(session_id)
+                        cancelled = channel.cancel_session(session_id, exclude_context=e_context["context"])
                         ok, result = True, "会话已重置"
+                        if cancelled and cancelled.get("running"):
+                            result += "，已中止{}条处理中的消息".format(cancelled["running"])
                     else:
                         ok, result = False, "当前对话机器人不支持重置会话"
                 logger.debug("[Godcmd] command: %s by %s" % (cmd, user))
@@ -340,8 +342,8 @@ class Godcmd(Plugin):
                         elif cmd == "resetall":
                             if bottype in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI,
                                            const.BAIDU, const.XUNFEI, const.QWEN, const.GEMINI, const.ZHIPU_AI, const.MOONSHOT]:
-                                channel.cancel_all_session()
-                                bot.sessions.clear_all_session()
+                                channel.cancel_all_session(exclude_context=e_context["context"])
+                                bot.clear_all_session()
                                 ok, result = True, "重置所有会话成功"
                             else:
                                 ok, result = False, "当前对话机器人不支持重置会话"
@@ -5,8 +5,8 @@ import requests
 import threading
 import time
 from bridge.reply import Reply, ReplyType
-import asyncio
 from bridge.context import ContextType
+from common.image_jobs import SUCCEEDED, ImageJobQuotaExceeded, image_job_engine
 from plugins import EventContext, EventAction
 from .utils import Util
 
@@ -49,6 +49,12 @@ task_name_mapping = {
 }
 
 
+class MJRequestError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
 class MJTask:
     def __init__(self, id, user_id: str, task_type: TaskType, raw_prompt=None, expires: int = 60 * 6,
                  status=Status.PENDING):
@@ -76,7 +82,6 @@ class MJBot:
         self.tasks = {}
         self.temp_dict = {}
         self.tasks_lock = threading.Lock()
-        self.event_loop = asyncio.new_event_loop()
 
     def judge_mj_task_type(self, e_context: EventContext):
         """
@@ -199,38 +204,28 @@ class MJBot:
         body = {"prompt": prompt, "mode": mode, "auto_translate": self.config.get("auto_translate")}
         if not self.config.get("img_proxy"):
             body["img_proxy"] = False
-        res = requests.post(url=self.base_url + "/generate", json=body, headers=self.headers, timeout=(5, 40))
-        if res.status_code == 200:
-            res = res.json()
-            logger.debug(f"[MJ] image generate, res={res}")
-            if res.get("code") == 200:
-                task_id = res.get("data").get("task_id")
-                real_prompt = res.get("data").get("real_prompt")
-                if mode == TaskMode.RELAX.value:
-                    time_str = "1~10分钟"
-                else:
-                    time_str = "1分钟"
-                content = f"🚀您的作品将在{time_str}左右完成，请耐心等待\n- - - - - - - - -\n"
-                if real_prompt:
-                    content += f"初始prompt: {prompt}\n转换后prompt: {real_prompt}"
-                else:
-                    content += f"prompt: {prompt}"
-                reply = Reply(ReplyType.INFO, content)
-                task = MJTask(id=task_id, status=Status.PENDING, raw_prompt=prompt, user_id=user_id,
-                              task_type=TaskType.GENERATE)
-                # put to memory dict
-                self.tasks[task.id] = task
-                # asyncio.run_coroutine_threadsafe(self.check_task(task, e_context), self.event_loop)
-                self._do_check_task(task, e_context)
-                return reply
-        else:
-            res_json = res.json()
-            logger.error(f"[MJ] generate error, msg={res_json.get('message')}, status_code={res.status_code}")
-            if res.status_code == INVALID_REQUEST:
+        try:
+            data = self._submit_task("/generate", body, user_id, TaskType.GENERATE, e_context, raw_prompt=prompt)
+        except ImageJobQuotaExceeded as e:
+            return Reply(ReplyType.INFO, str(e))
+        except MJRequestError as e:
+            logger.error(f"[MJ] generate error, msg={e}, status_code={e.status_code}")
+            if e.status_code == INVALID_REQUEST:
                 reply = Reply(ReplyType.ERROR, "图片生成失败，请检查提示词参数或内容")
             else:
                 reply = Reply(ReplyType.ERROR, "图片生成失败，请稍后再试")
             return reply
+        real_prompt = data.get("real_prompt")
+        if mode == TaskMode.RELAX.value:
+            time_str = "1~10分钟"
+        else:
+            time_str = "1分钟"
+        content = f"🚀您的作品将在{time_str}左右完成，请耐心等待\n- - - - - - - - -\n"
+        if real_prompt:
+            content += f"初始prompt: {prompt}\n转换后prompt: {real_prompt}"
+        else:
+            content += f"prompt: {prompt}"
+        return Reply(ReplyType.INFO, content)
 
     def do_operate(self, task_type: TaskType, user_id: str, img_id: str, e_context: EventContext,
                    index: int = None) -> Reply:
@@ -240,65 +235,72 @@ class MJBot:
             body["index"] = index
         if not self.config.get("img_proxy"):
             body["img_proxy"] = False
-        res = requests.post(url=self.base_url + "/operate", json=body, headers=self.headers, timeout=(5, 40))
-        logger.debug(res)
-        if res.status_code == 200:
-            res = res.json()
-            if res.get("code") == 200:
-                task_id = res.get("data").get("task_id")
-                logger.info(f"[MJ] image operate processing, task_id={task_id}")
-                icon_map = {TaskType.UPSCALE: "🔎", TaskType.VARIATION: "🪄", TaskType.RESET: "🔄"}
-                content = f"{icon_map.get(task_type)}图片正在{task_name_mapping.get(task_type.name)}中，请耐心等待"
-                reply = Reply(ReplyType.INFO, content)
-                task = MJTask(id=task_id, status=Status.PENDING, user_id=user_id, task_type=task_type)
-                # put to memory dict
-                self.tasks[task.id] = task
-                key = f"{task_type.name}_{img_id}_{index}"
-                self.temp_dict[key] = True
-                # asyncio.run_coroutine_threadsafe(self.check_task(task, e_context), self.event_loop)
-                self._do_check_task(task, e_context)
-                return reply
-        else:
+        try:
+            data = self._submit_task("/operate", body, user_id, task_type, e_context)
+        except ImageJobQuotaExceeded as e:
+            return Reply(ReplyType.INFO, str(e))
+        except MJRequestError as e:
             error_msg = ""
-            if res.status_code == NOT_FOUND_ORIGIN_IMAGE:
+            if e.status_code == NOT_FOUND_ORIGIN_IMAGE:
                 error_msg = "请输入正确的图片ID"
+            logger.error(f"[MJ] operate error, msg={e}, status_code={e.status_code}")
+            return Reply(ReplyType.ERROR, error_msg or "图片生成失败，请稍后再试")
+        logger.info(f"[MJ] image operate processing, task_id={data.get('task_id')}")
+        icon_map = {TaskType.UPSCALE: "🔎", TaskType.VARIATION: "🪄", TaskType.RESET: "🔄"}
+        content = f"{icon_map.get(task_type)}图片正在{task_name_mapping.get(task_type.name)}中，请耐心等待"
+        key = f"{task_type.name}_{img_id}_{index}"
+        self.temp_dict[key] = True
+        return Reply(ReplyType.INFO, content)
+
+    def _submit_task(self, path: str, body: dict, user_id: str, task_type: TaskType, e_context: EventContext,
+                     raw_prompt=None) -> dict:
+        """
+        提交任务，由图片任务引擎统一查询状态，完成后发送结果
+        :return: 接口返回的data
+        """
+        data = {}
+
+        def start():
+            res = requests.post(url=self.base_url + path, json=body, headers=self.headers, timeout=(5, 40))
             res_json = res.json()
-            logger.error(f"[MJ] operate error, msg={res_json.get('message')}, status_code={res.status_code}")
-            reply = Reply(ReplyType.ERROR, error_msg or "图片生成失败，请稍后再试")
-            return reply
+            logger.debug(f"[MJ] submit task, path={path}, res={res_json}")
+            if res.status_code != 200 or res_json.get("code") != 200:
+                raise MJRequestError(res.status_code, res_json.get("message"))
+            data.update(res_json.get("data"))
+            task = MJTask(id=data.get("task_id"), status=Status.PENDING, raw_prompt=raw_prompt, user_id=user_id,
+                          task_type=task_type)
+            # put to memory dict
+            with self.tasks_lock:
+                self.tasks[task.id] = task
+            return task.id
+
+        image_job_engine().submit("midjourney", user_id, start, self._poll_task,
+                                  lambda job: self._on_task_done(job, e_context),
+                                  timeout=60 * 6, first_delay=10,
+                                  max_pending=self.config.get("max_tasks"),
+                                  max_pending_per_user=self.config.get("max_tasks_per_user"))
+        return data
+
+    def _poll_task(self, job):
+        """查询任务状态，完成时返回任务数据，未完成返回None"""
+        res = requests.get(f"{self.base_url}/tasks/{job.remote_id}", headers=self.headers, timeout=8)
+        res_json = res.json()
+        if res.status_code != 200:
+            raise MJRequestError(res.status_code, res_json.get("message"))
+        logger.debug(f"[MJ] task check res, task_id={job.remote_id}, data={res_json.get('data')}")
+        if res_json.get("data") and res_json.get("data").get("status") == Status.FINISHED.name:
+            return res_json.get("data")
+        return None
 
-    def check_task_sync(self, task: MJTask, e_context: EventContext):
-        logger.debug(f"[MJ] start check task status, {task}")
-        max_retry_times = 90
-        while max_retry_times > 0:
-            time.sleep(10)
-            url = f"{self.base_url}/tasks/{task.id}"
-            try:
-                res = requests.get(url, headers=self.headers, timeout=8)
-                if res.status_code == 200:
-                    res_json = res.json()
-                    logger.debug(f"[MJ] task check res sync, task_id={task.id}, status={res.status_code}, "
-                                 f"data={res_json.get('data')}, thread={threading.current_thread().name}")
-                    if res_json.get("data") and res_json.get("data").get("status") == Status.FINISHED.name:
-                        # process success res
-                        if self.tasks.get(task.id):
-                            self.tasks[task.id].status = Status.FINISHED
-                        self._process_success_task(task, res_json.get("data"), e_context)
-                        return
-                    max_retry_times -= 1
-                else:
-                    res_json = res.json()
-                    logger.warn(f"[MJ] image check error, status_code={res.status_code}, res={res_json}")
-                    max_retry_times -= 20
-            except Exception as e:
-                max_retry_times -= 20
-                logger.warn(e)
-        logger.warn("[MJ] end from poll")
-        if self.tasks.get(task.id):
-            self.tasks[task.id].status = Status.EXPIRED
-
-    def _do_check_task(self, task: MJTask, e_context: EventContext):
-        threading.Thread(target=self.check_task_sync, args=(task, e_context)).start()
+    def _on_task_done(self, job, e_context: EventContext):
+        task = self.tasks.get(job.remote_id)
+        if task is None:
+            return
+        if job.status == SUCCEEDED:
+            self._process_success_task(task, job.result, e_context)
+        else:
+            logger.warn(f"[MJ] end from poll, {task}, error={job.error}")
+            task.status = Status.EXPIRED
 
     def _process_success_task(self, task: MJTask, res: dict, e_context: EventContext):
         """
@@ -345,15 +347,14 @@ class MJBot:
         :param e_context: 对话上下文
         :return: 任务是否能够生成, True:可以生成, False: 被限流
         """
-        tasks = self.find_tasks_by_user_id(user_id)
-        task_count = len([t for t in tasks if t.status == Status.PENDING])
-        if task_count >= self.config.get("max_tasks_per_user"):
+        # 提交时任务引擎会再次检查，这里提前回复，避免解析命令后才发现超限
+        engine = image_job_engine()
+        if engine.pending_count("midjourney", user_id) >= self.config.get("max_tasks_per_user"):
             reply = Reply(ReplyType.INFO, "您的Midjourney作图任务数已达上限，请稍后再试")
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
             return False
-        task_count = len([t for t in self.tasks.values() if t.status == Status.PENDING])
-        if task_count >= self.config.get("max_tasks"):
+        if engine.pending_count("midjourney") >= self.config.get("max_tasks"):
             reply = Reply(ReplyType.INFO, "Midjourney作图任务数已达上限，请稍后再试")
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
@@ -366,14 +367,6 @@ class MJBot:
             return TaskMode.RELAX.value
         return mode or TaskMode.FAST.value
 
-    def _run_loop(self, loop: asyncio.BaseEventLoop):
-        """
-        运行事件循环，用于轮询任务的线程
-        :param loop: 事件循环
-        """
-        loop.run_forever()
-        loop.stop()
-
     def _print_tasks(self):
         for id in self.tasks:
             logger.debug(f"[MJ] current task: {self.tasks[id]}")
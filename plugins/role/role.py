@@ -22,7 +22,7 @@ class RolePlay:
         self.bot.sessions.build_session(self.sessionid, system_prompt=self.desc)
 
     def reset(self):
-        self.bot.sessions.clear_session(self.sessionid)
+        self.bot.clear_session(self.sessionid)
 
     def action(self, user_action):
         session = self.bot.sessions.build_session(self.sessionid)
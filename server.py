@@ -15,7 +15,8 @@ from asyncio.subprocess import Process
 import asyncio
 from typing import List
 
-from common.models import Model404, Model400, StatusCodeEnum, CowItem, CoWConfig, ResponseItem, WX, ContactInfo
+from common.models import Model404, Model400, StatusCodeEnum, CowItem, CoWConfig, ResponseItem, WX, ContactInfo, \
+    UsageItem, UsageSummary, UsageResponseItem
 
 
 # todo 用户久不回的主动提醒，插件？
@@ -91,6 +92,16 @@ class CoW:
             fs = await response.json()
             return fs
 
+    async def usage(self, group_by: str) -> UsageItem | None:
+        """获取用量统计，子进程已退出时返回None"""
+        if self._client_session is None or self._client_session.closed: return None
+        try:
+            async with self._client_session.get('http://unix/usage/', params={"group_by": group_by}) as response:
+                return UsageItem(**await response.json())
+        except aiohttp.ClientError as e:
+            print(f"Failed to get usage of cow {self.pid}: {e}")
+            return None
+
     @classmethod
     async def create_cow(cls, ai_name: str, envs: None | dict = None) -> "CoW":
         """在异步环境创建一个新实例，禁止直接调用类来创建"""
@@ -374,6 +385,41 @@ async def delete_cow(cow_id: int):
     return ResponseItem(code=200, msg="success", data=None)
 
 
+def _sum_usage(items: List[UsageItem]) -> dict:
+    total = {}
+    for item in items:
+        for field, value in item.total.items():
+            total[field] = total.get(field, 0) + value
+    return total
+
+
+@app.get("/usage/", summary="获取所有CoW实例的用量", response_model=UsageResponseItem)
+async def get_usage(group_by: str = Query("user_id,group_id,model", description="逗号分隔的分组维度，可选user_id、group_id、model")):
+    """
+    汇总所有运行中CoW实例的请求数、失败数、token用量和耗时，每个实例的用量从其进程启动时开始累计。
+    """
+    items = [item for item in await asyncio.gather(*[cow.usage(group_by) for cow in list(cows.values())]) if item]
+    return UsageResponseItem(data=UsageSummary(total=_sum_usage(items), cows=items))
+
+
+@app.get("/cows/{cow_id}/usage/", summary="获取CoW实例的用量",
+         responses={
+             "200": {"description": "取得目标CoW的用量", "model": UsageResponseItem},
+             "404": {"description": "未找到目标CoW", "model": Model404}
+         })
+async def get_cow_usage(cow_id: int,
+                        group_by: str = Query("user_id,group_id,model", description="逗号分隔的分组维度，可选user_id、group_id、model")):
+    """
+    获取指定CoW的用量统计。
+    """
+    if cow_id not in cows:
+        raise HTTPException(status_code=404)
+
+    item = await cows[cow_id].usage(group_by)
+    items = [item] if item else []
+    return UsageResponseItem(data=UsageSummary(total=_sum_usage(items), cows=items))
+
+
 # todo 聊天记录列表和实时聊天推送
 
 # PATCH：部分更新资源
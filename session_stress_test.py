@@ -0,0 +1,121 @@
+"""
+会话并发压测：多个线程在大量session_id上并发执行session_query、session_reply、读取消息和clear_session，
+检查分段锁下没有丢失对话记录、没有死锁，SessionStore的字节统计与会话内容一致
+
+用法:
+    python session_stress_test.py [--threads 32] [--sessions 1000] [--turns 2000] [--timeout 120]
+"""
+import argparse
+import faulthandler
+import random
+import sys
+import threading
+import time
+
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_by_character
+from bot.session_manager import SessionManager
+from config import conf, load_config
+
+
+class StressSession(ChatGPTSession):
+    def calc_tokens(self):
+        # 按字符估算，避免压测时间花在tiktoken上
+        return num_tokens_by_character(self.messages)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=2000, help="query/reply turns of each thread")
+    parser.add_argument("--clear-ratio", type=float, default=0.01, help="ratio of turns that clear a session")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds before reporting a deadlock")
+    args = parser.parse_args()
+
+    load_config()
+    conf().update({
+        "conversation_max_tokens": 10 ** 9,  # 不丢弃历史，才能核对每一轮对话
+        "expires_in_seconds": 0,
+        "session_max_count": 0,
+        "session_max_memory_mb": 0,
+        "conversation_summary": False,
+        "session_backend": "memory",
+    })
+    manager = SessionManager(StressSession, model=conf().get("model"))
+    # 一半会话只追加不清除，用于核对完整的历史；另一半会话会被并发清除
+    stable_ids = ["stable-{}".format(i) for i in range(args.sessions // 2)]
+    volatile_ids = ["volatile-{}".format(i) for i in range(args.sessions - len(stable_ids))]
+    expected = {session_id: [] for session_id in stable_ids}  # session_id -> [(线程, 轮次)]
+    errors = []
+
+    def worker(thread_no):
+        rng = random.Random(thread_no)
+        done = []
+        try:
+            for turn in range(args.turns):
+                if rng.random() < 0.5:
+                    session_id = rng.choice(stable_ids)
+                    done.append((session_id, turn))
+                else:
+                    session_id = rng.choice(volatile_ids)
+                    if rng.random() < args.clear_ratio * 2:
+                        manager.clear_session(session_id)
+                        continue
+                tag = "{}-{}".format(thread_no, turn)
+                manager.session_query("q" + tag, session_id)
+                # 并发读取消息，触发紧凑记录的还原
+                session = manager.sessions.get(session_id)
+                if session is not None:
+                    len(session.messages)
+                manager.session_reply("r" + tag, session_id)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            with expected_lock:
+                for session_id, turn in done:
+                    expected[session_id].append((thread_no, turn))
+
+    expected_lock = threading.Lock()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(max(0.0, start + args.timeout - time.time()))
+    cost = time.time() - start
+    if any(t.is_alive() for t in threads):
+        faulthandler.dump_traceback(all_threads=True)
+        print("deadlock: threads still running after {}s".format(args.timeout))
+        sys.exit(1)
+    assert not errors, "worker errors: {}".format(errors[:5])
+
+    lost = 0
+    for session_id, turns in expected.items():
+        session = manager.sessions.get(session_id)
+        messages = session.messages[1:] if session else []
+        contents = set(message["content"] for message in messages)
+        assert len(messages) == len(contents), "duplicated messages in {}".format(session_id)
+        for thread_no, turn in turns:
+            tag = "{}-{}".format(thread_no, turn)
+            lost += ("q" + tag not in contents) + ("r" + tag not in contents)
+        assert len(messages) == 2 * len(turns), "unexpected messages in {}".format(session_id)
+        # 同一线程的一轮对话里，提问总在回复之前
+        index = {message["content"]: i for i, message in enumerate(messages)}
+        assert all(index["q{}-{}".format(*t)] < index["r{}-{}".format(*t)] for t in turns), "reply before query in {}".format(session_id)
+    for session_id in volatile_ids:
+        session = manager.sessions.get(session_id)
+        if session is not None:
+            assert session.messages[0]["role"] == "system", "broken session {}".format(session_id)
+
+    stats = manager.stats()
+    total_bytes = sum(entry[0].size_bytes() for entry in manager.sessions.entries.values())
+    operations = args.threads * args.turns
+    print("threads={}, sessions={}, {} turns in {:.2f}s ({:.0f}/s)".format(args.threads, args.sessions, operations, cost, operations / cost))
+    print("stats={}, recomputed bytes={}, lost messages={}".format(stats, total_bytes, lost))
+    assert lost == 0, "lost {} messages".format(lost)
+    assert stats["bytes"] == total_bytes, "byte accounting drifted: {} != {}".format(stats["bytes"], total_bytes)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
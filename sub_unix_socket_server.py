@@ -2,6 +2,7 @@ import asyncio
 import json
 import os
 from app import run
+from common import metering
 from common.models import SwitchItem
 from lib import itchat
 from plugins import PluginManager
@@ -52,6 +53,14 @@ async def switch(switch_item: SwitchItem):
     return plugins["SWITCH"].switch
 
 
+@app.get("/usage/")
+async def usage(group_by: str = "user_id,group_id,model"):
+    """
+    Get metered usage of this CoW, grouped by the comma separated dimensions in group_by
+    """
+    return metering.summary(tuple(d.strip() for d in group_by.split(",") if d.strip()))
+
+
 # ToDo 聊天记录 ChatGPT bot实例.session.messages
 
 if __name__ == '__main__':
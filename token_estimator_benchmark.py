@@ -0,0 +1,169 @@
+"""
+token估算基准：以tiktoken的精确计数为准，统计approximate估算的相对误差分位数和吞吐量，
+并按中日韩字符、英文单词、数字、其他符号拟合openai系列的系数(common/token_estimator.py中的DEFAULT_COEFFICIENTS)
+
+语料默认取自仓库中的文档和角色设定，按随机的行数切成片段模拟消息；一半用于拟合，另一半用于评估；
+需要覆盖代码类消息时可以加入 --corpus "**/*.py"
+tiktoken首次使用需要下载编码文件，离线环境可通过TIKTOKEN_CACHE_DIR指定已缓存的目录
+
+用法:
+    python token_estimator_benchmark.py [--encoding cl100k_base] [--corpus a.txt b.md ...] [--samples 5000]
+"""
+import argparse
+import glob
+import json
+import random
+import time
+
+import tiktoken
+
+from common import token_estimator
+from common.token_estimator import DEFAULT_COEFFICIENTS, _script_counts
+from config import load_config
+
+FEATURES = ("cjk", "word", "digit", "other")
+DEFAULT_CORPUS = ["**/*.md", "plugins/role/roles.json"]
+
+
+def load_texts(patterns) -> list:
+    texts = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            with open(path, encoding="utf-8", errors="ignore") as f:
+                content = f.read()
+            if path.endswith(".json"):
+                # 角色设定中的提示词最接近真实的对话内容
+                content = "\n".join(_json_strings(json.loads(content)))
+            texts.append(content)
+    return texts
+
+
+def _json_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _json_strings(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from _json_strings(v)
+
+
+def make_samples(texts, count, rng) -> list:
+    """从语料中随机截取1-30行的片段"""
+    lines = [text.splitlines() for text in texts if text.strip()]
+    samples = []
+    while len(samples) < count:
+        doc = rng.choice(lines)
+        start = rng.randrange(len(doc))
+        sample = "\n".join(doc[start:start + rng.randint(1, 30)]).strip()
+        if sample:
+            samples.append(sample)
+    return samples
+
+
+def fit(rows, targets) -> dict:
+    """
+    按相对误差做非负最小二乘：最小化 sum(((x·c) - y) / y)^2，系数为负的特征置0后重新求解
+    """
+    active = list(range(len(FEATURES)))
+    while True:
+        n = len(active)
+        ata = [[0.0] * n for _ in range(n)]
+        aty = [0.0] * n
+        for x, y in zip(rows, targets):
+            w = 1.0 / (y * y)
+            for i in range(n):
+                xi = x[active[i]]
+                aty[i] += w * xi * y
+                for j in range(n):
+                    ata[i][j] += w * xi * x[active[j]]
+        solution = _solve(ata, aty)
+        negative = [active[i] for i, c in enumerate(solution) if c < 0]
+        if not negative:
+            coefficients = dict.fromkeys(FEATURES, 0.0)
+            for i, c in zip(active, solution):
+                coefficients[FEATURES[i]] = c
+            return coefficients
+        active = [i for i in active if i not in negative]
+
+
+def _solve(a, b) -> list:
+    """高斯消元，特征很少，不依赖numpy"""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        m[col], m[pivot] = m[pivot], m[col]
+        if abs(m[col][col]) < 1e-12:
+            m[col][col] = 1e-12  # 语料中没有该类字符，系数取0
+        for r in range(n):
+            if r != col:
+                factor = m[r][col] / m[col][col]
+                for k in range(col, n + 1):
+                    m[r][k] -= factor * m[col][k]
+    return [m[i][n] / m[i][i] for i in range(n)]
+
+
+def percentile(values, p) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def report(name, samples, exact, coefficients):
+    errors = []
+    for text, y in zip(samples, exact):
+        estimate = token_estimator.approximate_tokens(text, coefficients)
+        errors.append((estimate - y) / y)
+    abs_errors = [abs(e) for e in errors]
+    under = sum(1 for e in errors if e < 0) / len(errors)
+    print("{:<10} mean={:+.1%}  |err| p50={:.1%} p90={:.1%} p99={:.1%} max={:.1%}  underestimate={:.0%}  total={:+.1%}".format(
+        name, sum(errors) / len(errors), percentile(abs_errors, 50), percentile(abs_errors, 90), percentile(abs_errors, 99),
+        max(abs_errors), under, sum(token_estimator.approximate_tokens(t, coefficients) for t in samples) / sum(exact) - 1))
+
+
+def throughput(samples, encoding, coefficients):
+    chars = sum(len(text) for text in samples)
+    _script_counts.cache_clear()
+    start = time.perf_counter()
+    for text in samples:
+        token_estimator.approximate_tokens(text, coefficients)
+    approximate_cost = time.perf_counter() - start
+    start = time.perf_counter()
+    for text in samples:
+        encoding.encode(text, disallowed_special=())
+    exact_cost = time.perf_counter() - start
+    print("throughput: approximate {:.0f} texts/s ({:.1f} MB/s), tiktoken {:.0f} texts/s ({:.1f} MB/s)".format(
+        len(samples) / approximate_cost, chars / approximate_cost / 1e6, len(samples) / exact_cost, chars / exact_cost / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encoding", default="cl100k_base", help="tiktoken encoding used as ground truth, e.g. cl100k_base, o200k_base")
+    parser.add_argument("--corpus", nargs="*", default=DEFAULT_CORPUS, help="text files or glob patterns")
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_config()
+    encoding = tiktoken.get_encoding(args.encoding)
+    rng = random.Random(args.seed)
+    samples = make_samples(load_texts(args.corpus), args.samples * 2, rng)
+    exact = [max(1, len(encoding.encode(text, disallowed_special=()))) for text in samples]
+    train, test = samples[:args.samples], samples[args.samples:]
+    train_exact, test_exact = exact[:args.samples], exact[args.samples:]
+
+    fitted = fit([_script_counts(text) for text in train], train_exact)
+    current = DEFAULT_COEFFICIENTS["openai"]
+    print("encoding={}, {} samples for fitting, {} for evaluation, {:.1f} chars/sample".format(
+        args.encoding, len(train), len(test), sum(map(len, samples)) / len(samples)))
+    print("current: " + ", ".join("{}={}".format(k, current[k]) for k in FEATURES))
+    print("fitted:  " + ", ".join("{}={:.2f}".format(k, fitted[k]) for k in FEATURES))
+    report("current", test, test_exact, current)
+    report("fitted", test, test_exact, dict(fitted, message=current["message"]))
+    print("token_estimator_coefficients: " + json.dumps({"openai": {k: round(fitted[k], 2) for k in FEATURES}}))
+    throughput(test, encoding, current)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import random
 import requests
 from voice import audio_convert
 from bridge.reply import Reply, ReplyType
+from common.compute_pool import compute_pool
 from common.log import logger
 from config import conf
 from voice.voice import Voice
@@ -27,7 +28,7 @@ class LinkAIVoice(Voice):
             if voice_file.endswith(".amr"):
                 try:
                     mp3_file = os.path.splitext(voice_file)[0] + ".mp3"
-                    audio_convert.any_to_mp3(voice_file, mp3_file)
+                    compute_pool().run(audio_convert.any_to_mp3, voice_file, mp3_file)
                     voice_file = mp3_file
                 except Exception as e:
                     logger.warn(f"[LinkVoice] amr file transfer failed, directly send amr voice file: {format(e)}")